@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Packed asset archive for distribution builds.
+
+``python assetpack.py [assets-dir] [archive]`` decodes every image in the
+assets directory into raw RGBA rows (bottom row first, the way OpenGL
+wants them) and every WAV file into raw PCM, and writes them all to a
+single archive together with the remaining files.
+
+At run time `AssetArchive` memory-maps the archive and serves it through
+the usual `pyglet.resource` interface, so images go from the page cache
+straight into texture atlases without being opened, decoded or copied.
+
+Archive layout (all integers little-endian)::
+
+    header   magic, version, entry count
+    index    one fixed-size ENTRY record per asset
+    data     asset payloads, each aligned to ALIGNMENT bytes
+
+"""
+import os
+import sys
+import mmap
+import wave
+import ctypes
+import struct
+
+
+MAGIC = 'DODOPAK\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sII')
+# name, kind, a, b, c, offset, size; the meaning of a, b, c depends on kind
+ENTRY = struct.Struct('<64sc3xIIIQQ')
+
+IMAGE = 'I' # a, b = width, height; c is 0
+SOUND = 'S' # a, b, c = channels, sample size in bits, sample rate
+FILE = 'F'
+
+ALIGNMENT = 16
+
+IMAGE_SUFFIXES = ('.png', )
+SOUND_SUFFIXES = ('.wav', )
+SKIPPED_SUFFIXES = ('.ico', ) # only needed by py2exe at build time
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class Entry(object):
+
+    def __init__(self, name, kind, a, b, c, offset, size):
+        self.name = name
+        self.kind = kind
+        self.a, self.b, self.c = a, b, c
+        self.offset = offset
+        self.size = size
+
+
+def read_index(data):
+    """Parse the header and index at the start of ``data``."""
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ArchiveError('not an asset archive')
+    if version != VERSION:
+        raise ArchiveError('unsupported archive version %d' % version)
+    index = {}
+    for n in range(count):
+        fields = ENTRY.unpack_from(data, HEADER.size + n * ENTRY.size)
+        name = fields[0].rstrip('\0')
+        index[name] = Entry(name, *fields[1:])
+    return index
+
+
+def decode_image(path):
+    import pyglet
+    image = pyglet.image.load(path).get_image_data()
+    data = image.get_data('RGBA', image.width * 4)
+    return image.width, image.height, 0, data
+
+
+def decode_sound(path):
+    w = wave.open(path, 'rb')
+    try:
+        data = w.readframes(w.getnframes())
+        return w.getnchannels(), w.getsampwidth() * 8, w.getframerate(), data
+    finally:
+        w.close()
+
+
+def pack(src_dir, filename):
+    """Pack the files in ``src_dir`` into the archive ``filename``."""
+    entries = []
+    for name in sorted(os.listdir(src_dir)):
+        path = os.path.join(src_dir, name)
+        suffix = os.path.splitext(name)[1].lower()
+        if (not os.path.isfile(path) or name.startswith('.')
+            or suffix in SKIPPED_SUFFIXES):
+            continue
+        if len(name) > 64:
+            raise ArchiveError('file name too long: %s' % name)
+        if suffix in IMAGE_SUFFIXES:
+            entries.append((name, IMAGE) + decode_image(path))
+        elif suffix in SOUND_SUFFIXES:
+            entries.append((name, SOUND) + decode_sound(path))
+        else:
+            entries.append((name, FILE, 0, 0, 0, open(path, 'rb').read()))
+
+    offset = HEADER.size + ENTRY.size * len(entries)
+    index = []
+    for name, kind, a, b, c, data in entries:
+        offset += -offset % ALIGNMENT
+        index.append(ENTRY.pack(name, kind, a, b, c, offset, len(data)))
+        offset += len(data)
+
+    f = open(filename, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+        f.write(''.join(index))
+        for (name, kind, a, b, c, data) in entries:
+            f.write('\0' * (-f.tell() % ALIGNMENT))
+            f.write(data)
+    finally:
+        f.close()
+    return len(entries)
+
+
+class MappedFile(object):
+    """Read-only file object over a slice of a memory map."""
+
+    def __init__(self, map, offset, size):
+        self._map = map
+        self._start = offset
+        self._end = offset + size
+        self._pos = offset
+
+    def read(self, size=-1):
+        if size < 0:
+            end = self._end
+        else:
+            end = min(self._pos + size, self._end)
+        data = self._map[self._pos:end]
+        self._pos = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos - self._start
+        elif whence == 2:
+            offset += self._end - self._start
+        self._pos = self._start + max(0, min(offset, self._end - self._start))
+
+    def tell(self):
+        return self._pos - self._start
+
+    def close(self):
+        pass
+
+
+def _loader_class():
+    # pyglet is imported late so that assetpack can be imported by setup.py
+    # without creating pyglet's shadow window
+    import pyglet
+    from pyglet import media
+
+    class MappedSoundSource(media.StaticMemorySource):
+        """PCM audio read straight out of the archive."""
+
+        def __init__(self, map, entry):
+            self._map, self._entry = map, entry
+            self._file = MappedFile(map, entry.offset, entry.size)
+            self._max_offset = entry.size
+            self.audio_format = media.AudioFormat(entry.a, entry.b, entry.c)
+            self._duration = entry.size / float(self.audio_format.bytes_per_second)
+
+        def _get_queue_source(self):
+            # every queued copy reads the same pages from its own position
+            return MappedSoundSource(self._map, self._entry)
+
+    class AssetArchive(pyglet.resource.Loader):
+        """A `pyglet.resource.Loader` serving assets from a packed archive."""
+
+        def __init__(self, filename):
+            self.filename = filename
+            self._file = open(filename, 'rb')
+            # copy-on-write, because ctypes can only wrap writable buffers;
+            # nothing ever writes, so no page is ever copied
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_COPY)
+            super(AssetArchive, self).__init__(path=[])
+
+        def reindex(self):
+            self._index = read_index(self._map)
+
+        def _entry(self, name, kind=None):
+            try:
+                entry = self._index[name]
+            except KeyError:
+                raise pyglet.resource.ResourceNotFoundException(name)
+            if kind is not None and entry.kind != kind:
+                raise ArchiveError('%s is not stored as %r' % (name, kind))
+            return entry
+
+        def image_data(self, name):
+            entry = self._entry(name, IMAGE)
+            data = (ctypes.c_ubyte * entry.size).from_buffer(self._map,
+                                                             entry.offset)
+            return pyglet.image.ImageData(entry.a, entry.b, 'RGBA', data)
+
+        def _alloc_image(self, name):
+            img = self.image_data(name)
+            bin = self._get_texture_atlas_bin(img.width, img.height)
+            if bin is None:
+                return img.get_texture(True)
+            return bin.add(img)
+
+        def file(self, name, mode='rb'):
+            entry = self._entry(name)
+            if entry.kind != FILE:
+                raise ArchiveError('%s was decoded when packing' % name)
+            return MappedFile(self._map, entry.offset, entry.size)
+
+        def location(self, name):
+            raise ArchiveError('%s has no location in an archive' % name)
+
+        def media(self, name, streaming=True):
+            return MappedSoundSource(self._map, self._entry(name, SOUND))
+
+    return AssetArchive
+
+
+def open_archive(filename):
+    """Return an `AssetArchive` for ``filename``."""
+    return _loader_class()(filename)
+
+
+def main():
+    src_dir = len(sys.argv) > 1 and sys.argv[1] or 'assets'
+    filename = len(sys.argv) > 2 and sys.argv[2] or 'assets.pak'
+    import pyglet
+    pyglet.options['shadow_window'] = False
+    n = pack(src_dir, filename)
+    print('packed %d assets into %s' % (n, filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+A search-based Dodopult player, for benchmarks and balancing runs.
+
+Before each throw `AutoPlayer` scores every candidate shot (where to stand,
+what angle, what power) and then drives the dodopult through the same
+methods a player's keys call.  A dodo's flight doesn't depend on where it
+starts, so the flight path of every angle and power is worked out once
+(`ShotTable`) and a candidate is scored by sliding its path to the launch
+point and walking it over the map's column heights until it hits the
+ground, the same way Dodo.update() would.  Scores are cached per launch
+point, so after the first throw from a spot a decision costs next to
+nothing; even a fresh one fits in a tick.
+
+It only reads the headless game state, so it runs the same with or
+without a window.
+"""
+import math
+import bisect
+from array import array
+
+
+class ShotTable(object):
+    """Flight paths of the candidate shots, relative to the launch point.
+
+    Each path is (xs, ys, index of the highest step).
+
+    ``powers`` are the exact powers the dodopult reaches while powering
+    up, so a chosen shot can really be fired.
+    """
+
+    max_drop = 2000 # stop following a path this far below the launch
+
+    def __init__(self, gravity, air_resistance, dt, angles, powers,
+                 max_steps=600):
+        self.physics = (gravity, air_resistance, dt)
+        self.shots = []
+        self.paths = []
+        step = dt * 3 # Dodo.update() runs the dodos at triple speed
+        # the same steps as dodo.flight_step()
+        keep = math.exp(-air_resistance * step)
+        if air_resistance:
+            reach = (1 - keep) / air_resistance
+        else:
+            reach = step
+        for angle in angles:
+            rad = math.radians(angle)
+            for power in powers:
+                dx, dy = power * math.cos(rad), power * math.sin(rad)
+                x = y = 0.0
+                xs, ys = array('d'), array('d')
+                while len(xs) < max_steps and y > -self.max_drop:
+                    x += dx * reach
+                    y += (dy - gravity * step / 2) * step
+                    xs.append(x)
+                    ys.append(y)
+                    dy -= gravity * step
+                    dx *= keep
+                self.shots.append((angle, power))
+                self.paths.append((xs, ys, max(range(len(ys)),
+                                               key=ys.__getitem__)))
+
+
+class Heightmap(object):
+    """Ground level of every map column, as Map.ground_level() sees it."""
+
+    def __init__(self, game_map):
+        self.tile_width = width = game_map.tile_width
+        columns = int(game_map.map_width / width)
+        self.heights = array('d', [game_map.ground_level(col * width)
+                                   for col in range(columns)])
+        # past either edge of the map there is a wall
+        self.outside = game_map.ground_level(columns * width)
+
+    def landing(self, path, x0, y0):
+        """Where a dodo launched at (x0, y0) along path lands.
+
+        Returns (x, ground, from_above), or None if it never lands; a dodo
+        that doesn't come down from above hits a wall.
+
+        Shots always go right, so the steps over each column are found by
+        bisecting the path's x, and as the path only falls after its apex,
+        the step where it drops below a column's ground is bisected too:
+        a shot costs a few lookups per column it crosses, not one per step.
+        """
+        heights, width, outside = self.heights, self.tile_width, self.outside
+        columns = len(heights)
+        xs, ys, apex = path
+        n = len(xs)
+        i = 0
+        prev_y = y0
+        while i < n:
+            col = int((x0 + xs[i]) / width)
+            if 0 <= col < columns:
+                ground = heights[col]
+                end = bisect.bisect_left(xs, (col + 1) * width - x0, i + 1)
+            else:
+                ground = outside
+                end = n
+            if y0 + ys[i] < ground:
+                return x0 + xs[i], ground, prev_y >= ground
+            below = ground - y0
+            if ys[end - 1] < below:
+                # the first step below ground is past the apex, where the
+                # path only falls; everything before it is above ground
+                lo, hi = max(i + 1, apex), end - 1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if ys[mid] < below:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                return x0 + xs[lo], ground, True
+            prev_y = y0 + ys[end - 1]
+            i = end
+        return None
+
+
+class AutoPlayer(object):
+    """Loads the nearest dodo and throws it where the search says.
+
+    Call act() once per game tick, before the clock is ticked.
+    """
+
+    angle_step = 5   # degrees between candidate angles
+    power_steps = 12 # candidate powers between min and max
+
+    def __init__(self, rng=None):
+        self.rng = rng
+        self.table = None
+        self.heightmap = None
+        self.power_step = 0.0
+        self.scores = {} # (launch x, launch y, level) -> [(score, shot)]
+        self.plan = None # (dodopult x, angle, power)
+
+    def act(self, game, dt=None):
+        dodopult = game.dodopult
+        if not dodopult.armed:
+            return
+        if dodopult.payload is None:
+            self.plan = None
+            walk_to_nearest_dodo(game)
+            return
+        if self.plan is None:
+            self.plan = self.choose(game)
+        x, angle, power = self.plan
+        if dodopult.x < x:
+            dodopult.move_right()
+        elif dodopult.x > x:
+            dodopult.move_left()
+        elif dodopult.aim_angle < angle:
+            dodopult.aim_up()
+        elif dodopult.aim_angle > angle:
+            dodopult.aim_down()
+        elif not dodopult.powering_up:
+            dodopult.start_powering_up()
+        elif dodopult.power >= power - self.power_step / 2:
+            dodopult.fire()
+            self.plan = None
+
+    def prepare(self, game):
+        """(Re)build the tables if the physics constants changed."""
+        dodopult = game.dodopult
+        self.power_step = power_step = (game.update_freq *
+                                        dodopult.power_increase)
+        reachable = int((dodopult.max_power - dodopult.min_power) / power_step)
+        stride = max(1, reachable // self.power_steps)
+        powers = [min(dodopult.min_power + k * power_step, dodopult.max_power)
+                  for k in range(0, reachable + 1, stride)]
+        angles = range(dodopult.min_aim_angle, dodopult.max_aim_angle + 1,
+                       self.angle_step)
+        physics = (game.gravity, game.air_resistance, game.update_freq)
+        if self.table is None or self.table.physics != physics:
+            self.table = ShotTable(game.gravity, game.air_resistance,
+                                   game.update_freq, angles, powers)
+            self.scores = {}
+        if self.heightmap is None:
+            self.heightmap = Heightmap(game.game_map)
+
+    def positions(self, game):
+        """Where the dodopult can stand: here, or as far right as it goes."""
+        dodopult = game.dodopult
+        right = game.current_level.right - dodopult.MARGIN_RIGHT
+        steps = int(max(0, right - dodopult.x) // 15)
+        return sorted(set([dodopult.x, dodopult.x + 15 * steps]))
+
+    def choose(self, game):
+        self.prepare(game)
+        dodopult = game.dodopult
+        best = None
+        for x in self.positions(game):
+            for score, (angle, power) in self.score(game, x, dodopult.y):
+                # walking there costs a little
+                score -= abs(x - dodopult.x) / 10000.0
+                if self.rng is not None:
+                    score += self.rng.uniform(0, 0.01) # vary equal shots
+                if best is None or score > best[0]:
+                    best = (score, (x, angle, power))
+        return best[1]
+
+    def score(self, game, x, y):
+        level = game.current_level
+        key = (x, y, level.number)
+        scores = self.scores.get(key)
+        if scores is not None:
+            return scores
+        dodopult = game.dodopult
+        x0 = x + dodopult.LAUNCH_POS[0]
+        y0 = y + dodopult.LAUNCH_POS[1]
+        # just past the next cliff is safe, and easy to pick up from
+        target = (level.next or level).left + 150
+        scores = []
+        for shot, path in zip(self.table.shots, self.table.paths):
+            landing = self.heightmap.landing(path, x0, y0)
+            if landing is None or not landing[2]:
+                score = -1.0 # off the map, or into a wall
+            elif landing[1] > level.height:
+                score = 1.0 - min(1.0, abs(landing[0] - target) / 2000.0)
+            elif landing[1] == level.height:
+                score = -0.25 # wasted, but it can be thrown again
+            else:
+                score = -0.5 # back down, where the sea gets it
+            scores.append((score, shot))
+        self.scores[key] = scores
+        return scores
+
+
+def walk_to_nearest_dodo(game):
+    """Move the dodopult towards the nearest dodo it can load; load it."""
+    dodopult = game.dodopult
+    here = [dodo.x for dodo in game.dodos
+            if dodo.is_alive and not dodo.in_flight
+            and dodo.y == game.current_level.height]
+    if not here:
+        return
+    x = min(here, key=lambda x: abs(x - dodopult.x))
+    left, right = dodopult.PICKUP_RANGE
+    if x < dodopult.x + left:
+        dodopult.move_left()
+    elif x > dodopult.x + right:
+        dodopult.move_right()
+    else:
+        dodopult.try_load()
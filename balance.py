@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Monte Carlo balancing runs for Dodopult's physics constants.
+
+    python balance.py --games 500 --set gravity=150,200,250 \\
+                      --set max_power=900,1000,1100 --output runs.jsonl
+
+Plays many headless games with scripted, random or search players, for every
+combination of the --set values, spread over a pool of worker processes
+(one per core by default).  Each game runs on a manual clock, as fast as
+the CPU allows, until it is over or --seconds of game time have passed.
+Results are written to --output as one JSON object per line as soon as
+they come in, and summed up per combination at the end: how many games
+reached the last level, how many of the dodos made it, and how long each
+level lasted.
+
+The tunable parameters are listed in PARAMETERS.
+"""
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+import server
+import autoplay
+
+
+# name -> (part of the game, attribute)
+PARAMETERS = {
+    'gravity': ('game', 'gravity'),
+    'air_resistance': ('game', 'air_resistance'),
+    'min_power': ('dodopult', 'min_power'),
+    'max_power': ('dodopult', 'max_power'),
+    'power_increase': ('dodopult', 'power_increase'),
+    'sea_rise': ('sea', 'rise_speed'),
+    'sea_growth': ('sea', 'rise_growth'),
+}
+
+
+def apply_parameters(game, params):
+    for name, value in params:
+        part, attr = PARAMETERS[name]
+        obj = game if part == 'game' else getattr(game, part)
+        setattr(obj, attr, value)
+    game.dodopult.power = game.dodopult.min_power
+
+
+class RandomPlayer(object):
+    """Presses a random key every now and then."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.wait = 0.0
+
+    def act(self, game, dt):
+        self.wait -= dt
+        if self.wait > 0:
+            return
+        self.wait = self.rng.uniform(0.05, 0.5)
+        getattr(game.dodopult, self.rng.choice(server.EVENTS))()
+
+
+class ScriptedPlayer(object):
+    """Walks to the nearest dodo, loads it and throws it to the right.
+
+    Aim and power are picked at random for each throw, so a sweep sees a
+    spread of shots rather than one lucky one.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.target = None
+
+    def act(self, game, dt):
+        dodopult = game.dodopult
+        if not dodopult.armed:
+            return
+        if dodopult.payload is None:
+            autoplay.walk_to_nearest_dodo(game)
+        elif self.target is None:
+            low, high = dodopult.min_power, dodopult.max_power
+            self.target = (self.rng.randint(dodopult.min_aim_angle + 15,
+                                            dodopult.max_aim_angle - 5),
+                           self.rng.uniform(low + (high - low) * 0.4, high))
+        elif dodopult.aim_angle < self.target[0]:
+            dodopult.aim_up()
+        elif dodopult.aim_angle > self.target[0]:
+            dodopult.aim_down()
+        elif not dodopult.powering_up:
+            dodopult.start_powering_up()
+        elif dodopult.power >= self.target[1]:
+            dodopult.fire()
+            self.target = None
+
+
+PLAYERS = {'random': RandomPlayer, 'scripted': ScriptedPlayer,
+           'search': autoplay.AutoPlayer}
+
+
+def play(task):
+    """Play one game; return its result as a dict."""
+    params, player, seed, seconds = task
+    random.seed(seed) # where the game puts the dodos
+    session = server.Session(seed)
+    game = session.game
+    apply_parameters(game, params)
+    bot = PLAYERS[player](random.Random(seed))
+    dt = server.TICK
+    level = game.current_level.number
+    level_started = 0.0
+    level_times = []
+    started = time.time()
+    while not game.game_is_over and session.time < seconds:
+        bot.act(game, dt)
+        session.step(dt)
+        if game.current_level.number != level:
+            level_times.append(session.time - level_started)
+            level = game.current_level.number
+            level_started = session.time
+    if game.game_is_over:
+        level_times.append(session.time - level_started)
+    # dodos left behind below the current level don't count
+    survivors = len([dodo for dodo in game.dodos if dodo.is_alive
+                     and dodo.y >= game.current_level.height])
+    return dict(params=params, player=player, seed=seed,
+                dodos=game.INITIAL_DODOS, survivors=survivors,
+                level=level, levels=len(game.game_map.levels),
+                completed=game.game_is_over and survivors > 0,
+                timed_out=not game.game_is_over, time=session.time,
+                level_times=level_times, cpu_time=time.time() - started)
+
+
+class Summary(object):
+    """Results summed up per parameter combination."""
+
+    def __init__(self):
+        self.rows = {} # params -> dict of sums
+        self.order = []
+
+    def add(self, result):
+        params = tuple(tuple(param) for param in result['params'])
+        row = self.rows.get(params)
+        if row is None:
+            row = self.rows[params] = dict(games=0, completed=0,
+                                           timed_out=0, dodos=0,
+                                           survivors=0, levels=[])
+            self.order.append(params)
+        row['games'] += 1
+        row['completed'] += result['completed']
+        row['timed_out'] += result['timed_out']
+        row['dodos'] += result['dodos']
+        row['survivors'] += result['survivors']
+        levels = row['levels']
+        for n, seconds in enumerate(result['level_times']):
+            if n == len(levels):
+                levels.append([0, 0.0])
+            levels[n][0] += 1
+            levels[n][1] += seconds
+
+    def report(self):
+        """Return the summary as lines of text, one per combination."""
+        lines = []
+        for params in self.order:
+            row = self.rows[params]
+            name = ' '.join('%s=%g' % param for param in params) or 'defaults'
+            lines.append('%s: %d games, %.0f%% completed, %.0f%% of dodos '
+                         'saved, %d timed out' % (
+                             name, row['games'],
+                             100.0 * row['completed'] / row['games'],
+                             100.0 * row['survivors'] / max(1, row['dodos']),
+                             row['timed_out']))
+            lines.append('    seconds per level: ' + ' '.join(
+                '%d:%.1f' % (n + 1, total / count)
+                for n, (count, total) in enumerate(row['levels'])))
+        return lines
+
+
+def sweep(values):
+    """All combinations of {name: [value, ...]}, as lists of pairs."""
+    names = sorted(values)
+    for combination in itertools.product(*[values[name] for name in names]):
+        yield zip(names, combination)
+
+
+def parse_values(option, opt_str, value, parser):
+    name, sep, values = value.partition('=')
+    if name not in PARAMETERS or not values:
+        parser.error('%s expects one of %s followed by =value,value,...'
+                     % (opt_str, ', '.join(sorted(PARAMETERS))))
+    parser.values.sweep[name] = [float(v) for v in values.split(',')]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.set_defaults(sweep={})
+    parser.add_option('--set', action='callback', callback=parse_values,
+                      type='string', metavar='NAME=V1,V2,...',
+                      help='values to try for a parameter')
+    parser.add_option('--games', type='int', default=100,
+                      help='games per combination [default: %default]')
+    parser.add_option('--player', choices=sorted(PLAYERS),
+                      default='scripted',
+                      help='random, scripted or search [default: %default]')
+    parser.add_option('--seconds', type='float', default=600.0,
+                      help='game time limit per game [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the first game [default: %default]')
+    parser.add_option('--workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='worker processes [default: %default]')
+    parser.add_option('--output', metavar='FILE',
+                      help='write every result here as a JSON line')
+    opts, args = parser.parse_args()
+
+    # the workers' games must be headless before they import dodo (and so
+    # pyglet); they inherit the environment
+    os.environ['DODOPULT_HEADLESS'] = '1'
+    tasks = [(params, opts.player, opts.seed + n, opts.seconds)
+             for params in sweep(opts.sweep) for n in range(opts.games)]
+    output = opts.output and open(opts.output, 'w')
+    summary = Summary()
+    pool = multiprocessing.Pool(opts.workers)
+    started = time.time()
+    try:
+        for done, result in enumerate(pool.imap_unordered(play, tasks, 4)):
+            summary.add(result)
+            if output:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+            if (done + 1) % 50 == 0:
+                elapsed = time.time() - started
+                sys.stderr.write('%d/%d games, %.0f s left\n' % (
+                    done + 1, len(tasks),
+                    elapsed / (done + 1) * (len(tasks) - done - 1)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print('interrupted; partial results:')
+    finally:
+        pool.join()
+        if output:
+            output.close()
+    for line in summary.report():
+        print(line)
+    print('%d games in %.1f s on %d workers' % (
+        sum(row['games'] for row in summary.rows.values()),
+        time.time() - started, opts.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""
+Draw call and overdraw diagnostics for Dodopult.
+
+`FrameProfiler` splits each frame into named layers and counts the draw
+calls, texture binds and vertices each layer sends to OpenGL.  The counts
+of the last frame are kept as plain numbers, so benchmarks can check them
+as well as people.  A timed profiler also measures how long each layer
+took the GPU to draw.
+
+It also records how long the garbage collections run by dodo.py's
+`GarbageCollector` took, per frame and per generation, and reports the
+texture memory counted by a `texturecache.TextureRegistry`.
+
+`OverdrawView` counts how many times each pixel was written during a
+frame in the stencil buffer, and replaces the frame with a heatmap of
+those counts.
+"""
+import sys
+import ctypes
+import timeit
+from contextlib import contextmanager
+
+from pyglet import gl
+
+
+class LayerStats(object):
+    """GL work done while drawing one layer."""
+
+    __slots__ = ('draw_calls', 'texture_binds', 'vertices')
+
+    def __init__(self):
+        self.draw_calls = 0
+        self.texture_binds = 0
+        self.vertices = 0
+
+    def add(self, other):
+        self.draw_calls += other.draw_calls
+        self.texture_binds += other.texture_binds
+        self.vertices += other.vertices
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return ('<LayerStats %d draw calls, %d texture binds, %d vertices>'
+                % (self.draw_calls, self.texture_binds, self.vertices))
+
+
+class GLCounter(object):
+    """Counts the GL calls made while it is installed into `stats`.
+
+    pyglet binds GL functions into its modules with ``from pyglet.gl import
+    *``, so install() replaces them in every loaded module that holds one,
+    which also counts the work done by pyglet's batches and sprites.
+    Functions linked at run time (like the instanced draw in renderer.py)
+    are passed to install() as (object, attribute name) pairs.
+    """
+
+    def __init__(self):
+        self.stats = LayerStats()
+        self._patched = []
+
+    def draw(self, vertices):
+        self.stats.draw_calls += 1
+        self.stats.vertices += vertices
+
+    def bind(self):
+        self.stats.texture_binds += 1
+
+    def _wrappers(self):
+        def draw_arrays(original):
+            def glDrawArrays(mode, first, count):
+                self.draw(count)
+                return original(mode, first, count)
+            return glDrawArrays
+
+        def draw_elements(original):
+            def glDrawElements(mode, count, type, indices):
+                self.draw(count)
+                return original(mode, count, type, indices)
+            return glDrawElements
+
+        def multi_draw_arrays(original):
+            def glMultiDrawArrays(mode, first, count, primcount):
+                self.draw(sum(count[i] for i in range(primcount)))
+                return original(mode, first, count, primcount)
+            return glMultiDrawArrays
+
+        def multi_draw_elements(original):
+            def glMultiDrawElements(mode, count, type, indices, primcount):
+                self.draw(sum(count[i] for i in range(primcount)))
+                return original(mode, count, type, indices, primcount)
+            return glMultiDrawElements
+
+        def begin(original):
+            def glBegin(mode):
+                self.draw(0) # immediate mode vertices aren't counted
+                return original(mode)
+            return glBegin
+
+        def bind_texture(original):
+            def glBindTexture(target, texture):
+                self.bind()
+                return original(target, texture)
+            return glBindTexture
+
+        return [('glDrawArrays', draw_arrays),
+                ('glDrawElements', draw_elements),
+                ('glMultiDrawArrays', multi_draw_arrays),
+                ('glMultiDrawElements', multi_draw_elements),
+                ('glBegin', begin),
+                ('glBindTexture', bind_texture)]
+
+    def _draw_instanced(self, original):
+        def draw_instanced(mode, first, count, primcount):
+            self.draw(count * primcount)
+            return original(mode, first, count, primcount)
+        return draw_instanced
+
+    def install(self, instanced=()):
+        if self._patched:
+            return
+        for name, wrap in self._wrappers():
+            original = getattr(gl, name, None)
+            if original is None:
+                continue
+            wrapper = wrap(original)
+            for module in list(sys.modules.values()):
+                if getattr(module, '__dict__', {}).get(name) is original:
+                    setattr(module, name, wrapper)
+                    self._patched.append((module, name, original))
+        for obj, name in instanced:
+            original = getattr(obj, name)
+            setattr(obj, name, self._draw_instanced(original))
+            self._patched.append((obj, name, original))
+
+    def uninstall(self):
+        for obj, name, original in reversed(self._patched):
+            setattr(obj, name, original)
+        self._patched = []
+
+    @property
+    def installed(self):
+        return bool(self._patched)
+
+
+class FrameProfiler(object):
+    """Counts the GL work of each layer of a frame.
+
+    Wrap the drawing of each layer in ``with profiler.layer(name):``;
+    whatever is drawn outside any layer counts as 'other'.  After
+    end_frame(), ``frame`` maps layer names to `LayerStats` for that frame
+    and ``order`` lists the names in the order they were first drawn.
+
+    If ``timed`` is true, ``times`` maps layer names to the seconds spent
+    drawing them.  Each layer waits for the GPU to finish before and after
+    (which makes frames slower, so it's for benchmarks); a layer's time
+    includes the layers drawn inside it.
+
+    If ``textures`` is set to a `texturecache.TextureRegistry`, the report
+    includes its texture memory per layer.
+    """
+
+    textures = None
+
+    def __init__(self, timed=False):
+        self.counter = GLCounter()
+        self.timed = timed
+        self.frame = {}
+        self.order = []
+        self.times = {}
+        self.overdraw = None
+        self.gc_pauses = []
+        self.gc_totals = {} # generation -> [collections, seconds, worst]
+        self._frame = {}
+        self._order = []
+        self._times = {}
+        self._gc_pauses = []
+
+    def _layer(self, name):
+        stats = self._frame.get(name)
+        if stats is None:
+            stats = self._frame[name] = LayerStats()
+            self._order.append(name)
+        return stats
+
+    def begin_frame(self):
+        self._frame = {}
+        self._order = []
+        self._times = {}
+        self._gc_pauses = []
+        self.counter.stats = self._layer('other')
+
+    @contextmanager
+    def layer(self, name):
+        outer = self.counter.stats
+        self.counter.stats = self._layer(name)
+        if self.timed:
+            gl.glFinish()
+            started = timeit.default_timer()
+        try:
+            yield
+        finally:
+            if self.timed:
+                gl.glFinish()
+                self._times[name] = (self._times.get(name, 0.0) +
+                                     timeit.default_timer() - started)
+            self.counter.stats = outer
+
+    def add_gc_pause(self, generation, seconds):
+        self._gc_pauses.append((generation, seconds))
+        totals = self.gc_totals.setdefault(generation, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+
+    def end_frame(self):
+        self.frame, self.order = self._frame, self._order
+        self.times = self._times
+        self.gc_pauses = self._gc_pauses
+        self.counter.stats = LayerStats() # not part of any frame
+
+    def totals(self):
+        total = LayerStats()
+        for stats in self.frame.values():
+            total.add(stats)
+        return total
+
+    def report(self):
+        """Return the last frame's numbers as lines of text."""
+        lines = ['%-10s %6s %6s %8s' % ('layer', 'draws', 'binds', 'verts')]
+        if self.timed:
+            lines[0] += ' %7s' % 'ms'
+        rows = [(name, self.frame[name]) for name in self.order]
+        rows.append(('total', self.totals()))
+        for name, stats in rows:
+            line = '%-10s %6d %6d %8d' % (name, stats.draw_calls,
+                                          stats.texture_binds, stats.vertices)
+            if self.timed and name in self.times:
+                line += ' %7.2f' % (self.times[name] * 1000)
+            lines.append(line)
+        if self.overdraw is not None:
+            lines.append('overdraw   %.2f avg, %d%% >= %d' % (
+                self.overdraw.mean, self.overdraw.high * 100,
+                OverdrawView.max_level))
+        for generation in sorted(self.gc_totals):
+            count, total, worst = self.gc_totals[generation]
+            lines.append('gc gen %d   %d runs, %.1f ms avg, %.1f ms worst' % (
+                generation, count, total * 1000 / count, worst * 1000))
+        if self.textures is not None:
+            lines.extend(self.textures.report())
+        return lines
+
+
+class _NullLayer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullProfiler(object):
+    """Stands in for a `FrameProfiler` when diagnostics are off."""
+
+    _layer = _NullLayer()
+
+    def layer(self, name):
+        return self._layer
+
+    def begin_frame(self):
+        pass
+
+    def add_gc_pause(self, generation, seconds):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class OverdrawStats(object):
+    """How many pixels were written how many times in one frame."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram # histogram[n] = pixels written n times
+        pixels = sum(histogram) or 1
+        self.mean = sum(n * count for n, count in enumerate(histogram)) / float(pixels)
+        self.high = histogram[-1] / float(pixels)
+
+
+class OverdrawView(object):
+    """Heatmap of how many times each pixel was written during a frame.
+
+    Between begin() and end() every fragment increments the stencil buffer,
+    whether or not it is transparent, because the GPU pays for it either
+    way.  Drawing into framebuffer objects (the game over snapshot and
+    RENDER_SCALE) isn't counted.  Needs a window with a stencil buffer.
+    """
+
+    max_level = 8
+
+    # 0 writes is black, then blue, cyan, green, yellow, ... to white
+    colors = [(0, 0, 0), (0, 0, 160), (0, 120, 255), (0, 200, 120),
+              (120, 230, 0), (255, 230, 0), (255, 140, 0), (255, 40, 0),
+              (255, 255, 255)]
+
+    @staticmethod
+    def is_supported():
+        bits = gl.GLint()
+        gl.glGetIntegerv(gl.GL_STENCIL_BITS, ctypes.byref(bits))
+        return bits.value >= 8
+
+    def begin(self):
+        gl.glClearStencil(0)
+        gl.glClear(gl.GL_STENCIL_BUFFER_BIT)
+        gl.glEnable(gl.GL_STENCIL_TEST)
+        gl.glStencilFunc(gl.GL_ALWAYS, 0, 0xff)
+        gl.glStencilOp(gl.GL_KEEP, gl.GL_INCR, gl.GL_INCR)
+
+    def end(self):
+        gl.glDisable(gl.GL_STENCIL_TEST)
+
+    def read(self, width, height):
+        """Return `OverdrawStats` for the frame drawn since begin()."""
+        size = width * height
+        data = (gl.GLubyte * size)()
+        gl.glPushClientAttrib(gl.GL_CLIENT_PIXEL_STORE_BIT)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(0, 0, width, height, gl.GL_STENCIL_INDEX,
+                        gl.GL_UNSIGNED_BYTE, data)
+        gl.glPopClientAttrib()
+        data = ctypes.string_at(data, size)
+        histogram = [data.count(chr(n)) for n in range(self.max_level)]
+        histogram.append(size - sum(histogram))
+        return OverdrawStats(histogram)
+
+    def draw(self, width, height):
+        """Cover the window with the heatmap."""
+        gl.glPushAttrib(gl.GL_ENABLE_BIT | gl.GL_STENCIL_BUFFER_BIT |
+                        gl.GL_CURRENT_BIT)
+        gl.glDisable(gl.GL_TEXTURE_2D)
+        gl.glDisable(gl.GL_BLEND)
+        gl.glEnable(gl.GL_STENCIL_TEST)
+        gl.glStencilOp(gl.GL_KEEP, gl.GL_KEEP, gl.GL_KEEP)
+        for level, (r, g, b) in enumerate(self.colors):
+            if level < self.max_level:
+                gl.glStencilFunc(gl.GL_EQUAL, level, 0xff)
+            else:
+                gl.glStencilFunc(gl.GL_LEQUAL, level, 0xff)
+            gl.glColor3ub(r, g, b)
+            gl.glRectf(0, 0, width, height)
+        gl.glPopAttrib()
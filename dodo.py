@@ -1,19 +1,110 @@
 #!/usr/bin/env python
+import gc
 import math
 import os.path
+import time
 import random
+import threading
 import logging
 import itertools
+import collections
+from array import array
 from contextlib import contextmanager
 
 import pyglet
+
+# Run games without a window, textures or sound (servers, bots, batch
+# runs); pyglet has to know before it creates its shadow window
+HEADLESS = bool(os.environ.get('DODOPULT_HEADLESS'))
+if HEADLESS:
+    pyglet.options['shadow_window'] = False
+    pyglet.options['audio'] = ('silent', )
+
 from pyglet.window import key
 from pyglet import gl
 
+import renderer
+import assetpack
+import diagnostics
+import savestate
+import telemetry
+import texturecache
+from particles import ParticleKind, ParticleSystem
+
 
 DEBUG_VERSION = False
 DEBUG_EVENTS = False
 
+# Draw terrain, clouds, dodos and waves with one instanced call per layer
+# (needs GL_ARB_draw_instanced and GL_ARB_instanced_arrays; falls back to
+# the sprite batches if the driver lacks them)
+INSTANCED_RENDERER = False
+
+# Only redraw when something on screen changed, and tick the clock less
+# often while the game is idle (help screen, finished game over screen)
+EVENT_DRIVEN_REDRAW = False
+
+# Drop sea bands, clouds, the sky and the FPS display when frames take too
+# long, and bring them back when there is time to spare
+ADAPTIVE_QUALITY = False
+
+# Pre-render terrain and clouds into textures for the game over zoom-out
+# instead of drawing 25 screens worth of sprites every frame
+GAME_OVER_SNAPSHOT = False
+
+# Run the game clock (physics, sea, camera) on a worker thread and let the
+# renderer interpolate between the two most recent simulation steps
+THREADED_SIMULATION = False
+
+# Most feathers, splashes and dust particles alive at once (0 turns them off)
+PARTICLE_BUDGET = 400
+
+# Draw the game at this fraction of the window resolution and stretch it
+# to fit, to save fill rate on large screens (needs framebuffer objects)
+RENDER_SCALE = 1.0
+# Keep the power bar, help screen and FPS display sharp when RENDER_SCALE
+# is below 1 by drawing them at the window resolution
+NATIVE_HUD = True
+
+# Start with the draw call counters shown (F3 cycles between off, counters,
+# and counters with the overdraw heatmap; the heatmap needs a stencil buffer)
+DIAGNOSTICS = False
+
+# Put every layer into one batch with ordered groups that apply the camera
+# and parallax transforms, instead of drawing layer by layer (takes the
+# place of INSTANCED_RENDERER and GAME_OVER_SNAPSHOT)
+BATCHED_SCENE = False
+
+# Switch off automatic garbage collection once a game is set up and collect
+# between frames instead; full collections only run on idle screens
+MANUAL_GC = False
+
+# Keep snapshots of the last ten seconds: Backspace rewinds a second, F5
+# saves the game and F9 loads it again
+SAVE_STATES = False
+SAVE_FILE = os.path.expanduser('~/.dodopult.sav')
+
+# Watch assets/map.txt and apply changes to the running game, rebuilding
+# only the tiles and levels that changed (for editing levels)
+MAP_HOT_RELOAD = False
+
+# Append frame time histograms, late simulation ticks and load times to a
+# local file; summarize them with telemetry.py
+TELEMETRY = False
+TELEMETRY_FILE = os.path.expanduser('~/.dodopult-telemetry.jsonl')
+
+# Step the game in fixed ticks driven by frame times measured at buffer
+# flips and snapped to the display's refresh interval, to even out jitter
+# (takes the place of THREADED_SIMULATION and EVENT_DRIVEN_REDRAW)
+FRAME_PACING = False
+# Draw paced games blended between their last two ticks
+PACED_INTERPOLATION = True
+
+# Most texture memory to keep on the GPU, in megabytes: textures that
+# haven't been drawn for a while are dropped and loaded again when needed
+# (None keeps everything; F3 shows the memory used either way)
+TEXTURE_BUDGET = None
+
 
 log = logging.getLogger('dodo')
 
@@ -25,17 +116,66 @@ if DEBUG_VERSION:
 pyglet.resource.path = ['assets']
 pyglet.resource.reindex()
 
+# Distribution builds ship the assets packed by assetpack.py
+ASSET_ARCHIVE = 'assets.pak'
+
+resources = pyglet.resource
+if os.path.exists(os.path.join(pyglet.resource.get_script_home(),
+                               ASSET_ARCHIVE)):
+    resources = assetpack.open_archive(
+        os.path.join(pyglet.resource.get_script_home(), ASSET_ARCHIVE))
+
 
 window = None
 
 
-def load_image(filename, **kw):
-    img = pyglet.resource.image(filename)
+class HeadlessImage(object):
+    """Stands in for an image in headless games, which never draw."""
+
+    width = height = 0
+
+    def __init__(self, filename, **kw):
+        self.filename = filename
+        self.__dict__.update(kw)
+
+
+class HeadlessSprite(object):
+    """Stands in for a sprite in headless games."""
+
+    visible = False
+
+
+class HeadlessWindow(object):
+    """The screen size headless games pretend to have (for the camera)."""
+
+    width = 1024
+    height = 600
+
+
+def load_image(filename, layer='other', **kw):
+    """Load an image drawn by ``layer`` (for the texture accounting)."""
+    if HEADLESS:
+        return HeadlessImage(filename, **kw)
+    img = resources.image(filename)
     for k, v in kw.items():
         setattr(img, k, v)
+    texture_registry.register(filename, img, layer)
     return img
 
 
+def load_image_data(filename):
+    if resources is pyglet.resource:
+        return pyglet.image.load(
+            os.path.join(resources.location(filename).path, filename))
+    return resources.image_data(filename)
+
+
+texture_registry = texturecache.TextureRegistry(
+    load_image_data,
+    TEXTURE_BUDGET is not None and TEXTURE_BUDGET * texturecache.MEGABYTE
+    or None)
+
+
 @contextmanager
 def gl_matrix():
     gl.glPushMatrix()
@@ -54,91 +194,463 @@ def gl_state(bits=gl.GL_ALL_ATTRIB_BITS):
         gl.glPopAttrib()
 
 
+def release_player(player):
+    """Stop a sound player and drop its queue.
+
+    A playing player keeps itself scheduled on pyglet's clock, so one
+    that is merely forgotten goes on playing (and looping, for the sea).
+    """
+    if player is None:
+        return
+    player.pause()
+    while player.source is not None:
+        player.next()
+
+
+def flight_step(dx, dy, dt, gravity, air_resistance):
+    """Move a dodo flying at (dx, dy) for dt seconds.
+
+    Returns how far it moved and its new speed, as (dx, dy, new dx, new
+    dy).  Gravity pulls down at a constant rate and the air slows the dodo
+    down sideways by a constant fraction per second; both have exact
+    solutions, so a flight follows the same curve whatever the tick rate.
+    """
+    keep = math.exp(-air_resistance * dt)
+    if air_resistance:
+        move_x = dx * (1 - keep) / air_resistance
+    else:
+        move_x = dx * dt
+    move_y = (dy - gravity * dt / 2) * dt
+    return move_x, move_y, dx * keep, dy - gravity * dt
+
+
+class Flock(object):
+    """Numeric state of a game's dodos, kept in one array slot per dodo.
+
+    Only dodos in flight need updating, so the flock tracks which ones
+    are flying and updates just those.  Sprite positions are copied from
+    the arrays once per frame, for the dodos that moved.
+
+    Only dodos in the camera's view have sprites.  The flock files its
+    dodos by columns of the world, as the SpriteAnimator does, so that
+    show_sprites_in() only looks at the dodos near the view.
+    """
+
+    column_width = 512 # pixels of the world
+
+    def __init__(self, game):
+        self.game = game
+        self.members = []
+        self.x = array('d')
+        self.y = array('d')
+        self.dx = array('d')
+        self.dy = array('d')
+        self.alive = array('b')
+        self.flying = set()
+        self.moved = set()
+        self.gone = set() # drowned or otherwise off the screen for good
+        self.columns = {} # column -> set of indices
+        self.column_of = array('i') # -1 until filed
+        self.shown = set() # dodos with sprites
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, dodo):
+        """Allocate a slot for ``dodo`` and return its index."""
+        self.members.append(dodo)
+        for column in self.x, self.y, self.dx, self.dy:
+            column.append(0.0)
+        self.alive.append(True)
+        self.column_of.append(-1)
+        index = len(self.members) - 1
+        self.moved.add(index)
+        return index
+
+    def truncate(self, size):
+        """Forget the dodos after the first ``size``."""
+        for dodo in self.members[size:]:
+            dodo.detach_sprite()
+            self.columns.get(self.column_of[dodo.index], set()).discard(
+                dodo.index)
+        del self.members[size:]
+        for column in (self.x, self.y, self.dx, self.dy, self.alive,
+                       self.column_of):
+            del column[size:]
+        self.flying = set(i for i in self.flying if i < size)
+        self.moved = set(i for i in self.moved if i < size)
+        self.gone = set(i for i in self.gone if i < size)
+
+    def update(self, dt):
+        members = self.members
+        for index in list(self.flying):
+            members[index].update(dt)
+
+    def file(self, index, x):
+        """Put a dodo that moved to ``x`` in the right column."""
+        column = int(x // self.column_width)
+        filed = self.column_of[index]
+        if column != filed:
+            if filed != -1:
+                self.columns[filed].discard(index)
+            self.columns.setdefault(column, set()).add(index)
+            self.column_of[index] = column
+
+    def show_sprites_in(self, left, bottom, right, top):
+        """Give sprites to the dodos inside the rectangle, and take them
+        from the ones that left it."""
+        members, y, gone = self.members, self.y, self.gone
+        width = self.column_width
+        wanted = set()
+        for column in range(int(left // width), int(right // width) + 1):
+            for index in self.columns.get(column, ()):
+                if index not in gone and bottom <= y[index] <= top:
+                    wanted.add(index)
+        for index in self.shown - wanted:
+            members[index]._detach_sprite()
+        for index in wanted - self.shown:
+            members[index]._attach_sprite()
+
+    def sync_sprites(self):
+        members = self.members
+        x, y = self.x, self.y
+        for index in self.moved:
+            self.file(index, x[index])
+            sprite = members[index].sprite
+            if sprite is not None:
+                sprite.set_position(x[index], y[index])
+        self.moved.clear()
+
+    def sync_sprites_between(self, previous, latest, alpha, moved):
+        """Place sprites between two captured WorldFrames.
+
+        Dodos in flight are interpolated; other dodos that moved since the
+        last call are put where the latest frame has them.
+        """
+        members = self.members
+        beta = 1 - alpha
+        px, py, x, y = previous.x, previous.y, latest.x, latest.y
+        for index in moved.union(latest.flying):
+            if index >= len(x) or index >= len(members):
+                if index < len(members):
+                    self.file(index, self.x[index]) # newer than the frame
+                continue
+            self.file(index, x[index])
+            sprite = members[index].sprite
+            if sprite is None:
+                continue
+            if index in latest.flying and index < len(px):
+                sprite.set_position(px[index] * beta + x[index] * alpha,
+                                    py[index] * beta + y[index] * alpha)
+            else:
+                sprite.set_position(x[index], y[index])
+
+
+class SpriteAnimator(object):
+    """Plays the animations of many sprites from one clock.
+
+    pyglet gives every sprite showing an Animation its own timer, which
+    keeps running wherever the sprite is.  Sprites handed to add() show
+    still frames instead, and update() works out which frame each sprite
+    in view should be showing by now, from when its animation started, so
+    a sprite that comes back into view is straight away where it would
+    have been.  Sprites are filed in columns by their x, so an update only
+    looks at the columns in view.  `time` is the clock, a function.
+    """
+
+    column_width = 512
+
+    def __init__(self, time=time.time):
+        self.time = time
+        self.columns = {} # column -> {sprite: (animation, start)}
+        self.where = {} # sprite -> column
+        self.timelines = {} # animation -> (total duration, frame ends)
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, sprite, animation, x):
+        """Start playing ``animation`` on a sprite standing at ``x``."""
+        self.remove(sprite)
+        column = int(x // self.column_width)
+        self.columns.setdefault(column, {})[sprite] = (animation, self.time())
+        self.where[sprite] = column
+        sprite.image = animation.frames[0].image
+
+    def remove(self, sprite):
+        column = self.where.pop(sprite, None)
+        if column is not None:
+            del self.columns[column][sprite]
+
+    def frame_at(self, animation, elapsed):
+        timeline = self.timelines.get(animation)
+        if timeline is None:
+            ends = []
+            total = 0.0
+            for frame in animation.frames:
+                total += frame.duration or 0.0
+                ends.append(total)
+            timeline = self.timelines[animation] = (total, ends)
+        total, ends = timeline
+        frames = animation.frames
+        if total and frames[-1].duration is not None: # it loops
+            elapsed %= total
+        for frame, end in zip(frames, ends):
+            if elapsed < end:
+                return frame.image
+        return frames[-1].image
+
+    def update(self, left, bottom, right, top):
+        """Bring the sprites inside the rectangle up to date."""
+        now = self.time()
+        width = self.column_width
+        for column in range(int(left // width), int(right // width) + 1):
+            sprites = self.columns.get(column)
+            if not sprites:
+                continue
+            for sprite, (animation, start) in sprites.items():
+                if not bottom <= sprite.y <= top:
+                    continue
+                image = self.frame_at(animation, now - start)
+                if sprite.image is not image:
+                    sprite.image = image
+
+
 class Dodo(object):
 
-    ready_image = load_image('Dodo_ready_for_launch.png')
+    __slots__ = ('flock', 'index', 'standing_image', 'sprite', 'player')
+
+    ready_image = load_image('Dodo_ready_for_launch.png', 'dodos')
     ready_image.anchor_x = 17
     ready_image.anchor_y = 13
 
-    dead_image = load_image('Dodo_broken.png')
+    dead_image = load_image('Dodo_broken.png', 'dodos')
     dead_image.anchor_x = -10
 
     SPRITE_SCALE = 0.7
 
-    def __init__(self, game):
+    # standing animations are shared between all dodos; each dodo picks one
+    # of this many blinking speeds for each direction it can face
+    ANIMATION_VARIANTS = 8
+    _standing_images = None
+
+    @classmethod
+    def standing_images(cls):
+        if cls._standing_images is None:
+            frames = [[load_image('Dodo.png', 'dodos', anchor_y=12),
+                       load_image('Dodo2.png', 'dodos', anchor_y=12)],
+                      [load_image('Dodo_flipped.png', 'dodos', anchor_y=12),
+                       load_image('Dodo_flipped2.png', 'dodos', anchor_y=12)]]
+            n = cls.ANIMATION_VARIANTS
+            cls._standing_images = [
+                pyglet.image.Animation.from_image_sequence(
+                    images, 0.5 + 1.5 * i / (n - 1))
+                for images in frames for i in range(n)]
+        return cls._standing_images
+
+    def __init__(self, game, flock=None):
+        if flock is None:
+            flock = Flock(game)
+        self.flock = flock
+        self.index = flock.add(self)
+        self.standing_image = random.choice(self.standing_images())
+        self.sprite = None # while in view; see Flock.show_sprites_in()
+        self.player = None
 
-        self.standing_images = [
-            pyglet.image.Animation.from_image_sequence([
-                    load_image('Dodo.png', anchor_y=12),
-                    load_image('Dodo2.png', anchor_y=12),
-                    ], random.uniform(0.5, 2)),
-            pyglet.image.Animation.from_image_sequence([
-                    load_image('Dodo_flipped.png', anchor_y=12),
-                    load_image('Dodo_flipped2.png', anchor_y=12),
-                    ], random.uniform(0.5, 2)),
-        ]
+    @property
+    def game(self):
+        return self.flock.game
 
-        self.game = game
-        self.standing_image = random.choice(self.standing_images)
-        self.standing_image.rotation = 0.2
-        self.sprite = pyglet.sprite.Sprite(self.standing_image,
-                                           batch=game.dodo_batch)
-        self.sprite.scale = self.SPRITE_SCALE
-        self.dx = 0
-        self.dy = 0
-        self.is_alive = True
-        self.player = pyglet.media.Player()
+    @property
+    def look(self):
+        """How the dodo looks, as one of the looks in savestate."""
+        game = self.game
+        if self is game.bunny:
+            return savestate.ENDING
+        if self.index in self.flock.gone:
+            return savestate.GONE
+        if not self.is_alive:
+            return savestate.DEAD
+        if self is game.dodopult.payload or self.in_flight:
+            return savestate.READY
+        return savestate.STANDING
+
+    def appearance(self):
+        """Return the image and scale to draw the dodo with, or (None,
+        None) if it is gone."""
+        look = self.look
+        if look == savestate.GONE:
+            return None, None
+        if look == savestate.ENDING:
+            return self.game.ending_image, 1.0
+        image = {savestate.STANDING: self.standing_image,
+                 savestate.READY: self.ready_image,
+                 savestate.DEAD: self.dead_image}[look]
+        return image, self.SPRITE_SCALE
+
+    def refresh(self):
+        """Make the dodo's sprite match its look (after a change to it)."""
+        self.game.defer(self._refresh)
+
+    def _refresh(self):
+        if self.sprite is None:
+            return # it gets the right look when it comes into view
+        image, scale = self.appearance()
+        if image is None:
+            self._detach_sprite()
+            return
+        self.sprite.scale = scale
+        self._show(image)
+
+    def _attach_sprite(self):
+        image, scale = self.appearance()
+        if image is None or self.game.dodo_batch is None:
+            return
+        self._detach_sprite()
+        still = image
+        if isinstance(image, pyglet.image.Animation):
+            still = image.frames[0].image # the animator takes over
+        self.sprite = pyglet.sprite.Sprite(still,
+                                           batch=self.game.dodo_batch,
+                                           group=self.game.dodo_group)
+        self.sprite.scale = scale
+        self.sprite.set_position(self.x, self.y)
+        self._show(image)
+        self.flock.shown.add(self.index)
+
+    def detach_sprite(self):
+        self.game.defer(self._detach_sprite)
+
+    def _detach_sprite(self):
+        if self.sprite is not None:
+            self.game.animator.remove(self.sprite)
+            self.sprite.delete()
+            self.sprite = None
+            self.flock.shown.discard(self.index)
+
+    def _show(self, image):
+        animator = self.game.animator
+        if isinstance(image, pyglet.image.Animation):
+            animator.add(self.sprite, image, self.x)
+        else:
+            animator.remove(self.sprite)
+            self.sprite.image = image
 
     def draw(self):
-        self.sprite.draw()
+        if self.sprite is not None:
+            self.sprite.draw()
 
     @property
     def in_flight(self):
-        return self.dx != 0 or self.dy != 0
+        return self.index in self.flock.flying
 
     @property
     def x(self):
-        return self.sprite.x
+        return self.flock.x[self.index]
 
     @x.setter
     def x(self, x):
-        self.sprite.x = x
+        self.flock.x[self.index] = x
+        self.flock.moved.add(self.index)
 
     @property
     def y(self):
-        return self.sprite.y
+        return self.flock.y[self.index]
 
     @y.setter
     def y(self, y):
-        self.sprite.y = y
+        self.flock.y[self.index] = y
+        self.flock.moved.add(self.index)
+
+    @property
+    def dx(self):
+        return self.flock.dx[self.index]
+
+    @dx.setter
+    def dx(self, dx):
+        self.flock.dx[self.index] = dx
+        self._update_flying()
+
+    @property
+    def dy(self):
+        return self.flock.dy[self.index]
+
+    @dy.setter
+    def dy(self, dy):
+        self.flock.dy[self.index] = dy
+        self._update_flying()
+
+    def _update_flying(self):
+        flock, index = self.flock, self.index
+        if flock.dx[index] or flock.dy[index]:
+            flock.flying.add(index)
+        else:
+            flock.flying.discard(index)
+
+    @property
+    def is_alive(self):
+        return bool(self.flock.alive[self.index])
+
+    @is_alive.setter
+    def is_alive(self, alive):
+        self.flock.alive[self.index] = alive
 
     def launch(self, dx, dy):
         self.dx = dx
         self.dy = dy
         self.game.camera.focus_on(self)
 
+    def vanish(self):
+        """Take the dodo off the screen for good."""
+        self.flock.gone.add(self.index)
+        self.refresh()
+
     def drown(self):
-        self.sprite.visible = False # sank below the water, so there!
+        self.vanish() # sank below the water, so there!
         self.is_alive = False
         self.game.camera.remove_focus(self)
+        self.game.emit_particles('splash', self.x + 10, self.game.sea.level, 12)
 
     def go_extinct(self):
-        self.sprite.image = self.dead_image
         self.is_alive = False
+        self.refresh()
         self.game.camera.remove_focus(self)
-        self.player.queue(pyglet.resource.media('dodo_splat.wav', streaming=False))
+        self.game.emit_particles('feathers', self.x + 15, self.y + 10, 16,
+                                 velocity=(self.dx * 0.2, 0))
+        if not self.game.headless:
+            self.game.defer(self._splat)
+
+    def _splat(self):
+        if self.player is None:
+            self.player = pyglet.media.Player()
+        self.player.queue(resources.media('dodo_splat.wav', streaming=False))
         self.player.seek(0.3)
         self.player.play()
 
+    def reset(self):
+        """Stand the dodo up again, alive, for the flock's new game."""
+        self.dx = self.dy = 0
+        self.is_alive = True
+        self.flock.gone.discard(self.index)
+        self.game.defer(self._reset_sprite)
+
+    def _reset_sprite(self):
+        if self.sprite is not None:
+            self.sprite.batch = self.game.dodo_batch
+            self.sprite.group = self.game.dodo_group
+            self.sprite.set_position(self.x, self.y)
+        self._refresh()
+
     def survive(self):
-        if self.is_alive:
-            self.sprite.image = self.standing_image
+        self.refresh()
         self.game.camera.remove_focus(self)
 
     def update(self, dt):
         dt = dt * 3
         if self.dx or self.dy:
-            dx, dy = self.dx * dt, self.dy * dt
+            dx, dy, new_dx, new_dy = flight_step(self.dx, self.dy, dt,
+                                                 self.game.gravity,
+                                                 self.game.air_resistance)
             self.x += dx
             self.y += dy
             ground_level = self.game.game_map.ground_level(self.x)
@@ -180,15 +692,15 @@ class Dodo(object):
                     self.x = x2
                     self.y = y2
                     self.go_extinct()
+                    self.dx = self.dy = 0
                 else:
                     self.x = x1
                     self.y = y1
+                    self.dx = self.dy = 0 # landed, so no longer in flight
                     self.survive()
-                self.dx = self.dy = 0
-                pyglet.clock.schedule_once(self.game.count_surviving_dodos, 3.0)
+                self.game.clock.schedule_once(self.game.count_surviving_dodos, 3.0)
             else:
-                self.dy -= self.game.gravity * dt
-                self.dx *= (1 - self.game.air_resistance)
+                self.dx, self.dy = new_dx, new_dy
 
 
 class PowerBar(object):
@@ -200,13 +712,16 @@ class PowerBar(object):
 
         self.textures = pyglet.image.TextureGrid(
                             pyglet.image.ImageGrid(
-                                load_image('power_bar.png'),
+                                load_image('power_bar.png', 'hud'),
                                 self.steps, 1))
         self.power_bar = pyglet.sprite.Sprite(self.textures[0], 20, 20)
 
-    def draw(self):
-        if not self.dodopult.payload:
-            return
+    def update_sprite(self):
+        """Point the power bar sprite at the payload; False if there's none."""
+        payload = self.dodopult.payload
+        self.power_bar.visible = bool(payload)
+        if not payload:
+            return False
 
         range = float(self.dodopult.max_power - self.dodopult.min_power)
         power = (self.dodopult.power - self.dodopult.min_power) / range
@@ -214,23 +729,27 @@ class PowerBar(object):
         self.power_bar.image = self.textures[n]
         self.power_bar.rotation = -self.dodopult.aim_angle
 
-        x = self.dodopult.payload.x + 5
-        y = self.dodopult.payload.y
+        x = payload.x + 5
+        y = payload.y
         dx, dy = self.dodopult.aim_vector(self.dodopult.AIM_R)
         self.power_bar.set_position(x + dx, y + dy)
-        self.power_bar.draw()
+        return True
+
+    def draw(self):
+        if self.update_sprite():
+            self.power_bar.draw()
 
 
 class Dodopult(object):
 
-    armed_sprite = loaded_sprite = load_image('Catapult_1.png')
+    armed_sprite = loaded_sprite = load_image('Catapult_1.png', 'dodopult')
 
-    unarmed_sprite = load_image('Catapult_5.png')
+    unarmed_sprite = load_image('Catapult_5.png', 'dodopult')
 
     arming_sprites = [unarmed_sprite,
-                      load_image('Catapult_4.png'),
-                      load_image('Catapult_3.png'),
-                      load_image('Catapult_2.png')]
+                      load_image('Catapult_4.png', 'dodopult'),
+                      load_image('Catapult_3.png', 'dodopult'),
+                      load_image('Catapult_2.png', 'dodopult')]
 
     reload_delay = 0.75 # animation duration, seconds
 
@@ -261,37 +780,53 @@ class Dodopult(object):
 
     def __init__(self, game):
         self.game = game
-        self.sprite = pyglet.sprite.Sprite(self.armed_sprite)
-        self.sprite.scale = self.SPRITE_SCALE
+        self.sprite = self.player = None
+        if not game.headless:
+            self.sprite = pyglet.sprite.Sprite(self.armed_sprite)
+            self.sprite.scale = self.SPRITE_SCALE
+            self.player = pyglet.media.Player()
+        self._x = 0
+        self._y = self.VERT_ADJUST
         self.payload = None
         self.armed = True
         self.time_loading = 0
         self.power = self.min_power
         self.powering_up = False
-        self.player = pyglet.media.Player()
 
     @property
     def x(self):
-        return self.sprite.x
+        return self._x
 
     @x.setter
     def x(self, x):
-        self.sprite.x = x
+        self._x = x
         if self.payload:
             self.payload.x = x + self.PAYLOAD_POS[0]
 
     @property
     def y(self):
-        return self.sprite.y + self.VERT_ADJUST
+        return self._y
 
     @y.setter
     def y(self, y):
-        self.sprite.y = y - self.VERT_ADJUST
+        self._y = y
         if self.payload:
             self.payload.y = y + self.PAYLOAD_POS[1] - self.VERT_ADJUST
 
     def set_sprite(self, sprite):
-        self.sprite.image = sprite
+        if self.sprite is not None:
+            self.game.defer(setattr, self.sprite, 'image', sprite)
+
+    def play_sound(self, name, restart=False):
+        if self.player is not None:
+            self.game.defer(self._play_sound, name, restart)
+
+    def _play_sound(self, name, restart):
+        if restart:
+            self.player.next()
+            self.player = pyglet.media.Player()
+        self.player.queue(resources.media(name, streaming=False))
+        self.player.play()
 
     def update(self, dt):
         if self.powering_up:
@@ -312,10 +847,9 @@ class Dodopult(object):
                 self.payload.x = self.x + self.LAUNCH_POS[0]
                 self.payload.y = self.y + self.LAUNCH_POS[1]
                 self.payload.launch(*self.aim_vector(self.power))
-            self.player.next()
-            self.player = pyglet.media.Player()
-            self.player.queue(pyglet.resource.media('catapult_fire.wav', streaming=False))
-            self.player.play()
+            self.game.emit_particles('dust', self.x, self.y - self.VERT_ADJUST,
+                                     10, direction=180 - self.aim_angle)
+            self.play_sound('catapult_fire.wav', restart=True)
             self.power = self.min_power
             self.powering_up = False
             self.armed = False
@@ -325,10 +859,15 @@ class Dodopult(object):
     def start_powering_up(self):
         if self.armed:
             self.powering_up = True
-            self.player.queue(pyglet.resource.media('power_up.wav', streaming=False))
-            self.player.play()
+            self.play_sound('power_up.wav')
+
+    def place_sprite(self):
+        view = self.game.view
+        self.sprite.set_position(view.dodopult_x,
+                                 view.dodopult_y - self.VERT_ADJUST)
 
     def draw(self):
+        self.place_sprite()
         self.sprite.draw()
 
     def move_left(self):
@@ -353,15 +892,16 @@ class Dodopult(object):
         if self.payload:
             # let's unload
             if self.x >= self.game.current_level.left:
-                self.payload.y -= self.PAYLOAD_POS[1]
-                self.payload = None
+                dodo, self.payload = self.payload, None
+                dodo.y -= self.PAYLOAD_POS[1]
+                dodo.refresh()
                 self.set_sprite(self.armed_sprite)
             return
         for dodo in self.game.dodos:
             if (self.x + self.PICKUP_RANGE[0] <= dodo.x <= self.x + self.PICKUP_RANGE[1]
                 and not dodo.in_flight and dodo.is_alive):
                 self.payload = dodo
-                dodo.sprite.image = dodo.ready_image
+                dodo.refresh()
                 self.x = self.x # trigger payload placement
                 self.y = self.y # trigger payload placement
                 self.set_sprite(self.loaded_sprite)
@@ -389,17 +929,20 @@ class Level(object):
 
 class Map(object):
 
-    solid = load_image('Earth_1.png')
-    grass_on_top = load_image('Earth_2.png')
-    cliff_on_left = load_image('Earth_3_side.png')
-    cliff_on_left_and_grass_on_top = load_image('Earth_4_side_corner.png')
-    inner_cliff_corner = load_image('Earth_5_inner_corner.png')
+    solid = load_image('Earth_1.png', 'terrain')
+    grass_on_top = load_image('Earth_2.png', 'terrain')
+    cliff_on_left = load_image('Earth_3_side.png', 'terrain')
+    cliff_on_left_and_grass_on_top = load_image('Earth_4_side_corner.png', 'terrain')
+    inner_cliff_corner = load_image('Earth_5_inner_corner.png', 'terrain')
 
     GRASS_HEIGHT = 10
 
-    def __init__(self, game):
+    def __init__(self, game, text=None):
+        """Build the map from map.txt, or from ``text`` if given."""
         self.game = game
-        self.text = pyglet.resource.file('map.txt').read().rstrip()
+        if text is None:
+            text = resources.file('map.txt').read().rstrip()
+        self.text = text
         self.lines = self.text.splitlines()[::-1]
 
         self.tile_width = 100
@@ -409,58 +952,155 @@ class Map(object):
         self.map_height = len(self.lines) * self.tile_height
 
         self.background_batch = pyglet.graphics.Batch()
+        self.batch = self.background_batch # where new tiles go
+        self.group = None
+        # we need to keep the sprites alive, or they're GCed
+        self.tiles = {} # (map_x, map_y) -> sprite
         self.sprites = []
-        for map_y, line in enumerate(self.lines):
-            try:
-                above = self.lines[map_y + 1]
-            except IndexError:
-                above = ''
-            for map_x, slot in enumerate(line):
-                if slot == ' ':
-                    continue
-
-                air_above = map_x >= len(above) or above[map_x] == ' '
-                air_to_the_left = map_x > 0 and line[map_x - 1] == ' '
-                air_above_to_the_left = (map_x - 1 >= len(above)
-                                         or map_x == 0
-                                         or above[map_x - 1] == ' ')
-
-                if air_above and air_to_the_left:
-                    image = self.cliff_on_left_and_grass_on_top
-                elif air_above:
-                    image = self.grass_on_top
-                elif air_to_the_left:
-                    image = self.cliff_on_left
-                elif air_above_to_the_left:
-                    image = self.inner_cliff_corner
-                else:
-                    image = self.solid
-
-                s = pyglet.sprite.Sprite(image,
-                                         map_x * self.tile_width,
-                                         map_y * self.tile_height,
-                                         batch=self.background_batch)
-                # we need to keep these objects alive, or they're GCed
-                self.sprites.append(s)
+        self.build_tiles((map_x, map_y)
+                         for map_y, line in enumerate(self.lines)
+                         for map_x in range(len(line)))
 
         self.levels = []
-        x1 = 0
+        self.boundaries = [] # x of every cliff, from left to right
+        self.find_levels()
+
+    def tile_image(self, map_x, map_y):
+        """Return the image for a map cell, or None if it is empty."""
+        if map_y >= len(self.lines):
+            return None
+        line = self.lines[map_y]
+        slot = line[map_x:map_x+1]
+        if slot in ('', ' '):
+            return None
+        try:
+            above = self.lines[map_y + 1]
+        except IndexError:
+            above = ''
+
+        air_above = map_x >= len(above) or above[map_x] == ' '
+        air_to_the_left = map_x > 0 and line[map_x - 1] == ' '
+        air_above_to_the_left = (map_x - 1 >= len(above)
+                                 or map_x == 0
+                                 or above[map_x - 1] == ' ')
+
+        if air_above and air_to_the_left:
+            return self.cliff_on_left_and_grass_on_top
+        elif air_above:
+            return self.grass_on_top
+        elif air_to_the_left:
+            return self.cliff_on_left
+        elif air_above_to_the_left:
+            return self.inner_cliff_corner
+        else:
+            return self.solid
+
+    def build_tiles(self, cells):
+        """Create, change or remove the sprites of the given cells."""
+        if self.game.headless:
+            return
+        for map_x, map_y in cells:
+            image = self.tile_image(map_x, map_y)
+            sprite = self.tiles.get((map_x, map_y))
+            if image is None:
+                if sprite is not None:
+                    sprite.delete()
+                    del self.tiles[map_x, map_y]
+            elif sprite is None:
+                self.tiles[map_x, map_y] = pyglet.sprite.Sprite(
+                    image, map_x * self.tile_width, map_y * self.tile_height,
+                    batch=self.batch, group=self.group)
+            elif sprite.image is not image:
+                sprite.image = image
+        self.sprites = [self.tiles[cell] for cell in
+                        sorted(self.tiles, key=lambda cell: (cell[1], cell[0]))]
+
+    def find_levels(self, first_col=None, last_col=None):
+        """Split the map into levels at its cliffs.
+
+        After an edit of the columns first_col..last_col only the levels
+        around those columns are looked for again; the others keep their
+        `Level` objects, renumbered if need be.
+        """
+        w = self.tile_width
+        if first_col is None:
+            boundaries, tail = [0], []
+            dirty = lambda x1, x2: True
+        else:
+            # cliffs further than a column away from the edit stay put
+            lo, hi = (first_col - 1) * w, (last_col + 2) * w
+            boundaries = [x for x in self.boundaries if x <= lo] or [0]
+            tail = [x for x in self.boundaries if x > hi]
+            dirty = lambda x1, x2: x2 >= lo and x1 <= hi
+        x1 = boundaries[-1]
         while True:
             x2 = self.vertical_wall_right_of(x1)
             if x2 == x1:
                 break
-            ground = self.ground_level((x1 + x2) / 2)
-            if ground > 0:
-                self.levels.append(Level(len(self.levels) + 1, x1, x2, ground))
-                log.debug('Level %d: %.1f--%.1f, ground %.1f',
-                          len(self.levels), x1, x2, ground)
-                if len(self.levels) >= 2:
-                    self.levels[-2].next = self.levels[-1]
+            boundaries.append(x2)
+            if x2 in tail:
+                # back in step with the old cliffs, so the rest is the same
+                boundaries.extend(tail[tail.index(x2) + 1:])
+                break
             x1 = x2
 
+        old = dict(((level.left, level.right), level) for level in self.levels)
+        levels = []
+        for x1, x2 in zip(boundaries, boundaries[1:]):
+            level = old.get((x1, x2))
+            if level is None or dirty(x1, x2):
+                ground = self.ground_level((x1 + x2) / 2)
+                if ground <= 0:
+                    continue
+                if level is None:
+                    level = Level(0, x1, x2, ground)
+                level.height = ground
+            levels.append(level)
+        for n, level in enumerate(levels):
+            level.number = n + 1
+            level.next = n + 1 < len(levels) and levels[n + 1] or None
+            log.debug('Level %d: %.1f--%.1f, ground %.1f',
+                      level.number, level.left, level.right, level.height)
+        self.levels = levels
+        self.boundaries = boundaries
+
+    def update(self, text):
+        """Switch to an edited map text, rebuilding only what changed.
+
+        Returns the cells, as (map_x, map_y), that changed.
+        """
+        old_lines = self.lines
+        self.text = text
+        self.lines = text.splitlines()[::-1]
+        self.map_width = max(map(len, self.lines)) * self.tile_width
+        self.map_height = len(self.lines) * self.tile_height
+        changed = set()
+        for map_y in range(max(len(old_lines), len(self.lines))):
+            old = map_y < len(old_lines) and old_lines[map_y] or ''
+            new = map_y < len(self.lines) and self.lines[map_y] or ''
+            if old != new:
+                changed.update((map_x, map_y)
+                               for map_x in range(max(len(old), len(new)))
+                               if old[map_x:map_x+1] != new[map_x:map_x+1])
+        if not changed:
+            return changed
+        # a tile's look depends on the cells above, left and above-left
+        affected = set(changed)
+        for map_x, map_y in changed:
+            affected.update([(map_x, map_y - 1), (map_x + 1, map_y),
+                             (map_x + 1, map_y - 1)])
+        self.build_tiles(cell for cell in affected if cell[1] >= 0)
+        columns = [map_x for map_x, map_y in changed]
+        self.find_levels(min(columns), max(columns))
+        return changed
+
     def draw(self):
         with gl_matrix():
-            self.background_batch.draw()
+            if self.game.renderer:
+                self.game.renderer.draw_sprites('terrain', self.sprites,
+                                                static=True)
+            else:
+                self.background_batch.draw()
 
     def vertical_wall_left_of(self, x):
         col = int(x / self.tile_width)
@@ -566,33 +1206,48 @@ class Camera(object):
 
 class Sky(object):
 
+    visible = True
+
+    clear_color = (0xd / 255., 0x5d / 255., 0x93 / 255., 1.0)
+
     def __init__(self, game):
         self.game = game
-        self.background = load_image('sky.png')
-        gl.glClearColor(0xd / 255., 0x5d / 255., 0x93 / 255., 1.0)
+        self.background = load_image('sky.png', 'sky')
+        gl.glClearColor(*self.clear_color)
+
+    parallax = -0.5 # vertical only
 
     def draw(self):
+        if not self.visible:
+            return # the clear colour is a good enough sky
         with gl_matrix():
             gl.glLoadIdentity()
-            gl.glTranslatef(0, self.game.camera.y * -0.5, 0)
+            gl.glTranslatef(0, self.game.view.camera_y * self.parallax, 0)
             with gl_state():
                 gl.glEnable(gl.GL_BLEND)
                 gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-                self.background.blit(-100, -300, height=1600, width=window.width+200)
+                x, y, width, height = self.rect()
+                self.background.blit(x, y, width=width, height=height)
+
+    def rect(self):
+        return -100, -300, window.width + 200, 1600
 
 
 class Clouds(object):
 
-    images = ([load_image('Cloud_1.png')] * 10 +
-              [load_image('Cloud_2.png')] + # rainbows are rare
-              [load_image('Cloud_3.png')] * 10)
+    images = ([load_image('Cloud_1.png', 'clouds')] * 10 +
+              [load_image('Cloud_2.png', 'clouds')] + # rainbows are rare
+              [load_image('Cloud_3.png', 'clouds')] * 10)
 
     parallax = -0.5
     density = 1 / 200000. # 1 cloud in square mm
 
+    layers = 3 # clouds are spread over this many batches
+    layers_shown = layers
+
     def __init__(self, game):
         self.game = game
-        self.batch = pyglet.graphics.Batch()
+        self.batches = [pyglet.graphics.Batch() for n in range(self.layers)]
         self.sprites = []
         map = game.game_map
         w, h = map.map_width, map.map_height
@@ -603,27 +1258,44 @@ class Clouds(object):
             x = random.uniform(0, w * abs(self.parallax))
             y = random.uniform(0, h * abs(self.parallax))
             s = pyglet.sprite.Sprite(random.choice(self.images), x, y,
-                                     batch=self.batch)
+                                     batch=self.batches[i % self.layers])
             self.sprites.append(s)
 
     def draw(self):
         with gl_matrix():
-            gl.glTranslatef(self.game.camera.x * self.parallax,
-                            self.game.camera.y * self.parallax, 0)
-            self.batch.draw()
+            gl.glTranslatef(self.game.view.camera_x * self.parallax,
+                            self.game.view.camera_y * self.parallax, 0)
+            self.draw_layers()
+
+    def draw_layers(self):
+        for n in range(self.layers_shown):
+            if self.game.renderer:
+                self.game.renderer.draw_sprites(
+                    ('clouds', n), self.sprites[n::self.layers], static=True)
+            else:
+                self.batches[n].draw()
 
 
 class Sea(object):
 
+    band_step = 20 # vertical distance between wave bands
+
+    rise_speed = 2.0  # pixels per second on the first level...
+    rise_growth = 2.5 # ...and this many times faster on each next one
+
     def __init__(self, game):
         self.game = game
         self.batch = pyglet.graphics.Batch()
-        self.image = image = load_image('Wave.png')
+        self.image = image = load_image('Wave.png', 'sea')
         self.first_layer = []
         self.level = 250
+        self.phase = 0
+        self.player = None
+        if game.headless:
+            return
 
         self.player = pyglet.media.Player()
-        self.player.queue(pyglet.resource.media('sea.wav', streaming=False))
+        self.player.queue(resources.media('sea.wav', streaming=False))
         self.player.eos_action = self.player.EOS_LOOP
         self.player.volume = 0.2
         self.player.play()
@@ -634,27 +1306,38 @@ class Sea(object):
             s = pyglet.sprite.Sprite(image, x, 0,
                                      batch=self.batch)
             self.first_layer.append(s)
-        self.phase = 0
 
-    def draw(self, low_y_hint=0):
+    def bands(self, low_y_hint=0):
+        """Return the positions of the wave bands, top to bottom."""
+        view = self.game.view
         x = -75
-        y = self.level - self.image.height // 3
+        y = view.sea_level - self.image.height // 3
         radius_iter = itertools.cycle([-10, 15, -20, 15])
         phase_iter = itertools.cycle([0, 1, 0.5, 1.5])
         phase_mult_iter = itertools.cycle([1.2, 1, 1.1, 1.4, 1.5, 1.6, 1.3])
         phase = 0
         extra = 100
+        bands = []
         while y > low_y_hint - self.image.height:
             radius = radius_iter.next()
             radius_x = radius * 2
             radius_y = radius * 0.5
-            phase = phase * 0.5 + (self.phase + math.pi * phase_iter.next()) / phase_mult_iter.next()
+            phase = phase * 0.5 + (view.sea_phase + math.pi * phase_iter.next()) / phase_mult_iter.next()
+            bands.append((int(x + math.sin(phase) * radius_x),
+                          int(y + math.cos(phase) * radius_y)))
+            y -= self.band_step
+        return bands
+
+    def draw(self, low_y_hint=0):
+        bands = self.bands(low_y_hint)
+        if self.game.renderer:
+            self.game.renderer.draw_rows(self.image, len(self.first_layer),
+                                         self.image.width, bands)
+            return
+        for band_x, band_y in bands:
             with gl_matrix():
-                gl.glTranslatef(int(x + math.sin(phase) * radius_x),
-                                int(y + math.cos(phase) * radius_y),
-                                0)
+                gl.glTranslatef(band_x, band_y, 0)
                 self.batch.draw()
-            y -= 20
 
     def update(self, dt):
         self.phase += dt * 3
@@ -662,76 +1345,574 @@ class Sea(object):
             return
         if self.level > self.game.game_map.map_height:
             return
-        self.level += 2 * (dt * 2.5 ** (self.game.current_level.number - 1))
+        self.level += dt * self.rise_speed * self.rise_growth ** (
+            self.game.current_level.number - 1)
         if self.game.dodopult.y < self.level:
             self.game.dodopult.y = self.level
         if self.level >= self.game.current_level.height:
             self.game.next_level()
 
 
+class WorldSnapshot(object):
+    """Terrain and clouds of the game over screen, rendered ahead of time.
+
+    Each entry of `scales` gets its own render target covering what is
+    visible between that zoom level and the next one, so every level is
+    at most about twice the window size.  Levels are rendered the first
+    time they are needed; while the view is zoomed in closer than the
+    first scale the world is drawn live, which costs no more than usual.
+
+    The clouds are baked in with the parallax of the camera position at
+    the time the level is rendered; the camera has settled on the bunny
+    long before the view zooms out that far.
+    """
+
+    scales = (0.5, 0.25)
+
+    def __init__(self, game, min_zoom):
+        self.game = game
+        self.min_zoom = min_zoom
+        self.levels = {}
+        self.window_size = None
+
+    def level_for(self, zoom):
+        """Return the scale of the level to use at ``zoom``, if any."""
+        usable = [scale for scale in self.scales if scale >= zoom]
+        if not usable:
+            return None
+        return min(usable)
+
+    def prepare(self, zoom):
+        """Return the level to draw at ``zoom``, or None to draw live.
+
+        Must be called outside of the camera transform, since it may
+        render a new level.
+        """
+        if (window.width, window.height) != self.window_size:
+            self.release()
+            self.window_size = window.width, window.height
+        scale = self.level_for(zoom)
+        if scale is None:
+            return None
+        try:
+            return self.levels[scale]
+        except KeyError:
+            level = self.levels[scale] = self.render(scale)
+            return level
+
+    def draw(self, level):
+        """Draw a level returned by prepare() in world coordinates."""
+        target, (left, bottom, right, top) = level
+        target.blit_premultiplied(left, bottom, right - left, top - bottom)
+
+    def render(self, scale):
+        i = self.scales.index(scale)
+        lowest_zoom = max(self.min_zoom, self.scales[i + 1]
+                          if i + 1 < len(self.scales) else 0)
+        view = self.game.view
+        center_x = view.camera_x + window.width / 2.
+        center_y = view.camera_y + window.height // 2
+        half_w = window.width / 2. / lowest_zoom
+        half_h = window.height / 2. / lowest_zoom
+        left, right = int(center_x - half_w), int(center_x + half_w)
+        bottom, top = int(center_y - half_h), int(center_y + half_h)
+        width = int((right - left) * scale)
+        height = int((top - bottom) * scale)
+        if max(width, height) > renderer.RenderTarget.max_size():
+            return None
+        try:
+            target = renderer.RenderTarget(width, height, mipmaps=True)
+        except renderer.RenderTargetError as e:
+            log.debug('no game over snapshot: %s', e)
+            return None
+        clouds = self.game.clouds
+        with target.drawing(left, bottom, right, top):
+            with gl_matrix():
+                # world position of the clouds as seen from this camera
+                gl.glTranslatef(view.camera_x * (1 + clouds.parallax),
+                                view.camera_y * (1 + clouds.parallax), 0)
+                clouds.draw_layers()
+            self.game.game_map.draw()
+        return target, (left, bottom, right, top)
+
+    def release(self):
+        for level in self.levels.values():
+            if level is not None:
+                level[0].delete()
+        self.levels.clear()
+
+
+class MapWatcher(object):
+    """Reloads the map whenever its file changes on disk."""
+
+    interval = 0.25 # seconds between checks
+
+    def __init__(self, game, filename):
+        self.game = game
+        self.filename = filename
+        self.mtime = self.modified()
+
+    def modified(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def check(self, dt=None):
+        mtime = self.modified()
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            f = open(self.filename)
+            try:
+                text = f.read().rstrip()
+            finally:
+                f.close()
+        except IOError as e:
+            log.warning('cannot reload the map: %s', e)
+            return
+        if text.strip():
+            self.game.reload_map(text)
+
+
 class Help(object):
 
-    def __init__(self):
-        self.help = pyglet.sprite.Sprite(load_image('halp.png'))
+    def __init__(self, headless=False):
+        if headless:
+            self.help = HeadlessSprite()
+            return
+        self.help = pyglet.sprite.Sprite(load_image('halp.png', 'hud'))
         self.help.image.anchor_x = self.help.image.width // 2
         self.help.image.anchor_y = self.help.image.height // 2
 
-    def draw(self):
+    def place(self):
         self.help.x = window.width // 2
         self.help.y = window.height // 2
+
+    def draw(self):
+        self.place()
         self.help.draw()
 
 
+class WorldPool(object):
+    """The parts of a finished game that the next one can reuse.
+
+    Parsing the map and building its tiles, scattering the clouds and
+    making the dodos and their sprites is most of the work of starting a
+    game.  Game.stop(pool) leaves the map, the cloud field and the flock
+    here, and Game(pool=pool) takes them over, so a new game starts at
+    once and has just as many sprites and batches as the first one did.
+    Parts left by a headless game only go to headless games, and the other
+    way round.
+    """
+
+    def __init__(self):
+        self.headless = None
+        self.game_map = None
+        self.clouds = None
+        self.flock = None
+
+    def put(self, game):
+        self.headless = game.headless
+        self.game_map = game.game_map
+        self.clouds = game.clouds
+        self.flock = game.flock
+
+    def take(self, game):
+        """Return the kept (map, clouds, flock), now belonging to ``game``.
+
+        Whatever was not kept is None.
+        """
+        parts = self.game_map, self.clouds, self.flock
+        self.game_map = self.clouds = self.flock = None
+        if game.headless != self.headless:
+            return None, None, None
+        for part in parts:
+            if part is not None:
+                part.game = game
+        return parts
+
+
 class Game(object):
 
-    ending_image = load_image('Dodo_starting_screen.png')
+    ending_image = load_image('Dodo_starting_screen.png', 'dodos')
+    ending_image.anchor_x = ending_image.width // 2
+    ending_image.anchor_y = ending_image.height // 2
 
     gravity = 200.0 # pixels per second squared
-    air_resistance = 0.007 # i.e. a loss of 0.7% per seco^W per update
-                           # XXX fix this to be per second
+    air_resistance = 0.14 # share of sideways speed lost per second of
+                          # flight, exponentially (dodos fly at triple
+                          # speed, so about 0.7% per update at 60 Hz)
 
     game_over_animation = 5.0 # seconds
+    game_over_zoom = 1 / 5.
 
     update_freq = 1 / 60.
 
     INITIAL_DODOS = 20
 
-    def __init__(self):
-        self.game_map = Map(self)
+    particle_kinds = [
+        ParticleKind('feathers', (250, 250, 245, 230), size=3.0,
+                     lifetime=(0.6, 1.4), speed=(30, 90), spread=80,
+                     gravity=60.0, drag=0.2),
+        ParticleKind('splash', (210, 235, 255, 200), size=4.0,
+                     lifetime=(0.4, 0.8), speed=(60, 150), spread=25,
+                     gravity=400.0),
+        ParticleKind('dust', (170, 140, 100, 150), size=5.0,
+                     lifetime=(0.3, 0.7), speed=(10, 40), spread=60,
+                     gravity=-15.0, drag=0.1),
+    ]
+
+    def __init__(self, headless=HEADLESS, clock=None, pool=None):
+        """Set up a new game.
+
+        Headless games have no sprites, sounds or particles, and start
+        with the help screen closed.  If a clock is given, the caller ticks
+        it; otherwise the game runs on pyglet's clock (or its own clock on
+        a simulation thread, with THREADED_SIMULATION, or stepped by
+        advance(), with FRAME_PACING).  A `WorldPool` that a stopped game
+        was put into supplies the map, clouds and dodos.
+        """
+        global window
+        self.headless = headless
+        if headless and window is None:
+            window = HeadlessWindow()
+        self.lock = threading.RLock()
+        self.stepper = None
+        if clock is not None:
+            self.clock = clock
+            self.deferred = None
+            self.simulation = None
+        elif FRAME_PACING and not headless:
+            self.stepper = FixedStepper(self.update_freq, PACED_INTERPOLATION)
+            self.clock = self.stepper.clock
+            self.deferred = None
+            self.simulation = None
+        elif THREADED_SIMULATION and not headless:
+            self.clock = pyglet.clock.Clock()
+            self.deferred = []
+            self.simulation = SimulationThread(self)
+        else:
+            self.clock = pyglet.clock.get_default()
+            self.deferred = None
+            self.simulation = None
+
+        self.renderer = None
+        if INSTANCED_RENDERER and not BATCHED_SCENE:
+            self.renderer = renderer.get_instanced_renderer()
+            if self.renderer:
+                self.renderer.reset()
+        self.bunny = None
+        self.snapshot = None
+        self.profiler = diagnostics.NULL_PROFILER
+
+        self.particles = None
+        if not headless:
+            # particles are only for show, so they live on the render thread
+            self.particles = ParticleSystem(self.particle_kinds,
+                                            PARTICLE_BUDGET)
+            pyglet.clock.schedule_interval(self.particles.update,
+                                           self.update_freq)
+
+        game_map = clouds = flock = None
+        if pool is not None:
+            game_map, clouds, flock = pool.take(self)
+
+        self.game_map = game_map or Map(self)
         self.current_level = self.game_map.levels[0]
         self.game_is_over = False
         self.game_over_time = 0
 
         self.dodopult = Dodopult(self)
         self.current_level.place(self.dodopult)
-        pyglet.clock.schedule_interval(self.dodopult.update, self.update_freq)
+        self.clock.schedule_interval(self.dodopult.update, self.update_freq)
 
-        self.powerbar = PowerBar(self.dodopult)
+        self.powerbar = None
+        if not headless:
+            self.powerbar = PowerBar(self.dodopult)
 
         self.sea = Sea(self)
-        pyglet.clock.schedule_interval(self.sea.update, self.update_freq)
+        self.clock.schedule_interval(self.sea.update, self.update_freq)
 
-        self.sky = Sky(self)
-        self.clouds = Clouds(self)
+        self.sky = self.clouds = None
+        if not headless:
+            self.sky = Sky(self)
+            self.clouds = clouds or Clouds(self)
 
         self.dodos = []
-        self.dodo_batch = pyglet.graphics.Batch()
-        for dodo in range(self.INITIAL_DODOS):
+        self.dodo_batch = None
+        self.animator = None
+        if not headless:
+            self.dodo_batch = pyglet.graphics.Batch()
+            self.animator = SpriteAnimator()
+        self.dodo_group = None
+        if flock is None:
+            flock = Flock(self)
+        self.flock = flock
+        self.clock.schedule_interval(self.flock.update, self.update_freq)
+        self.flock.truncate(self.INITIAL_DODOS) # the bunny goes
+        for dodo in self.flock.members:
+            self.current_level.place(dodo)
+            dodo.reset()
+            self.dodos.append(dodo)
+        while len(self.dodos) < self.INITIAL_DODOS:
             self.add_dodo()
 
-        self.help = Help()
+        self.help = Help(headless)
 
         self.camera = Camera(self)
-        pyglet.clock.schedule_interval(self.camera.update, self.update_freq)
+        self.clock.schedule_interval(self.camera.update, self.update_freq)
+
+        self.clock.schedule_interval(self.update, self.update_freq)
+
+        self.view = WorldFrame.capture(self)
+
+        self.scene = None
+        if BATCHED_SCENE and not headless:
+            self.scene = Scene(self)
+
+        self.rewind = None
+        if SAVE_STATES:
+            self.rewind = savestate.RewindBuffer(self)
+            self.rewind.start()
+
+        self.map_watcher = None
+        if MAP_HOT_RELOAD and not headless and resources is pyglet.resource:
+            self.map_watcher = MapWatcher(self, os.path.join(
+                pyglet.resource.get_script_home(), 'assets', 'map.txt'))
+            pyglet.clock.schedule_interval(self.map_watcher.check,
+                                           self.map_watcher.interval)
+
+    def start(self):
+        if self.simulation is not None:
+            self.simulation.start()
+
+    def stop(self, pool=None):
+        """End the game for good.
+
+        Everything the game scheduled is unscheduled and its sounds are
+        released, so nothing of it keeps running (or keeps its batches
+        alive) once a new game starts.  With a `WorldPool`, the map,
+        clouds and dodos are left in it for the next game.
+        """
+        if self.simulation is not None:
+            self.simulation.stop()
+        for func in (self.dodopult.update, self.sea.update, self.flock.update,
+                     self.camera.update, self.update,
+                     self.count_surviving_dodos):
+            self.clock.unschedule(func)
+        if self.rewind is not None:
+            self.rewind.stop()
+        if self.particles is not None:
+            pyglet.clock.unschedule(self.particles.update)
+        if self.map_watcher is not None:
+            pyglet.clock.unschedule(self.map_watcher.check)
+        release_player(self.sea.player)
+        release_player(self.dodopult.player)
+        for dodo in self.flock.members:
+            release_player(dodo.player)
+        if self.snapshot is not None:
+            self.snapshot.release()
+            self.snapshot = None
+        if pool is not None:
+            pool.put(self)
+
+    def advance(self, dt):
+        """Run the ticks that fit in ``dt`` more seconds (FRAME_PACING)."""
+        if self.stepper is not None:
+            self.stepper.advance(dt, self)
+
+    def defer(self, func, *args):
+        """Call func(*args) on the thread that draws.
+
+        Sprites, batches and sound players belong to the render thread;
+        game logic that touches them goes through here.  Without a
+        simulation thread this just calls the function.
+        """
+        if self.deferred is None:
+            func(*args)
+        else:
+            self.deferred.append((func, args))
 
-        pyglet.clock.schedule_interval(self.update, self.update_freq)
+    def emit_particles(self, name, x, y, n, direction=90.0, velocity=(0, 0)):
+        if self.particles is None:
+            return
+        self.defer(self.particles.emit, name, x, y, n, direction, velocity)
+
+    def run_deferred(self):
+        deferred, self.deferred = self.deferred, []
+        for func, args in deferred:
+            func(*args)
+
+    def sync_view(self):
+        """Update self.view and the dodo sprites for the next draw()."""
+        stepper = self.stepper
+        if stepper is not None and stepper.interpolate:
+            previous, latest, moved = stepper.take_frames()
+            alpha = stepper.alpha
+        elif self.simulation is not None:
+            with self.lock:
+                self.run_deferred()
+            previous, latest, moved = self.simulation.take_frames()
+            alpha = None
+        else:
+            self.view = WorldFrame.capture(self)
+            self.flock.sync_sprites()
+            return
+        if latest is None:
+            # nothing has been stepped yet
+            if stepper is not None:
+                self.view = WorldFrame.capture(self)
+                self.flock.sync_sprites()
+            return
+        if previous is None:
+            previous = latest
+        if alpha is None:
+            render_time = time.time() - self.simulation.tick
+            span = latest.time - previous.time
+            alpha = 1.0
+            if span > 0:
+                alpha = min(1.0, max(0.0,
+                                     (render_time - previous.time) / span))
+        self.view = WorldFrame.interpolate(previous, latest, alpha)
+        self.flock.sync_sprites_between(previous, latest, alpha, moved)
 
     def add_dodo(self):
-        dodo = Dodo(self)
+        dodo = Dodo(self, self.flock)
         self.current_level.place(dodo)
-        pyglet.clock.schedule_interval(dodo.update, self.update_freq)
         self.dodos.append(dodo)
 
+    def capture_state(self):
+        """Return a `savestate.GameState` for restore_state()."""
+        state = savestate.GameState()
+        flock = self.flock
+        index = dict((id(dodo), n) for n, dodo in enumerate(flock.members))
+        def index_of(dodo):
+            return index.get(id(dodo), -1)
+
+        dodopult, camera = self.dodopult, self.camera
+        state.flags = ((self.game_is_over and savestate.GAME_OVER) |
+                       (dodopult.armed and savestate.ARMED) |
+                       (dodopult.powering_up and savestate.POWERING_UP) |
+                       (camera.manual_control and savestate.MANUAL_CAMERA))
+        state.level = self.game_map.levels.index(self.current_level)
+        state.bunny = index_of(self.bunny)
+        state.payload = index_of(dodopult.payload)
+        state.focus = index_of(camera.focus)
+        state.game_over_time = self.game_over_time
+        state.sea_level, state.sea_phase = self.sea.level, self.sea.phase
+        state.dodopult_x, state.dodopult_y = dodopult.x, dodopult.y
+        state.power = dodopult.power
+        state.time_loading = dodopult.time_loading
+        state.aim_angle = dodopult.aim_angle
+        state.camera_x, state.camera_y = camera.x, camera.y
+        state.camera_target_x = camera.target_x
+        state.camera_target_y = camera.target_y
+        state.focus_timer = camera.focus_timer
+
+        state.x, state.y = array('d', flock.x), array('d', flock.y)
+        state.dx, state.dy = array('d', flock.dx), array('d', flock.dy)
+        state.alive = array('b', flock.alive)
+        standing = Dodo.standing_images()
+        for dodo in flock.members:
+            state.looks.append(dodo.look)
+            state.standing.append(standing.index(dodo.standing_image))
+        state.flying = array('I', sorted(flock.flying))
+        state.dodos = array('I', [index[id(dodo)] for dodo in self.dodos])
+        return state
+
+    def restore_state(self, state):
+        """Put the game back the way it was when ``state`` was captured.
+
+        Raises `savestate.SnapshotError`, leaving the game as it was, if
+        the state was saved on a different map.
+        """
+        state.check(len(self.game_map.levels), len(Dodo.standing_images()))
+        flock = self.flock
+        size = len(state.x)
+        flock.truncate(size)
+        while len(flock) < size:
+            Dodo(self, flock)
+        flock.x[:], flock.y[:] = state.x, state.y
+        flock.dx[:], flock.dy[:] = state.dx, state.dy
+        flock.alive[:] = state.alive
+        flock.flying = set(state.flying)
+        flock.moved = set(range(size))
+        members = flock.members
+        def member(index):
+            return index >= 0 and members[index] or None
+
+        # the other looks follow from the rest of the state
+        flock.gone = set(n for n, look in enumerate(state.looks)
+                         if look == savestate.GONE)
+        standing = Dodo.standing_images()
+        for dodo, image in zip(members, state.standing):
+            dodo.standing_image = standing[image]
+        self.dodos = [members[n] for n in state.dodos]
+        self.bunny = member(state.bunny)
+
+        was_over = self.game_is_over
+        self.game_is_over = bool(state.flags & savestate.GAME_OVER)
+        if was_over and not self.game_is_over and self.snapshot:
+            self.snapshot.release()
+            self.snapshot = None
+        self.game_over_time = state.game_over_time
+        self.current_level = self.game_map.levels[state.level]
+        self.sea.level, self.sea.phase = state.sea_level, state.sea_phase
+
+        dodopult = self.dodopult
+        dodopult.payload = member(state.payload)
+        dodopult.x, dodopult.y = state.dodopult_x, state.dodopult_y
+        dodopult.armed = bool(state.flags & savestate.ARMED)
+        dodopult.powering_up = bool(state.flags & savestate.POWERING_UP)
+        dodopult.power = state.power
+        dodopult.time_loading = state.time_loading
+        dodopult.aim_angle = state.aim_angle
+        if dodopult.payload:
+            dodopult.set_sprite(dodopult.loaded_sprite)
+        elif dodopult.armed:
+            dodopult.set_sprite(dodopult.armed_sprite)
+        else:
+            dodopult.set_sprite(dodopult.unarmed_sprite)
+        for dodo in members:
+            dodo.refresh()
+
+        camera = self.camera
+        camera.x, camera.y = state.camera_x, state.camera_y
+        camera.target_x = state.camera_target_x
+        camera.target_y = state.camera_target_y
+        camera.focus = member(state.focus)
+        camera.focus_timer = state.focus_timer
+        camera.manual_control = bool(state.flags & savestate.MANUAL_CAMERA)
+
+        if self.particles is not None:
+            self.defer(self.particles.clear)
+        # any pending count belonged to the future we just left
+        self.clock.unschedule(self.count_surviving_dodos)
+        if not self.game_is_over:
+            self.clock.schedule_once(self.count_surviving_dodos, 3.0)
+
+    def reload_map(self, text):
+        """Apply an edited map to the running game."""
+        start = time.time()
+        with self.lock:
+            changed = self.game_map.update(text)
+            if not changed:
+                return
+            levels = self.game_map.levels
+            if self.current_level not in levels and levels:
+                x = self.dodopult.x
+                self.current_level = ([level for level in levels
+                                       if level.left <= x < level.right]
+                                      or levels)[0]
+        if self.renderer:
+            self.renderer.forget('terrain')
+        if self.snapshot:
+            self.snapshot.release()
+        log.info('map reloaded: %d cells changed, %d levels, %.1f ms',
+                 len(changed), len(levels), (time.time() - start) * 1000)
+
     def count_surviving_dodos(self, dt=None):
         above = 0
         here = 0
@@ -762,76 +1943,961 @@ class Game(object):
             self.current_level = self.current_level.next
             log.debug("Level %d", self.current_level.number)
             self.current_level.place(self.dodopult)
-            pyglet.clock.schedule_once(self.count_surviving_dodos, 3.0)
+            self.clock.schedule_once(self.count_surviving_dodos, 3.0)
 
     def game_over(self):
         log.debug("Game over")
-        bunny = Dodo(self)
-        self.ending_image.anchor_x = self.ending_image.width // 2
-        self.ending_image.anchor_y = self.ending_image.height // 2
-        bunny.sprite = pyglet.sprite.Sprite(self.ending_image,
-                                            batch=self.dodo_batch)
+        bunny = self.bunny = Dodo(self, self.flock)
         lvl = self.game_map.levels[-1]
         bunny.x = (lvl.left + lvl.right) / 2 + self.game_map.tile_width * 1.0
         bunny.y = lvl.height - self.game_map.tile_height * 7
+        bunny.refresh()
         self.camera.focus_on(bunny)
+        if (GAME_OVER_SNAPSHOT and not BATCHED_SCENE
+            and renderer.RenderTarget.is_supported()):
+            self.snapshot = WorldSnapshot(self, self.game_over_zoom)
         self.game_is_over = True
 
+    @property
+    def game_over_animation_finished(self):
+        return (self.game_is_over
+                and self.game_over_time >= self.game_over_animation)
+
+    @property
+    def is_idle(self):
+        """Nothing moves on screen unless the player does something."""
+        return self.help.help.visible or self.game_over_animation_finished
+
+    def view_state(self):
+        """Return a tuple that changes whenever draw() would look different.
+
+        Waves keep rolling on the idle screens, but that alone is not worth
+        a redraw, so the sea phase only counts while the game is running.
+        """
+        dodopult = self.dodopult
+        state = (self.camera.x, self.camera.y, self.sea.level,
+                 self.game_over_time, self.help.help.visible,
+                 dodopult.x, dodopult.y, dodopult.aim_angle, dodopult.power,
+                 dodopult.time_loading, dodopult.payload is None,
+                 len(self.dodos), self.particles.steps)
+        if not self.is_idle:
+            state += (self.sea.phase, )
+        return state
+
     def update(self, dt):
         if self.game_is_over:
             self.game_over_time = min(self.game_over_animation,
                                       self.game_over_time + dt)
 
-    def draw(self):
+    def draw_dodos(self):
+        if not self.renderer:
+            self.dodo_batch.draw()
+            return
+        sprites = [dodo.sprite for dodo in self.flock.members
+                   if dodo.sprite is not None]
+        self.renderer.draw_sprites('dodos', sprites)
+
+    def zoom(self):
+        if not self.game_is_over:
+            return 1
+        t = self.view.game_over_time / self.game_over_animation
+        # linear transition from 1X to 5X
+        return 1 - t * (1 - self.game_over_zoom)
+
+    def visible_rect(self, margin=64):
+        """The part of the world on screen, as (left, bottom, right, top),
+        with ``margin`` pixels to spare for sprites sticking in."""
+        view = self.view
+        scale = self.zoom()
+        # zooming scales around the middle of the window
+        x = view.camera_x + window.width / 2.0
+        y = view.camera_y + window.height / 2.0
+        half_width = window.width / 2.0 / scale + margin
+        half_height = window.height / 2.0 / scale + margin
+        return (x - half_width, y - half_height,
+                x + half_width, y + half_height)
+
+    def apply_zoom(self, scale):
+        gl.glTranslatef(window.width / 2, window.height // 2, 0)
+        gl.glScalef(scale, scale, 1.0)
+        gl.glTranslatef(-window.width / 2, -window.height // 2, 0)
+
+    def draw(self, hud=True):
+        """Draw the game; leave out the HUD if hud is false.
+
+        draw_hud() draws the parts left out.
+        """
+        self.sync_view()
+        if self.animator is not None:
+            rect = self.visible_rect()
+            self.flock.show_sprites_in(*rect)
+            self.animator.update(*rect)
+        if self.scene is not None:
+            self.scene.draw(hud)
+            return
+        view = self.view
+        layer = self.profiler.layer
+        scale = self.zoom()
         with gl_matrix():
             if self.game_is_over:
-                t = self.game_over_time / self.game_over_animation
-                scale = 1 - t * (1 - 1/5.)  # linear transition from 1X to 5X
-                gl.glTranslatef(window.width / 2, window.height // 2, 0)
-                gl.glScalef(scale, scale, 1.0)
-                gl.glTranslatef(-window.width / 2, -window.height // 2, 0)
-                low_y_hint = self.camera.y - window.height / 2 / scale
+                self.apply_zoom(scale)
+                low_y_hint = view.camera_y - window.height / 2 / scale
             else:
-                low_y_hint = self.camera.y
-            self.sky.draw()
-            self.clouds.draw()
+                low_y_hint = view.camera_y
+            with layer('snapshot'):
+                snapshot = self.snapshot and self.snapshot.prepare(scale)
+            with layer('sky'):
+                self.sky.draw()
+            if not snapshot:
+                with layer('clouds'):
+                    self.clouds.draw()
+            with gl_matrix():
+                gl.glTranslatef(view.camera_x * -1, view.camera_y * -1, 0)
+                with layer('terrain'):
+                    if snapshot:
+                        self.snapshot.draw(snapshot)
+                    else:
+                        self.game_map.draw()
+                with layer('dodos'):
+                    self.draw_dodos()
+                with layer('dodopult'):
+                    self.dodopult.draw()
+                with layer('particles'):
+                    self.particles.draw()
+                with layer('sea'):
+                    self.sea.draw(low_y_hint)
+                if hud:
+                    with layer('hud'):
+                        self.powerbar.draw()
+        if hud:
+            with layer('hud'):
+                self.help.draw()
+
+    def draw_hud(self):
+        if self.scene is not None:
+            self.scene.draw_hud()
+            return
+        view = self.view
+        with self.profiler.layer('hud'):
             with gl_matrix():
-                gl.glTranslatef(self.camera.x * -1, self.camera.y * -1, 0)
-                self.game_map.draw()
-                self.dodo_batch.draw()
-                self.dodopult.draw()
-                self.sea.draw(low_y_hint)
+                if self.game_is_over:
+                    self.apply_zoom(self.zoom())
+                gl.glTranslatef(view.camera_x * -1, view.camera_y * -1, 0)
                 self.powerbar.draw()
-        self.help.draw()
+            self.help.draw()
+
+
+class SceneGroup(pyglet.graphics.OrderedGroup):
+    """A layer of the batched scene, seen through the game camera.
+
+    The layer moves by parallax times the camera offset (use a pair for
+    separate horizontal and vertical parallax); zoomed layers also follow
+    the game over zoom-out.
+    """
+
+    def __init__(self, order, game, parallax=1.0, zoomed=True, parent=None):
+        super(SceneGroup, self).__init__(order, parent)
+        self.game = game
+        if not isinstance(parallax, tuple):
+            parallax = (parallax, parallax)
+        self.parallax_x, self.parallax_y = parallax
+        self.zoomed = zoomed
+
+    def set_state(self):
+        game = self.game
+        gl.glPushMatrix()
+        if self.zoomed and game.game_is_over:
+            game.apply_zoom(game.zoom())
+        gl.glTranslatef(game.view.camera_x * -self.parallax_x,
+                        game.view.camera_y * -self.parallax_y, 0)
+
+    def unset_state(self):
+        gl.glPopMatrix()
+
+
+class OffsetGroup(pyglet.graphics.OrderedGroup):
+    """Draws its children moved by (x, y)."""
+
+    x = y = 0
+
+    def set_state(self):
+        gl.glPushMatrix()
+        gl.glTranslatef(self.x, self.y, 0)
+
+    def unset_state(self):
+        gl.glPopMatrix()
+
+
+def quad_vertices(image, x, y, width=None, height=None):
+    x -= image.anchor_x
+    y -= image.anchor_y
+    x2 = x + (width or image.width)
+    y2 = y + (height or image.height)
+    return [x, y, x2, y, x2, y2, x, y2]
+
+
+class Scene(object):
+    """All layers of a game in one batch (and the HUD in another).
+
+    The camera, parallax and game over zoom are applied by the groups, so
+    nothing needs to be redrawn layer by layer: a frame is one submission
+    per layer and texture, plus one per wave band, no matter how many
+    sprites there are.  The sprites of the map, clouds, dodos and dodopult
+    are moved into the scene's batch.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.batch = batch = pyglet.graphics.Batch()
+        self.hud_batch = pyglet.graphics.Batch()
+
+        self.sky_group = SceneGroup(0, game, (0, -game.sky.parallax),
+                                    zoomed=False)
+        self.clouds_group = SceneGroup(1, game, -game.clouds.parallax)
+        self.terrain_group = SceneGroup(2, game)
+        self.dodo_group = SceneGroup(3, game)
+        self.dodopult_group = SceneGroup(4, game)
+        self.particle_group = SceneGroup(5, game)
+        self.sea_group = SceneGroup(6, game)
+        self.powerbar_group = SceneGroup(0, game)
+        self.help_group = pyglet.graphics.OrderedGroup(1)
+
+        sky = game.sky.background.get_texture()
+        self.sky_rect = None
+        self.sky = batch.add(4, gl.GL_QUADS,
+                             pyglet.sprite.SpriteGroup(
+                                 sky, gl.GL_SRC_ALPHA,
+                                 gl.GL_ONE_MINUS_SRC_ALPHA, self.sky_group),
+                             'v2f', ('t3f', sky.tex_coords))
+        self.clouds_shown = None
+
+        self.move(game.clouds.sprites, self.clouds_group)
+        self.move(game.game_map.sprites, self.terrain_group)
+        game.game_map.batch, game.game_map.group = batch, self.terrain_group
+        game.dodo_batch, game.dodo_group = batch, self.dodo_group
+        self.move([dodo.sprite for dodo in game.flock.members
+                   if dodo.sprite is not None], self.dodo_group)
+        self.move([game.dodopult.sprite], self.dodopult_group)
+        game.particles.attach(batch, self.particle_group)
+        self.move([game.powerbar.power_bar], self.powerbar_group,
+                  self.hud_batch)
+        self.move([game.help.help], self.help_group, self.hud_batch)
+
+        wave = game.sea.image
+        self.wave_group = pyglet.sprite.SpriteGroup(
+            wave.get_texture(), gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        self.wave_row = []
+        for sprite in game.sea.first_layer:
+            self.wave_row.extend(quad_vertices(wave, sprite.x, sprite.y))
+        self.bands = []
+
+    def move(self, sprites, group, batch=None):
+        for sprite in sprites:
+            sprite.batch = batch or self.batch
+            sprite.group = group
+
+    def update_sky(self):
+        sky = self.game.sky
+        rect = sky.visible and sky.rect()
+        if rect != self.sky_rect:
+            self.sky_rect = rect
+            if rect:
+                self.sky.vertices[:] = quad_vertices(sky.background, *rect)
+            else:
+                self.sky.vertices[:] = [0] * 8
+
+    def update_clouds(self):
+        clouds = self.game.clouds
+        if clouds.layers_shown != self.clouds_shown:
+            self.clouds_shown = clouds.layers_shown
+            for n, sprite in enumerate(clouds.sprites):
+                sprite.visible = n % clouds.layers < clouds.layers_shown
+
+    def update_sea(self, low_y_hint):
+        positions = self.game.sea.bands(low_y_hint)
+        bands = self.bands
+        tiles = len(self.wave_row) // 8
+        texture = self.wave_group.texture
+        while len(bands) < len(positions):
+            group = OffsetGroup(len(bands), self.sea_group)
+            wave_group = pyglet.sprite.SpriteGroup(
+                texture, gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA, group)
+            bands.append((group, self.batch.add(
+                tiles * 4, gl.GL_QUADS, wave_group,
+                ('v2f/static', self.wave_row),
+                ('t3f/static', texture.tex_coords * tiles))))
+        while len(bands) > len(positions):
+            bands.pop()[1].delete()
+        for (group, vertex_list), (x, y) in zip(bands, positions):
+            group.x, group.y = x, y
+
+    def draw(self, hud=True):
+        game = self.game
+        low_y_hint = game.view.camera_y
+        if game.game_is_over:
+            low_y_hint -= window.height / 2 / game.zoom()
+        self.update_sky()
+        self.update_clouds()
+        self.update_sea(low_y_hint)
+        game.dodopult.place_sprite()
+        with game.profiler.layer('scene'):
+            self.batch.draw()
+        if hud:
+            self.draw_hud()
+
+    def draw_hud(self):
+        self.game.powerbar.update_sprite()
+        self.game.help.place()
+        with self.game.profiler.layer('hud'):
+            self.hud_batch.draw()
+
+
+class WorldFrame(object):
+    """What draw() needs to know about the game at one point in time."""
+
+    __slots__ = ('time', 'camera_x', 'camera_y', 'sea_level', 'sea_phase',
+                 'dodopult_x', 'dodopult_y', 'game_over_time',
+                 'x', 'y', 'flying')
+
+    SCALARS = __slots__[1:8]
+
+    @classmethod
+    def capture(cls, game, copy=False):
+        """Capture the state of ``game``.
+
+        Dodo positions are shared with the flock unless ``copy`` is true.
+        """
+        frame = cls()
+        frame.time = time.time()
+        frame.camera_x = game.camera.x
+        frame.camera_y = game.camera.y
+        frame.sea_level = game.sea.level
+        frame.sea_phase = game.sea.phase
+        frame.dodopult_x = game.dodopult.x
+        frame.dodopult_y = game.dodopult.y
+        frame.game_over_time = game.game_over_time
+        flock = game.flock
+        if copy:
+            frame.x = array('d', flock.x)
+            frame.y = array('d', flock.y)
+            frame.flying = frozenset(flock.flying)
+        else:
+            frame.x, frame.y, frame.flying = flock.x, flock.y, flock.flying
+        return frame
+
+    @classmethod
+    def interpolate(cls, a, b, alpha):
+        """Blend the scalars of two frames (dodos are done by the flock)."""
+        frame = cls()
+        beta = 1 - alpha
+        for name in cls.SCALARS:
+            setattr(frame, name,
+                    getattr(a, name) * beta + getattr(b, name) * alpha)
+        frame.time = b.time
+        frame.x, frame.y, frame.flying = b.x, b.y, b.flying
+        return frame
+
+
+class SimulationThread(threading.Thread):
+    """Steps a game's clock on a worker thread.
+
+    Each step runs with the game lock held and then publishes a copy of
+    the state as a WorldFrame.  The last two frames form a double buffer
+    that the render thread reads without waiting for the simulation.
+    Dodos that moved are collected until the render thread takes them,
+    so dropped frames don't leave sprites behind.
+
+    CPython still runs one thread at a time, but the render thread spends
+    much of a frame in the GL driver with the GIL released, so a slow
+    frame no longer delays the physics.
+    """
+
+    def __init__(self, game):
+        super(SimulationThread, self).__init__(name='simulation')
+        self.daemon = True
+        self.game = game
+        self.tick = game.update_freq
+        self.running = False
+        self.frames = (None, None)
+        self.moved = set()
+        self.publish_lock = threading.Lock()
+
+    def run(self):
+        game = self.game
+        next_tick = time.time()
+        self.running = True
+        while self.running:
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.25:
+                next_tick = time.time() # hopelessly behind; don't catch up
+            next_tick += self.tick
+            with game.lock:
+                game.clock.tick(True)
+                frame = WorldFrame.capture(game, copy=True)
+                moved, game.flock.moved = game.flock.moved, set()
+            with self.publish_lock:
+                self.frames = (self.frames[1], frame)
+                self.moved.update(moved)
+
+    def take_frames(self):
+        """Return the previous and latest frames and the dodos that moved."""
+        with self.publish_lock:
+            moved, self.moved = self.moved, set()
+            return self.frames + (moved, )
+
+    def stop(self):
+        """Stop stepping and wait for the thread to finish.
+
+        The caller may hold the game lock, which the thread needs to
+        finish its step, so waiting lets go of the lock meanwhile.
+        """
+        self.running = False
+        if not self.is_alive():
+            return
+        finished = threading.Condition(self.game.lock)
+        try:
+            while self.is_alive():
+                finished.wait(self.tick) # releases the lock, at any depth
+        except RuntimeError:
+            self.join() # we don't hold the lock
+
+
+class FixedStepper(object):
+    """Steps a game's clock in whole ticks as frames hand it time.
+
+    advance() banks the time a frame took and ticks the clock once per
+    `tick` seconds of it, so the physics always see the same dt however
+    uneven the frames are.  What is left over becomes `alpha`, how far the
+    next tick has got; with `interpolate` the last two ticks are kept as
+    WorldFrames for the renderer to blend, like with a SimulationThread.
+    """
+
+    max_frame = 0.25 # seconds; longer stalls are not caught up on
+
+    def __init__(self, tick, interpolate=True):
+        self.tick = tick
+        self.interpolate = interpolate
+        self.time = 0.0
+        self.clock = pyglet.clock.Clock(time_function=self.now)
+        self.accumulator = 0.0
+        self.frames = (None, None)
+        self.moved = set()
+
+    def now(self):
+        return self.time
+
+    @property
+    def alpha(self):
+        return min(1.0, self.accumulator / self.tick)
+
+    def advance(self, dt, game):
+        self.accumulator += min(dt, self.max_frame)
+        while self.accumulator >= self.tick:
+            self.accumulator -= self.tick
+            self.time += self.tick
+            self.clock.tick(True)
+            if self.interpolate:
+                frame = WorldFrame.capture(game, copy=True)
+                frame.time = self.time
+                self.frames = (self.frames[1], frame)
+                self.moved.update(game.flock.moved)
+                game.flock.moved = set()
+
+    def take_frames(self):
+        """Return the previous and latest frames and the dodos that moved."""
+        moved, self.moved = self.moved, set()
+        return self.frames + (moved, )
+
+
+class FramePacer(object):
+    """Turns the times between presented frames into steady frame times.
+
+    With vsync every frame should take a whole number of refresh
+    intervals, but the time measured between two flips wobbles around it
+    (timer resolution, compositors, the OS waking us up late).  Stepping
+    the game by the raw times makes motion stutter, so frame() snaps a
+    time that is close to a whole number of intervals onto it.  What the
+    snapping shaved off or added is carried over to the next frame, so
+    game time never drifts away from real time; times that are nowhere
+    near a multiple (a dropped frame, a stall) are passed through.
+
+    The refresh interval is the median of recent frame times, rounded to
+    a common refresh rate, unless it is given.  stats() sums up the raw
+    and paced frame times for the diagnostics overlay.
+    """
+
+    window_size = 120 # recent frames kept for the estimate and stats
+    estimate_every = 30 # frames
+    tolerance = 0.2 # of a refresh interval
+    refresh_rates = (240, 165, 144, 120, 100, 90, 85, 75, 60, 50, 30)
+
+    def __init__(self, refresh=None):
+        self.refresh = refresh
+        self.estimate = refresh
+        self.raw = collections.deque(maxlen=self.window_size)
+        self.paced = collections.deque(maxlen=self.window_size)
+        self.carry = 0.0
+        self.frames = 0
+        self.snapped = 0
+        self.last_present = None
+        self.pending = 0.0
+
+    def present(self, now):
+        """Note a buffer flip at time ``now``."""
+        if self.last_present is not None:
+            self.pending += self.frame(now - self.last_present)
+        self.last_present = now
+
+    def take(self):
+        """Return the paced time since the last take()."""
+        dt, self.pending = self.pending, 0.0
+        return dt
+
+    def frame(self, dt):
+        """Return the paced length of a frame that took ``dt`` seconds."""
+        self.raw.append(dt)
+        self.frames += 1
+        if self.refresh is None and self.frames % self.estimate_every == 0:
+            self.estimate = self.estimate_refresh()
+        wanted = dt + self.carry
+        paced = wanted
+        refresh = self.estimate
+        if refresh:
+            snapped = max(1, int(round(wanted / refresh))) * refresh
+            if abs(wanted - snapped) <= refresh * self.tolerance:
+                paced = snapped
+                self.snapped += 1
+        self.carry = wanted - paced
+        self.paced.append(paced)
+        return paced
+
+    def estimate_refresh(self):
+        times = sorted(self.raw)
+        median = times[len(times) // 2]
+        for rate in self.refresh_rates:
+            if abs(median * rate - 1) <= self.tolerance / 2:
+                return 1.0 / rate
+        return None # not running at the refresh rate; don't snap
+
+    def stats(self):
+        """Return (mean ms, raw jitter ms, paced jitter ms, snapped share)."""
+        def deviation(times):
+            mean = sum(times) / len(times)
+            return math.sqrt(sum((t - mean) ** 2 for t in times) / len(times))
+        if not self.raw:
+            return (0.0, 0.0, 0.0, 0.0)
+        return (1000 * sum(self.raw) / len(self.raw),
+                1000 * deviation(self.raw), 1000 * deviation(self.paced),
+                float(self.snapped) / self.frames)
+
+    def report(self):
+        """Return the stats as lines of text."""
+        mean, raw, paced, snapped = self.stats()
+        refresh = self.estimate and '%.0f Hz' % (1 / self.estimate) or '?'
+        return ['pacing: %.1f ms, refresh %s' % (mean, refresh),
+                '  jitter %.2f ms -> %.2f ms, %d%% snapped' % (
+                    raw, paced, 100 * snapped)]
+
+
+class Quality(object):
+    """One step of the adaptive quality ladder."""
+
+    def __init__(self, sea_band_step, cloud_layers, sky, fps_display):
+        self.sea_band_step = sea_band_step
+        self.cloud_layers = cloud_layers
+        self.sky = sky
+        self.fps_display = fps_display
+
+    def apply(self, window):
+        game = window.game
+        game.sea.band_step = self.sea_band_step
+        game.clouds.layers_shown = min(self.cloud_layers, game.clouds.layers)
+        game.sky.visible = self.sky
+        window.show_fps = self.fps_display
+
+
+class QualityController(object):
+    """Picks a quality level that keeps frame times within budget.
+
+    Quality drops one step as soon as the average of the recent frames is
+    over budget.  It only goes back up after frames have been fast enough
+    for `probe_delay` seconds; if that step turns out to be too slow, the
+    delay before the next attempt doubles, so the level doesn't flicker.
+    """
+
+    levels = [
+        Quality(20, 3, True, True),
+        Quality(20, 3, True, False),
+        Quality(30, 2, True, False),
+        Quality(40, 1, True, False),
+        Quality(60, 1, False, False),
+        Quality(80, 0, False, False),
+    ]
+
+    target_fps = 60
+    window_size = 30        # frames averaged before deciding anything
+    slow_ratio = 1.15       # lower quality above this much of the budget
+    fast_ratio = 1.05       # consider raising it below this much
+    min_probe_delay = 5.0   # seconds
+    max_probe_delay = 80.0  # seconds
+
+    def __init__(self):
+        self.level = 0
+        self.frame_times = collections.deque(maxlen=self.window_size)
+        self.since_change = 0
+        self.probe_delay = self.min_probe_delay
+        self.probing = False
+
+    @property
+    def quality(self):
+        return self.levels[self.level]
+
+    def add_frame(self, dt):
+        """Record the duration of a frame; return True if the level changed."""
+        self.frame_times.append(dt)
+        self.since_change += dt
+        if len(self.frame_times) < self.window_size:
+            return False
+        budget = 1.0 / self.target_fps
+        average = sum(self.frame_times) / len(self.frame_times)
+        if average > budget * self.slow_ratio:
+            if self.level + 1 >= len(self.levels):
+                return False
+            if self.probing:
+                self.probe_delay = min(self.probe_delay * 2,
+                                       self.max_probe_delay)
+            self._change(self.level + 1, probing=False)
+            return True
+        if (average < budget * self.fast_ratio and self.level > 0
+            and self.since_change >= self.probe_delay):
+            if self.probing:
+                # the last step up held, so don't be so shy next time
+                self.probe_delay = self.min_probe_delay
+            self._change(self.level - 1, probing=True)
+            return True
+        return False
+
+    def _change(self, level, probing):
+        log.debug('Quality level %d -> %d', self.level, level)
+        self.level = level
+        self.probing = probing
+        self.since_change = 0
+        self.frame_times.clear()
+
+
+class GarbageCollector(object):
+    """Runs the cyclic garbage collector between frames.
+
+    Python 2 has no gc.freeze(), so world_loaded() does one full collection
+    instead, which moves the long-lived world (map tiles, clouds, sprites)
+    into the oldest generation, and switches automatic collection off.
+    From then on end_frame() collects the young generations when enough
+    garbage has piled up, and leaves full collections, which would scan
+    the whole world again, to idle screens unless they become overdue.
+    """
+
+    young_threshold = 700 # net allocations, same as the gc default
+    middle_threshold = 10 # young collections
+    full_threshold = 100 # middle collections, if never idle
+
+    def world_loaded(self):
+        gc.disable()
+        gc.collect()
+
+    def generation_due(self, counts, idle):
+        """Which generation to collect (or None) given gc.get_count()."""
+        young, middle, old = counts
+        if old >= self.full_threshold or (idle and old):
+            return 2
+        if middle >= self.middle_threshold:
+            return 1
+        if young >= self.young_threshold:
+            return 0
+        return None
+
+    def end_frame(self, profiler, idle=False):
+        generation = self.generation_due(gc.get_count(), idle)
+        if generation is None:
+            return
+        start = time.time()
+        gc.collect(generation)
+        profiler.add_gc_pause(generation, time.time() - start)
+
+
+class IdleThrottlingEventLoop(pyglet.app.EventLoop):
+    """Event loop that redraws a window only when its contents changed.
+
+    Windows can define needs_redraw(); windows without it are redrawn on
+    every iteration like with the stock event loop.  When no window needed
+    a redraw the clock is ticked at most every `idle_tick` seconds instead
+    of at the rate of the scheduled update functions.
+    """
+
+    idle_tick = 0.1 # seconds
+
+    def idle(self):
+        pyglet.clock.tick(True)
+        busy = False
+        for window in pyglet.app.windows:
+            needs_redraw = getattr(window, 'needs_redraw', None)
+            if window.invalid or needs_redraw is None or needs_redraw():
+                window.switch_to()
+                window.dispatch_event('on_draw')
+                window.flip()
+                window.invalid = False
+                busy = True
+        sleep_time = pyglet.clock.get_sleep_time(True)
+        if busy:
+            return sleep_time
+        return max(sleep_time, self.idle_tick)
 
 
 class Main(pyglet.window.Window):
 
     fps_display = None
+    show_fps = True
+
+    quality = None
+
+    render_scale = RENDER_SCALE
+    render_target = None
+
+    profiler = diagnostics.NULL_PROFILER
+    overdraw = None
+    collector = None
+    diagnostics_label = None
+    telemetry = None
+    pacer = None
+    pool = None
+    after_input = None # [(func, args)] while an input event is handled
+
+    idle_redraw = 0.5 # seconds; keeps dodo animations alive on idle screens
+
+    # events that change the game, so they must not race the simulation
+    INPUT_EVENTS = ('on_key_press', 'on_key_release', 'on_text_motion',
+                    'on_mouse_drag')
 
     def __init__(self):
+        config = None
+        if DEBUG_VERSION or DIAGNOSTICS:
+            # the overdraw heatmap counts writes in the stencil buffer
+            screen = pyglet.window.get_platform().get_default_display() \
+                .get_default_screen()
+            try:
+                config = screen.get_best_config(
+                    gl.Config(double_buffer=True, stencil_size=8))
+            except pyglet.window.NoSuchConfigException:
+                config = None
         super(Main, self).__init__(width=1024, height=600,
                                    resizable=True,
-                                   caption='Save the Dodos')
+                                   caption='Save the Dodos',
+                                   config=config)
         self.set_minimum_size(320, 200) # does not work on linux with compiz
         self.set_fullscreen()
         self.set_mouse_visible(True)
-        self.set_icon(pyglet.image.load(
-            os.path.join(pyglet.resource.location('Dodo.png').path, 'Dodo.png')))
-        self.game = Game()
+        self.set_icon(load_image_data('Dodo.png'))
+        if TELEMETRY:
+            self.telemetry = telemetry.TelemetryWriter(TELEMETRY_FILE)
+        if TEXTURE_BUDGET is not None:
+            # before the diagnostics counters, which wrap the hook
+            texture_registry.install()
+        self.pool = WorldPool()
+        self.game = self.create_game()
+        if MANUAL_GC:
+            self.collector = GarbageCollector()
+            self.collector.world_loaded()
+        self.game.start()
+        if DIAGNOSTICS:
+            self.toggle_diagnostics()
 
         self.fps_display = pyglet.clock.ClockDisplay()
         self.fps_display.label.y = self.height - 50
         self.fps_display.label.x = self.width - 170
 
+        self.drawn_state = None
+        self.drawn_at = 0
+
+        self.last_frame_at = None
+        if ADAPTIVE_QUALITY:
+            self.quality = QualityController()
+        if FRAME_PACING:
+            self.pacer = FramePacer()
+
+    def create_game(self):
+        started = time.time()
+        game = Game(pool=self.pool)
+        if self.telemetry:
+            self.telemetry.load('game', time.time() - started)
+            game.clock.schedule_interval(self.telemetry.tick,
+                                         game.update_freq)
+        return game
+
     def new_game(self):
-        self.game = Game()
+        self.game.stop(self.pool)
+        if self.telemetry:
+            self.game.clock.unschedule(self.telemetry.tick)
+        self.game = self.create_game()
+        self.game.profiler = self.profiler
+        if self.collector:
+            self.collector.world_loaded()
+        self.game.start()
+        if self.quality:
+            self.quality.quality.apply(self)
+
+    def dispatch_event(self, event_type, *args):
+        game = getattr(self, 'game', None)
+        if game is not None and event_type in self.INPUT_EVENTS:
+            self.after_input = []
+            try:
+                with game.lock:
+                    result = super(Main, self).dispatch_event(event_type,
+                                                              *args)
+            finally:
+                after, self.after_input = self.after_input, None
+            for func, args in after:
+                func(*args)
+            return result
+        return super(Main, self).dispatch_event(event_type, *args)
+
+    def after_locked_input(self, func, *args):
+        """Call func(*args) once the game lock is released.
+
+        Stopping a game waits for its simulation thread, which can't
+        finish a step while an input handler holds the lock.
+        """
+        if self.after_input is None:
+            func(*args)
+        elif (func, args) not in self.after_input:
+            self.after_input.append((func, args))
+
+    def needs_redraw(self):
+        if pyglet.clock.get_default().time() - self.drawn_at > self.idle_redraw:
+            return True
+        return (id(self.game), self.game.view_state()) != self.drawn_state
 
     def on_draw(self):
+        now = pyglet.clock.get_default().time()
+        if self.quality and self.last_frame_at is not None:
+            # idle screens may legitimately be drawn rarely
+            if (not self.game.is_idle
+                and self.quality.add_frame(now - self.last_frame_at)):
+                self.quality.quality.apply(self)
+        if (self.telemetry and self.last_frame_at is not None
+            and not self.game.is_idle):
+            self.telemetry.frame(now - self.last_frame_at, self.game,
+                                 self.profiler)
+        self.last_frame_at = now
+        if self.pacer:
+            self.game.advance(self.pacer.take())
         self.clear()
-        self.game.draw()
-        if self.fps_display:
-            self.fps_display.draw()
+        profiler = self.profiler
+        profiler.begin_frame()
+        if self.overdraw:
+            self.overdraw.begin()
+        target = self.scaled_render_target()
+        if target is None:
+            self.game.draw()
+            self.draw_fps()
+        else:
+            # the frame covers the window, so it's drawn over the sky
+            # colour and replaces the window's pixels without blending
+            with target.drawing(0, 0, self.width, self.height,
+                                clear_color=Sky.clear_color):
+                self.game.draw(hud=not NATIVE_HUD)
+                if not NATIVE_HUD:
+                    self.draw_fps()
+            with profiler.layer('upscale'):
+                target.blit_opaque(0, 0, self.width, self.height)
+            if NATIVE_HUD:
+                self.game.draw_hud()
+                self.draw_fps()
+        if self.overdraw:
+            self.overdraw.end()
+            profiler.overdraw = self.overdraw.read(self.width, self.height)
+            self.overdraw.draw(self.width, self.height)
+        if self.collector:
+            self.collector.end_frame(profiler, self.game.is_idle)
+        profiler.end_frame()
+        texture_registry.end_frame()
+        if self.diagnostics_label:
+            lines = profiler.report()
+            if self.pacer:
+                lines += self.pacer.report()
+            self.diagnostics_label.text = '\n'.join(lines)
+            self.diagnostics_label.draw()
+        self.drawn_state = (id(self.game), self.game.view_state())
+        self.drawn_at = pyglet.clock.get_default().time()
+
+    def flip(self):
+        super(Main, self).flip()
+        if self.pacer:
+            # with vsync this is when the frame reached the screen
+            self.pacer.present(time.time())
+
+    def draw_fps(self):
+        if self.fps_display and self.show_fps:
+            with self.profiler.layer('hud'):
+                self.fps_display.draw()
+
+    def toggle_diagnostics(self):
+        """Cycle between off, draw call counters, and counters with the
+        overdraw heatmap."""
+        if self.profiler is diagnostics.NULL_PROFILER:
+            self.profiler = diagnostics.FrameProfiler()
+            self.profiler.textures = texture_registry
+            instanced = []
+            if self.game.renderer:
+                instanced.append((self.game.renderer, '_draw_instanced'))
+            self.profiler.counter.install(instanced)
+            self.diagnostics_label = pyglet.text.Label(
+                '', font_name='Courier New', font_size=10,
+                x=10, y=self.height - 10, anchor_y='top',
+                multiline=True, width=400)
+        elif (self.overdraw is None
+              and diagnostics.OverdrawView.is_supported()):
+            self.overdraw = diagnostics.OverdrawView()
+        else:
+            self.profiler.counter.uninstall()
+            self.profiler = diagnostics.NULL_PROFILER
+            self.overdraw = None
+            self.diagnostics_label = None
+        self.game.profiler = self.profiler
+        self.invalid = True
+
+    def scaled_render_target(self):
+        """Return the offscreen buffer for RENDER_SCALE, or None."""
+        if self.render_scale >= 1:
+            return None
+        width = max(1, int(self.width * self.render_scale))
+        height = max(1, int(self.height * self.render_scale))
+        target = self.render_target
+        if target is not None and (target.width, target.height) == (width, height):
+            return target
+        if target is not None:
+            target.delete()
+            self.render_target = None
+        if not renderer.RenderTarget.is_supported():
+            log.warning('framebuffer objects not supported, '
+                        'drawing at full resolution')
+            self.render_scale = 1
+            return None
+        try:
+            self.render_target = renderer.RenderTarget(width, height)
+        except renderer.RenderTargetError as e:
+            log.warning('cannot scale rendering: %s', e)
+            self.render_scale = 1
+        return self.render_target
+
+    def on_expose(self):
+        self.invalid = True
+
+    def on_close(self):
+        self.game.stop()
+        if self.telemetry:
+            self.telemetry.close(self.game)
+        super(Main, self).on_close()
 
     def on_text_motion(self, motion):
         if motion == key.LEFT:
@@ -850,6 +2916,22 @@ class Main(pyglet.window.Window):
             # starting new game, closing help screen
             return
 
+        if symbol == key.F3:
+            self.toggle_diagnostics()
+            return
+
+        if SAVE_STATES and symbol in (key.BACKSPACE, key.F5, key.F9):
+            if symbol == key.BACKSPACE:
+                self.game.rewind.rewind()
+            elif symbol == key.F5:
+                savestate.save(self.game, SAVE_FILE)
+            else:
+                try:
+                    savestate.load(self.game, SAVE_FILE)
+                except (IOError, savestate.SnapshotError) as e:
+                    log.warning('cannot load %s: %s', SAVE_FILE, e)
+            return
+
         if DEBUG_VERSION and symbol == key.C:
             self.game.camera.manual_control = True
             return
@@ -858,23 +2940,22 @@ class Main(pyglet.window.Window):
             if self.game.help.help.visible:
                 self.game.help.help.visible = False
             else:
-                self.dispatch_event('on_close')
+                self.after_locked_input(self.dispatch_event, 'on_close')
 
         if symbol == key.F1:
             self.game.help.help.visible = True
         else:
             self.game.help.help.visible = False
 
-        if (self.game.game_is_over
-            and self.game.game_over_time >= self.game.game_over_animation):
-            self.new_game()
+        if self.game.game_over_animation_finished:
+            self.after_locked_input(self.new_game)
 
         if symbol == key.SPACE:
             self.game.dodopult.start_powering_up()
         if symbol in (key.LALT, key.RALT, key.Z):
             self.game.dodopult.try_load()
         if symbol == key.N:
-            self.new_game()
+            self.after_locked_input(self.new_game)
 
         # DEBUG/CHEAT CODES
         if not DEBUG_VERSION:
@@ -889,7 +2970,7 @@ class Main(pyglet.window.Window):
             # -- eradicating a dodo mid-flight won't leave the camera focus
             # stuck on it then
             for dodo in self.game.dodos[::2]:
-                dodo.sprite.visible = False
+                dodo.vanish()
             del self.game.dodos[::2]
         if symbol == key.PLUS:
             self.game.add_dodo()
@@ -915,10 +2996,16 @@ class Main(pyglet.window.Window):
         if self.fps_display:
             self.fps_display.label.y = self.height - 50
             self.fps_display.label.x = self.width - 170
+        if self.diagnostics_label:
+            self.diagnostics_label.y = self.height - 10
+        self.invalid = True
         super(Main, self).on_resize(width, height)
 
     def run(self):
-        pyglet.app.run()
+        if EVENT_DRIVEN_REDRAW and not FRAME_PACING:
+            IdleThrottlingEventLoop().run()
+        else:
+            pyglet.app.run()
 
 
 def main():
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+Differential fuzzing of Dodopult's physics and map queries.
+
+    python fuzz.py [--cases N] [--seed S] [--target NAME ...]
+
+Faster versions of Dodo.update(), Map.ground_level() and the wall queries
+have to behave exactly like the code they replace.  This keeps frozen
+copies of that code (the reference_* functions below) and runs random maps
+and launch states through both the reference and what the game uses now,
+and through autoplay.Heightmap, which answers the same questions its own
+way.  Results have to agree within TOLERANCE, including which exception is
+raised, if any.
+
+A mismatch is shrunk (fewer map rows and columns, rounder numbers) for as
+long as it keeps failing, and printed as a case to paste into tests.py.
+
+Change the reference functions only when the game's behaviour is meant to
+change.
+"""
+import os
+import sys
+import math
+import random
+from optparse import OptionParser
+
+
+TOLERANCE = 1e-6
+
+TILE_WIDTH = TILE_HEIGHT = 100 # what Map uses
+
+
+# --- the reference implementations ---
+
+def parse(rows):
+    """Map rows, top first, as Map keeps them (bottom first)."""
+    return '\n'.join(rows).splitlines()[::-1]
+
+
+def reference_ground_level(lines, x):
+    col = int(x / TILE_WIDTH)
+    y = 0
+    for line in lines:
+        if line[col:col+1].isspace():
+            break
+        y += TILE_HEIGHT
+    return y
+
+
+def reference_wall_left_of(lines, x):
+    col = int(x / TILE_WIDTH)
+    ground = reference_ground_level(lines, x)
+    while x > 0 and reference_ground_level(lines, x) >= ground:
+        col -= 1
+        x -= TILE_WIDTH
+    return (col + 1) * TILE_WIDTH
+
+
+def reference_wall_right_of(lines, x):
+    map_width = max(map(len, lines)) * TILE_WIDTH
+    col = int(x / TILE_WIDTH) + 1
+    ground = reference_ground_level(lines, x)
+    while x < map_width and reference_ground_level(lines, x) <= ground:
+        col += 1
+        x += TILE_WIDTH
+    return (col - 1) * TILE_WIDTH
+
+
+def reference_update(lines, x, y, dx, dy, dt, gravity, air_resistance):
+    """One Dodo.update(); returns (x, y, dx, dy, alive)."""
+    # positions are stored in arrays of doubles, hence the float()s
+    alive = True
+    dt = dt * 3
+    if dx or dy:
+        # exact solution: constant pull down, exponential drag sideways
+        if air_resistance:
+            ddx = dx * (1 - math.exp(-air_resistance * dt)) / air_resistance
+        else:
+            ddx = dx * dt
+        ddy = dy * dt - gravity * dt * dt / 2
+        x = float(x + ddx)
+        y = float(y + ddy)
+        ground_level = reference_ground_level(lines, x)
+        if y < ground_level:
+            wall_x = reference_wall_left_of(lines, x)
+            if wall_x < x - ddx:
+                wall_x = x - ddx
+            if y - ddy >= ground_level:
+                x1 = x - ddx + (ground_level - y + ddy) * ddx / ddy
+                y1 = ground_level
+            else:
+                x1 = y1 = None
+            if x - ddx <= wall_x:
+                y2 = y - ddy + (wall_x - x + ddx) * ddy / ddx
+                x2 = wall_x
+                if y2 > ground_level:
+                    x2 = y2 = None
+                if x1 is not None and x1 < wall_x:
+                    x1 = y1 = None
+            else:
+                x2 = y2 = None
+            if x1 is None:
+                x, y = float(x2), float(y2)
+                alive = False
+            else:
+                x, y = float(x1), float(y1)
+            dx = dy = 0.0
+        else:
+            dy = float(dy - gravity * dt)
+            dx = float(dx * math.exp(-air_resistance * dt))
+    return x, y, dx, dy, alive
+
+
+def reference_landing(lines, x, y, angle, power, gravity, air_resistance,
+                      dt, max_steps):
+    """Step a shot until it drops below ground: (x, ground, from_above)."""
+    step = dt * 3
+    rad = math.radians(angle)
+    dx, dy = power * math.cos(rad), power * math.sin(rad)
+    px = py = 0.0
+    prev_y = y
+    for i in range(max_steps):
+        if py <= -2000:
+            break
+        if air_resistance:
+            px += dx * (1 - math.exp(-air_resistance * step)) / air_resistance
+        else:
+            px += dx * step
+        py += dy * step - gravity * step * step / 2
+        ground = reference_ground_level(lines, x + px)
+        if y + py < ground:
+            return x + px, ground, prev_y >= ground
+        prev_y = y + py
+        dy -= gravity * step
+        dx *= math.exp(-air_resistance * step)
+    return None
+
+
+# --- what the game uses now ---
+
+def load_game():
+    import dodo
+    return dodo
+
+
+class _Camera(object):
+
+    def focus_on(self, obj):
+        pass
+
+    def remove_focus(self, obj):
+        pass
+
+
+class _Clock(object):
+
+    def schedule_once(self, func, delay):
+        pass
+
+
+class FuzzGame(object):
+    """Just enough of a game for a Map and a Dodo."""
+
+    headless = True
+    dodo_batch = None
+    dodo_group = None
+    camera = _Camera()
+    clock = _Clock()
+    gravity = 200.0
+    air_resistance = 0.14
+
+    def __init__(self, rows):
+        self.game_map = load_game().Map(self, '\n'.join(rows))
+
+    def defer(self, func, *args):
+        func(*args)
+
+    def emit_particles(self, *args, **kw):
+        pass
+
+    def count_surviving_dodos(self, dt=None):
+        pass
+
+
+def game_update(rows, x, y, dx, dy, dt):
+    game = FuzzGame(rows)
+    dodo = load_game().Dodo(game)
+    dodo.x, dodo.y, dodo.dx, dodo.dy = x, y, dx, dy
+    dodo.update(dt)
+    return dodo.x, dodo.y, dodo.dx, dodo.dy, dodo.is_alive
+
+
+# --- targets ---
+
+def coordinate(rng, limit):
+    """A random coordinate, often right on a tile edge."""
+    edge = rng.randint(-1, int(limit / TILE_WIDTH) + 1) * TILE_WIDTH
+    return rng.choice([edge, edge + rng.choice([-1e-9, 1e-9, 0.5, -0.5]),
+                       round(rng.uniform(-TILE_WIDTH, limit + TILE_WIDTH), 2)])
+
+
+def velocity(rng):
+    return rng.choice([0.0, rng.randint(-5, 5) * 10.0,
+                       round(rng.uniform(-400, 400), 3)])
+
+
+def random_rows(rng):
+    """A small map, with ragged row ends and holes like map.txt's."""
+    heights = [rng.randint(0, 7) for col in range(rng.randint(1, 10))]
+    rows = []
+    for row in range(max(heights) + rng.randint(0, 2), 0, -1):
+        line = [height >= row and '#' or ' ' for height in heights]
+        if rng.random() < 0.2:
+            line[rng.randrange(len(line))] = ' '
+        line = ''.join(line)
+        if rng.random() < 0.2:
+            line = line[:rng.randint(0, len(line))]
+        rows.append(line)
+    if not rows or not rows[-1].strip():
+        rows.append('#' * len(heights))
+    return rows
+
+
+class Target(object):
+    """Something to compare: how to make cases and run both versions.
+
+    Subclasses define random_case(rng), which returns a case dict, and
+    reference(case) and optimized(case), which return what the two
+    versions make of it.
+    """
+
+    fields = ()
+    seeds = ()
+
+
+class GroundLevel(Target):
+
+    fields = ('x', )
+
+    def random_case(self, rng):
+        rows = random_rows(rng)
+        return dict(rows=rows, x=coordinate(rng, len(rows[-1]) * TILE_WIDTH))
+
+    def reference(self, case):
+        return reference_ground_level(parse(case['rows']), case['x'])
+
+    def optimized(self, case):
+        return FuzzGame(case['rows']).game_map.ground_level(case['x'])
+
+
+class Walls(GroundLevel):
+
+    def reference(self, case):
+        lines = parse(case['rows'])
+        return (reference_wall_left_of(lines, case['x']),
+                reference_wall_right_of(lines, case['x']))
+
+    def optimized(self, case):
+        game_map = FuzzGame(case['rows']).game_map
+        return (game_map.vertical_wall_left_of(case['x']),
+                game_map.vertical_wall_right_of(case['x']))
+
+
+class Update(Target):
+
+    fields = ('x', 'y', 'dx', 'dy', 'dt')
+
+    # the crashes in tests.py: hitting a wall right at its edge, and
+    # launching from inside it
+    _cliff = ['        ##'] * 2 + ['##########'] * 7
+    seeds = [dict(rows=_cliff, x=800.0, y=695.0, dx=50.0, dy=50.0, dt=1.0),
+             dict(rows=_cliff, x=801.0, y=695.0, dx=50.0, dy=50.0, dt=1.0),
+             dict(rows=_cliff, x=780.0, y=740.0, dx=10.0, dy=-10.0, dt=1.0)]
+
+    def random_case(self, rng):
+        rows = random_rows(rng)
+        return dict(rows=rows, x=coordinate(rng, len(rows[-1]) * TILE_WIDTH),
+                    y=coordinate(rng, len(rows) * TILE_HEIGHT),
+                    dx=velocity(rng), dy=velocity(rng),
+                    dt=rng.choice([1 / 60., 1 / 30., 0.1, 1.0]))
+
+    def reference(self, case):
+        return reference_update(parse(case['rows']), case['x'], case['y'],
+                                case['dx'], case['dy'], case['dt'],
+                                FuzzGame.gravity, FuzzGame.air_resistance)
+
+    def optimized(self, case):
+        return game_update(case['rows'], case['x'], case['y'], case['dx'],
+                           case['dy'], case['dt'])
+
+
+class Landing(Target):
+    """autoplay's bisecting Heightmap against plain stepping."""
+
+    fields = ('x', 'y', 'angle', 'power')
+
+    def random_case(self, rng):
+        rows = random_rows(rng)
+        return dict(rows=rows,
+                    x=round(rng.uniform(0, len(rows[-1]) * TILE_WIDTH), 2),
+                    y=round(rng.uniform(0, (len(rows) + 2) * TILE_HEIGHT), 2),
+                    angle=rng.randint(15, 75),
+                    power=rng.choice([200.0, 1000.0,
+                                      round(rng.uniform(200, 1000), 1)]))
+
+    def reference(self, case):
+        return reference_landing(parse(case['rows']), case['x'], case['y'],
+                                 case['angle'], case['power'],
+                                 FuzzGame.gravity, FuzzGame.air_resistance,
+                                 1 / 60., 600)
+
+    def optimized(self, case):
+        import autoplay
+        table = autoplay.ShotTable(FuzzGame.gravity, FuzzGame.air_resistance,
+                                   1 / 60., [case['angle']], [case['power']])
+        heightmap = autoplay.Heightmap(FuzzGame(case['rows']).game_map)
+        return heightmap.landing(table.paths[0], case['x'], case['y'])
+
+
+TARGETS = dict(ground_level=GroundLevel(), walls=Walls(), update=Update(),
+               landing=Landing())
+
+
+# --- comparing and shrinking ---
+
+def outcome(func, case):
+    try:
+        return func(case)
+    except Exception as e:
+        return ('error', type(e).__name__)
+
+
+def same(a, b):
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if (isinstance(a, float) or isinstance(b, float)) and not (
+            isinstance(a, bool) or isinstance(b, bool)):
+        try:
+            return abs(a - b) <= TOLERANCE * max(1.0, abs(a), abs(b))
+        except TypeError:
+            return False
+    return a == b
+
+
+def mismatch(target, case):
+    """Return (reference, optimized) if they disagree on case, else None."""
+    expected = outcome(target.reference, case)
+    got = outcome(target.optimized, case)
+    if same(expected, got):
+        return None
+    return expected, got
+
+
+def size(case):
+    rows = case['rows']
+    return (len(rows) + sum(map(len, rows)),
+            sum(len(repr(value)) for name, value in case.items()
+                if name != 'rows'),
+            sum(abs(value) for name, value in case.items() if name != 'rows'))
+
+
+def simpler(target, case):
+    """Cases a little simpler than case."""
+    rows = case['rows']
+    if len(rows) > 1:
+        yield dict(case, rows=rows[1:]) # top row
+        yield dict(case, rows=rows[:-1]) # bottom row
+    width = max(map(len, rows))
+    if width > 1:
+        yield dict(case, rows=[row[:width - 1] for row in rows])
+        shifted = dict(case, rows=[row[1:] for row in rows])
+        if 'x' in case:
+            shifted['x'] = case['x'] - TILE_WIDTH
+        yield shifted
+    for n, row in enumerate(rows):
+        if row != row.rstrip():
+            yield dict(case, rows=rows[:n] + [row.rstrip()] + rows[n + 1:])
+    for name in target.fields:
+        value = case[name]
+        for simple in (0, int(value), round(value, 1), round(value, -1),
+                       value / 2):
+            if simple != value:
+                yield dict(case, **{name: type(value)(simple)})
+
+
+def shrink(target, case, max_attempts=5000):
+    """Simplify a failing case for as long as it keeps failing."""
+    attempts = 0
+    progress = True
+    while progress and attempts < max_attempts:
+        progress = False
+        for candidate in simpler(target, case):
+            attempts += 1
+            if size(candidate) < size(case) and mismatch(target, candidate):
+                case = candidate
+                progress = True
+                break
+    return case
+
+
+def describe(name, case, result):
+    lines = ['%s: the reference and the game disagree on' % name,
+             '    rows = [']
+    lines.extend('        %r,' % row for row in case['rows'])
+    lines.append('    ]')
+    for field in TARGETS[name].fields:
+        lines.append('    %s = %r' % (field, case[field]))
+    lines.append('  reference: %r' % (result[0], ))
+    lines.append('  game:      %r' % (result[1], ))
+    return lines
+
+
+def fuzz(name, cases, seed):
+    """Run a target; return the shrunk failing case, or None."""
+    target = TARGETS[name]
+    rng = random.Random(seed)
+    for n in range(len(target.seeds) + cases):
+        if n < len(target.seeds):
+            case = target.seeds[n]
+        else:
+            case = target.random_case(rng)
+        if mismatch(target, case):
+            return shrink(target, case)
+    return None
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--cases', type='int', default=2000,
+                      help='random cases per target [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [default: %default]')
+    parser.add_option('--target', action='append', choices=sorted(TARGETS),
+                      help='only this target (%s)' % ', '.join(sorted(TARGETS)))
+    opts, args = parser.parse_args()
+    # before dodo (and so pyglet) is imported
+    os.environ['DODOPULT_HEADLESS'] = '1'
+    failed = False
+    for name in opts.target or sorted(TARGETS):
+        case = fuzz(name, opts.cases, opts.seed)
+        if case is None:
+            print('%s: %d cases agree' % (name, opts.cases))
+        else:
+            failed = True
+            for line in describe(name, case, mismatch(TARGETS[name], case)):
+                print(line)
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Cheap particle effects for Dodopult.
+
+Particles live in flat, preallocated arrays, one set per `ParticleKind`,
+and never allocate while the game runs.  A kind is stepped in a single
+pass over its arrays and drawn with a single glDrawArrays call, straight
+from the same arrays.  The whole system shares a hard budget: particles
+that don't fit are simply not emitted, so a flock drowning at once costs
+no more than a few feathers do.
+
+Alternatively the particles can be added to a pyglet batch with attach();
+dead particles are then drawn fully transparent.
+"""
+import math
+import random
+from array import array
+
+import pyglet
+from pyglet import gl
+
+
+class ParticleKind(object):
+    """How particles of one kind look and move."""
+
+    def __init__(self, name, color, size=3.0, lifetime=(0.5, 1.0),
+                 speed=(20.0, 60.0), spread=180.0, gravity=0.0, drag=1.0):
+        self.name = name
+        self.color = color       # (r, g, b, a) bytes; alpha fades to 0
+        self.size = size         # pixels
+        self.lifetime = lifetime # seconds, (min, max)
+        self.speed = speed       # pixels per second, (min, max)
+        self.spread = spread     # degrees either side of the direction
+        self.gravity = gravity   # pixels per second squared
+        self.drag = drag         # fraction of velocity kept after a second
+
+
+class Emitter(object):
+    """Storage and stepping for the live particles of one kind."""
+
+    def __init__(self, kind, capacity):
+        self.kind = kind
+        self.capacity = capacity
+        self.count = 0
+        self.xy = array('f', [0.0]) * (capacity * 2)
+        self.velocity = array('f', [0.0]) * (capacity * 2)
+        self.age = array('f', [0.0]) * capacity
+        self.lifetime = array('f', [0.0]) * capacity
+        self.rgba = array('B', kind.color[:3] + (0, )) * capacity
+        self.vertex_list = None
+
+    def emit(self, x, y, n, direction, velocity):
+        kind = self.kind
+        xy, v = self.xy, self.velocity
+        base_dx, base_dy = velocity
+        for i in range(self.count, self.count + n):
+            angle = math.radians(direction +
+                                 random.uniform(-kind.spread, kind.spread))
+            speed = random.uniform(*kind.speed)
+            xy[2 * i] = x
+            xy[2 * i + 1] = y
+            v[2 * i] = base_dx + math.cos(angle) * speed
+            v[2 * i + 1] = base_dy + math.sin(angle) * speed
+            self.age[i] = 0.0
+            self.lifetime[i] = random.uniform(*kind.lifetime)
+            self.rgba[4 * i + 3] = kind.color[3]
+        self.count += n
+        self.upload()
+
+    def update(self, dt):
+        kind = self.kind
+        xy, v, age, lifetime, rgba = (self.xy, self.velocity, self.age,
+                                      self.lifetime, self.rgba)
+        keep = kind.drag ** dt
+        fall = kind.gravity * dt
+        alpha = kind.color[3]
+        n = self.count
+        i = 0
+        while i < n:
+            a = age[i] + dt
+            if a >= lifetime[i]:
+                # move the last live particle into the hole
+                n -= 1
+                xy[2 * i:2 * i + 2] = xy[2 * n:2 * n + 2]
+                v[2 * i:2 * i + 2] = v[2 * n:2 * n + 2]
+                age[i] = age[n]
+                lifetime[i] = lifetime[n]
+                rgba[4 * i + 3] = rgba[4 * n + 3]
+                continue
+            age[i] = a
+            dx = v[2 * i] * keep
+            dy = v[2 * i + 1] * keep - fall
+            v[2 * i] = dx
+            v[2 * i + 1] = dy
+            xy[2 * i] += dx * dt
+            xy[2 * i + 1] += dy * dt
+            rgba[4 * i + 3] = int(alpha * (1 - a / lifetime[i]))
+            i += 1
+        for i in range(n, self.count):
+            rgba[4 * i + 3] = 0
+        self.count = n
+        self.upload()
+
+    def clear(self):
+        for i in range(self.count):
+            self.rgba[4 * i + 3] = 0
+        self.count = 0
+        self.upload()
+
+    def attach(self, batch, group):
+        self.vertex_list = batch.add(self.capacity, gl.GL_POINTS, group,
+                                     'v2f/stream', 'c4B/stream')
+        self.upload()
+
+    def upload(self):
+        if self.vertex_list is not None:
+            self.vertex_list.vertices[:] = self.xy
+            self.vertex_list.colors[:] = self.rgba
+
+    def draw(self):
+        if not self.count:
+            return
+        gl.glPointSize(self.kind.size)
+        gl.glVertexPointer(2, gl.GL_FLOAT, 0, self.xy.buffer_info()[0])
+        gl.glColorPointer(4, gl.GL_UNSIGNED_BYTE, 0,
+                          self.rgba.buffer_info()[0])
+        gl.glDrawArrays(gl.GL_POINTS, 0, self.count)
+
+
+class ParticleSystem(object):
+    """All particle effects of a game, within a shared budget."""
+
+    def __init__(self, kinds, budget=500):
+        self.budget = budget
+        self.steps = 0 # updates that moved at least one particle
+        self.emitters = {}
+        self.order = []
+        for kind in kinds:
+            self.emitters[kind.name] = Emitter(kind, budget)
+            self.order.append(self.emitters[kind.name])
+
+    @property
+    def live(self):
+        return sum(emitter.count for emitter in self.order)
+
+    def emit(self, name, x, y, n, direction=90.0, velocity=(0.0, 0.0)):
+        """Emit up to n particles; returns how many fit into the budget."""
+        n = max(0, min(n, self.budget - self.live))
+        if n:
+            self.emitters[name].emit(x, y, n, direction, velocity)
+        return n
+
+    def update(self, dt):
+        if not self.live:
+            return
+        self.steps += 1
+        for emitter in self.order:
+            if emitter.count:
+                emitter.update(dt)
+
+    def clear(self):
+        for emitter in self.order:
+            emitter.clear()
+
+    def attach(self, batch, parent=None):
+        """Draw the particles as part of ``batch`` instead of with draw()."""
+        for emitter in self.order:
+            emitter.attach(batch, PointGroup(emitter.kind.size, parent))
+
+    def draw(self):
+        if not self.live:
+            return
+        gl.glPushClientAttrib(gl.GL_CLIENT_VERTEX_ARRAY_BIT)
+        gl.glPushAttrib(gl.GL_ENABLE_BIT | gl.GL_POINT_BIT |
+                        gl.GL_COLOR_BUFFER_BIT | gl.GL_CURRENT_BIT)
+        try:
+            gl.glDisable(gl.GL_TEXTURE_2D)
+            gl.glEnable(gl.GL_BLEND)
+            gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+            gl.glEnable(gl.GL_POINT_SMOOTH)
+            gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+            gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+            for emitter in self.order:
+                emitter.draw()
+        finally:
+            gl.glPopAttrib()
+            gl.glPopClientAttrib()
+
+
+class PointGroup(pyglet.graphics.Group):
+    """Round, blended, untextured points of the given size."""
+
+    def __init__(self, size, parent=None):
+        super(PointGroup, self).__init__(parent)
+        self.size = size
+
+    def set_state(self):
+        gl.glPushAttrib(gl.GL_ENABLE_BIT | gl.GL_POINT_BIT |
+                        gl.GL_COLOR_BUFFER_BIT)
+        gl.glDisable(gl.GL_TEXTURE_2D)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.glEnable(gl.GL_POINT_SMOOTH)
+        gl.glPointSize(self.size)
+
+    def unset_state(self):
+        gl.glPopAttrib()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Offscreen rendering benchmark and golden image checks for Dodopult.
+
+    python renderbench.py [--frames 100] [--enable INSTANCED_RENDERER]
+                          [--json after.json] [--baseline before.json]
+
+Sets up a game for each of the SCENES (a seeded game stepped on a manual
+clock through a scripted bit of play, so the picture is the same on every
+run), draws it into a framebuffer object of a hidden window ``--frames``
+times with a timed `diagnostics.FrameProfiler`, and prints how long each
+layer of Game.draw() took.  The last frame of each scene is read back and
+compared with golden/<scene>.png: a pixel differs if any channel is off
+by more than --threshold, and a scene fails if more than --tolerance of
+its pixels differ.  Failing scenes leave golden/<scene>.new.png and a
+golden/<scene>.diff.png showing where, and the exit status is 1.
+
+Golden images that don't exist yet are recorded; --update records all of
+them again (after a change that is meant to look different).  They depend
+on the GL implementation, so record and check them on the same one; a
+software rasterizer under a virtual display works on machines without a
+GPU:
+
+    xvfb-run -s '-screen 0 1024x768x24' python renderbench.py
+
+--enable switches on one of the feature flags at the top of dodo.py, so an
+optimization can be checked against the same golden images; --json saves
+the timings and --baseline prints the speedup over a saved run.
+"""
+import os
+import sys
+import json
+import random
+import timeit
+from array import array
+from optparse import OptionParser
+
+import pyglet
+from pyglet import gl
+
+import dodo
+import renderer
+import diagnostics
+import autoplay
+
+
+WIDTH, HEIGHT = 800, 480
+TICK = 1 / 60.
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'golden')
+
+
+def step(game, stepper, seconds):
+    """Run the game for ``seconds`` of game time."""
+    for n in range(int(round(seconds / TICK))):
+        stepper.advance(TICK, game)
+
+
+def load_a_dodo(game, stepper):
+    for n in range(600):
+        if game.dodopult.payload is not None:
+            return
+        autoplay.walk_to_nearest_dodo(game)
+        step(game, stepper, TICK)
+
+
+def scene_start(game, stepper):
+    step(game, stepper, 1.0)
+
+
+def scene_help(game, stepper):
+    game.help.help.visible = True
+    step(game, stepper, 1.0)
+
+
+def scene_aiming(game, stepper):
+    load_a_dodo(game, stepper)
+    for n in range(8):
+        game.dodopult.aim_up()
+    game.dodopult.start_powering_up()
+    step(game, stepper, 1.5)
+
+
+def scene_flight(game, stepper):
+    scene_aiming(game, stepper)
+    game.dodopult.fire()
+    step(game, stepper, 4 * TICK) # the first cliff is close
+
+
+def scene_flood(game, stepper):
+    step(game, stepper, 1.0)
+    game.sea.level = game.current_level.height - 40
+
+
+def scene_later_level(game, stepper):
+    game.next_level()
+    game.next_level()
+    step(game, stepper, 3.0)
+
+
+def scene_game_over(game, stepper):
+    game.game_over()
+    step(game, stepper, game.game_over_animation / 2)
+
+
+def scene_game_over_end(game, stepper):
+    game.game_over()
+    step(game, stepper, game.game_over_animation + 1.0)
+
+
+SCENES = [
+    ('start', scene_start),
+    ('help', scene_help),
+    ('aiming', scene_aiming),
+    ('flight', scene_flight),
+    ('flood', scene_flood),
+    ('level3', scene_later_level),
+    ('gameover', scene_game_over),
+    ('gameover-end', scene_game_over_end),
+]
+
+
+def build(setup, seed=0):
+    """Return a game set up for a scene."""
+    random.seed(seed)
+    # the game only moves when the scene steps it
+    stepper = dodo.FixedStepper(TICK, interpolate=False)
+    game = dodo.Game(clock=stepper.clock)
+    game.animator.time = stepper.now
+    game.help.help.visible = False
+    setup(game, stepper)
+    return game
+
+
+def read_pixels(width, height):
+    """Return the RGBA pixels of the bound framebuffer, bottom row first."""
+    data = (gl.GLubyte * (width * height * 4))()
+    gl.glPushClientAttrib(gl.GL_CLIENT_PIXEL_STORE_BIT)
+    gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+    gl.glReadPixels(0, 0, width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                    data)
+    gl.glPopClientAttrib()
+    return pyglet.image.ImageData(width, height, 'RGBA',
+                                  buffer(data)[:], width * 4)
+
+
+def load_golden(filename, width, height):
+    """Return the RGBA pixels of a golden image, or None if it is missing
+    or a different size."""
+    if not os.path.exists(filename):
+        return None
+    image = pyglet.image.load(filename).get_image_data()
+    if (image.width, image.height) != (width, height):
+        return None
+    return image.get_data('RGBA', width * 4)
+
+
+def compare(data, reference, threshold):
+    """Compare two RGBA images of the same size.
+
+    Returns the indices of the pixels that differ by more than
+    ``threshold`` in any channel, and the largest difference seen.
+    """
+    if data == reference:
+        return [], 0
+    a, b = array('B', data), array('B', reference)
+    differing = []
+    worst = 0
+    for i in range(0, len(a), 4):
+        diff = max(abs(a[i] - b[i]), abs(a[i + 1] - b[i + 1]),
+                   abs(a[i + 2] - b[i + 2]), abs(a[i + 3] - b[i + 3]))
+        if diff > threshold:
+            differing.append(i // 4)
+        worst = max(worst, diff)
+    return differing, worst
+
+
+def diff_image(data, differing, width, height):
+    """The image dimmed to a quarter, with differing pixels in red."""
+    pixels = array('B', [value // 4 for value in array('B', data)])
+    for n in differing:
+        pixels[n * 4:n * 4 + 4] = array('B', (255, 0, 0, 255))
+    return pyglet.image.ImageData(width, height, 'RGBA', pixels.tostring(),
+                                  width * 4)
+
+
+def run_scene(setup, target, frames):
+    """Draw a scene; return (mean seconds per layer, last frame)."""
+    game = build(setup)
+    profiler = diagnostics.FrameProfiler(timed=True)
+    game.profiler = profiler
+    totals = {}
+    order = []
+    warmup = 5
+    image = None
+    for n in range(warmup + frames):
+        profiler.begin_frame()
+        started = timeit.default_timer()
+        with target.drawing(0, 0, WIDTH, HEIGHT,
+                            clear_color=dodo.Sky.clear_color):
+            game.draw()
+            gl.glFinish()
+            elapsed = timeit.default_timer() - started
+            if n == warmup + frames - 1:
+                image = read_pixels(WIDTH, HEIGHT)
+        profiler.end_frame()
+        if n < warmup:
+            continue # textures are uploaded, caches fill
+        for layer in profiler.order:
+            if layer in profiler.times:
+                if layer not in totals:
+                    order.append(layer)
+                totals[layer] = totals.get(layer, 0.0) + profiler.times[layer]
+        totals['frame'] = totals.get('frame', 0.0) + elapsed
+    game.stop()
+    means = [(layer, totals[layer] / frames) for layer in order + ['frame']]
+    return means, image
+
+
+def check_golden(name, image, opts):
+    """Compare a frame with its golden image; return a status word."""
+    filename = os.path.join(GOLDEN_DIR, name + '.png')
+    data = image.get_data('RGBA', WIDTH * 4)
+    reference = None
+    if not opts.update:
+        reference = load_golden(filename, WIDTH, HEIGHT)
+    if reference is None:
+        if not os.path.isdir(GOLDEN_DIR):
+            os.makedirs(GOLDEN_DIR)
+        image.save(filename)
+        return 'recorded'
+    differing, worst = compare(data, reference, opts.threshold)
+    if len(differing) <= opts.tolerance * WIDTH * HEIGHT:
+        return 'ok'
+    image.save(os.path.join(GOLDEN_DIR, name + '.new.png'))
+    diff_image(data, differing, WIDTH, HEIGHT).save(
+        os.path.join(GOLDEN_DIR, name + '.diff.png'))
+    return 'FAILED (%d pixels, up to %d off)' % (len(differing), worst)
+
+
+def enable_flag(option, opt_str, value, parser):
+    if not value.isupper() or not isinstance(getattr(dodo, value, None),
+                                             bool):
+        parser.error('%s expects one of the feature flags in dodo.py'
+                     % opt_str)
+    setattr(dodo, value, True)
+    parser.values.flags.append(value)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [scene ...]')
+    parser.set_defaults(flags=[])
+    parser.add_option('--frames', type='int', default=100,
+                      help='frames timed per scene [default: %default]')
+    parser.add_option('--enable', action='callback', callback=enable_flag,
+                      type='string', metavar='FLAG',
+                      help='switch on a feature flag of dodo.py')
+    parser.add_option('--threshold', type='int', default=8,
+                      help='channel difference that makes a pixel differ '
+                      '[default: %default]')
+    parser.add_option('--tolerance', type='float', default=0.001,
+                      help='share of pixels that may differ '
+                      '[default: %default]')
+    parser.add_option('--update', action='store_true',
+                      help='record all golden images again')
+    parser.add_option('--json', metavar='FILE',
+                      help='save the timings here')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='compare the timings with a saved run')
+    opts, args = parser.parse_args()
+    if opts.frames < 1:
+        parser.error('--frames must be at least 1')
+    scenes = [(name, setup) for name, setup in SCENES
+              if not args or name in args]
+    if not scenes:
+        parser.error('scenes: %s' % ', '.join(name for name, s in SCENES))
+
+    dodo.window = pyglet.window.Window(WIDTH, HEIGHT, visible=False)
+    if not renderer.RenderTarget.is_supported():
+        sys.exit('framebuffer objects are not supported by this driver')
+    target = renderer.RenderTarget(WIDTH, HEIGHT)
+    baseline = {}
+    if opts.baseline:
+        f = open(opts.baseline)
+        try:
+            baseline = json.load(f)['scenes']
+        finally:
+            f.close()
+
+    print('%s, %s' % (gl.gl_info.get_renderer(),
+                      ' '.join(opts.flags) or 'default flags'))
+    results = {}
+    failed = False
+    for name, setup in scenes:
+        means, image = run_scene(setup, target, opts.frames)
+        status = check_golden(name, image, opts)
+        failed = failed or status.startswith('FAILED')
+        results[name] = dict(means)
+        print('%s: %s' % (name, status))
+        for layer, seconds in means:
+            line = '    %-10s %7.3f ms' % (layer, seconds * 1000)
+            before = baseline.get(name, {}).get(layer)
+            if before and seconds:
+                line += '  %5.2fx' % (before / seconds)
+            print(line)
+    if opts.json:
+        f = open(opts.json, 'w')
+        try:
+            json.dump(dict(flags=opts.flags, frames=opts.frames,
+                           renderer=gl.gl_info.get_renderer(),
+                           scenes=results), f, indent=1)
+        finally:
+            f.close()
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""
+Optional OpenGL rendering paths for Dodopult.
+
+The game draws everything with plain pyglet sprites and batches.  The code
+in here is only used when one of the switches at the top of dodo.py turns
+it on, and every entry point degrades to ``None`` when the driver lacks the
+required extensions, so callers can always fall back to the batches.
+"""
+import array
+import ctypes
+import logging
+from contextlib import contextmanager
+
+import pyglet
+from pyglet import gl
+
+
+log = logging.getLogger('dodo.renderer')
+
+
+class ShaderError(Exception):
+    pass
+
+
+class RenderTargetError(Exception):
+    pass
+
+
+def _c_string(text):
+    return ctypes.cast(ctypes.c_char_p(text), ctypes.POINTER(gl.GLchar))
+
+
+class ShaderProgram(object):
+    """A linked GLSL program with cached uniform locations."""
+
+    def __init__(self, vertex_source, fragment_source, attributes=()):
+        self.id = gl.glCreateProgram()
+        shaders = [self._compile(gl.GL_VERTEX_SHADER, vertex_source),
+                   self._compile(gl.GL_FRAGMENT_SHADER, fragment_source)]
+        for shader in shaders:
+            gl.glAttachShader(self.id, shader)
+        for index, name in enumerate(attributes):
+            gl.glBindAttribLocation(self.id, index, _c_string(name))
+        gl.glLinkProgram(self.id)
+        status = gl.GLint()
+        gl.glGetProgramiv(self.id, gl.GL_LINK_STATUS, ctypes.byref(status))
+        if not status.value:
+            raise ShaderError(self._info_log(gl.glGetProgramiv,
+                                             gl.glGetProgramInfoLog, self.id))
+        for shader in shaders:
+            gl.glDeleteShader(shader)
+        self._uniforms = {}
+
+    def _compile(self, kind, source):
+        shader = gl.glCreateShader(kind)
+        src = ctypes.c_char_p(source)
+        gl.glShaderSource(shader, 1,
+                          ctypes.cast(ctypes.pointer(src),
+                                      ctypes.POINTER(ctypes.POINTER(gl.GLchar))),
+                          None)
+        gl.glCompileShader(shader)
+        status = gl.GLint()
+        gl.glGetShaderiv(shader, gl.GL_COMPILE_STATUS, ctypes.byref(status))
+        if not status.value:
+            raise ShaderError(self._info_log(gl.glGetShaderiv,
+                                             gl.glGetShaderInfoLog, shader))
+        return shader
+
+    @staticmethod
+    def _info_log(get_iv, get_log, handle):
+        length = gl.GLint()
+        get_iv(handle, gl.GL_INFO_LOG_LENGTH, ctypes.byref(length))
+        buf = ctypes.create_string_buffer(length.value + 1)
+        get_log(handle, len(buf), None, ctypes.cast(buf, ctypes.POINTER(gl.GLchar)))
+        return buf.value
+
+    def uniform(self, name):
+        try:
+            return self._uniforms[name]
+        except KeyError:
+            loc = self._uniforms[name] = gl.glGetUniformLocation(self.id,
+                                                                 _c_string(name))
+            return loc
+
+    def use(self):
+        gl.glUseProgram(self.id)
+
+    def stop(self):
+        gl.glUseProgram(0)
+
+
+INSTANCED_VERTEX_SHADER = '''
+#version 120
+#extension GL_ARB_draw_instanced : require
+
+#define MAX_ROWS %(max_rows)d
+
+attribute vec2 corner;      // unit quad corner, (0, 0) to (1, 1)
+attribute vec4 placement;   // x, y, rotation (degrees, clockwise), scale
+attribute vec4 extent;      // width, height, anchor_x, anchor_y
+attribute vec4 frame;       // atlas frame: s0, t0, s1, t1
+
+// Row mode draws row_length copies of one image spaced row_spacing apart,
+// once for each of the row_offsets.  It is off when row_length is zero.
+uniform float row_length;
+uniform float row_spacing;
+uniform vec2 row_offsets[MAX_ROWS];
+
+varying vec2 tex_coord;
+
+void main()
+{
+    vec2 origin = placement.xy;
+    if (row_length > 0.0) {
+        float id = float(gl_InstanceIDARB);
+        float row = floor(id / row_length);
+        origin += row_offsets[int(row)];
+        origin.x += (id - row * row_length) * row_spacing;
+    }
+    vec2 local = (corner * extent.xy - extent.zw) * placement.w;
+    float r = radians(-placement.z);
+    float c = cos(r);
+    float s = sin(r);
+    vec2 pos = origin + vec2(local.x * c - local.y * s,
+                             local.x * s + local.y * c);
+    gl_Position = gl_ModelViewProjectionMatrix * vec4(pos, 0.0, 1.0);
+    tex_coord = mix(frame.xy, frame.zw, corner);
+}
+'''
+
+INSTANCED_FRAGMENT_SHADER = '''
+#version 120
+
+uniform sampler2D sprite_texture;
+
+varying vec2 tex_coord;
+
+void main()
+{
+    gl_FragColor = texture2D(sprite_texture, tex_coord);
+}
+'''
+
+
+class InstanceBuffer(object):
+    """Per-instance data of the sprites in one layer that share a texture."""
+
+    FLOATS_PER_INSTANCE = 12
+
+    def __init__(self, texture):
+        self.texture = texture
+        self.data = array.array('f')
+        self.count = 0
+        self.capacity = 0
+        self.id = gl.GLuint()
+        gl.glGenBuffers(1, ctypes.byref(self.id))
+
+    def add(self, x, y, rotation, scale, texture):
+        tc = texture.tex_coords
+        self.data.extend((x, y, rotation, scale,
+                          texture.width, texture.height,
+                          texture.anchor_x, texture.anchor_y,
+                          tc[0], tc[1], tc[6], tc[7]))
+
+    def upload(self):
+        self.count = len(self.data) // self.FLOATS_PER_INSTANCE
+        address, length = self.data.buffer_info()
+        size = length * self.data.itemsize
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.id)
+        if size > self.capacity:
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, size, address,
+                            gl.GL_DYNAMIC_DRAW)
+            self.capacity = size
+        elif size:
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, size, address)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        gl.glDeleteBuffers(1, ctypes.byref(self.id))
+
+
+class InstancedRenderer(object):
+    """Draws whole sprite layers with one instanced call per texture.
+
+    Sprites stay ordinary pyglet sprites, so the game keeps moving them
+    around as before; the renderer only reads their position, rotation,
+    scale and current frame.  Static layers (terrain, clouds) are packed
+    once and kept on the GPU, dynamic layers are repacked every frame.
+    """
+
+    MAX_ROWS = 128
+
+    CORNER, PLACEMENT, EXTENT, FRAME = range(4)
+    ATTRIBUTES = ('corner', 'placement', 'extent', 'frame')
+
+    def __init__(self):
+        self.program = ShaderProgram(
+            INSTANCED_VERTEX_SHADER % dict(max_rows=self.MAX_ROWS),
+            INSTANCED_FRAGMENT_SHADER, self.ATTRIBUTES)
+        self._draw_instanced = gl.lib.link_GL(
+            'glDrawArraysInstancedARB', None,
+            [gl.GLenum, gl.GLint, gl.GLsizei, gl.GLsizei], 'ARB_draw_instanced')
+        self._attrib_divisor = gl.lib.link_GL(
+            'glVertexAttribDivisorARB', None,
+            [gl.GLuint, gl.GLuint], 'ARB_instanced_arrays')
+        corners = (gl.GLfloat * 8)(0, 0, 1, 0, 1, 1, 0, 1)
+        self.quad = gl.GLuint()
+        gl.glGenBuffers(1, ctypes.byref(self.quad))
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.quad)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, ctypes.sizeof(corners), corners,
+                        gl.GL_STATIC_DRAW)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        self._layers = {}
+        self._packed = set()
+
+    @staticmethod
+    def is_supported():
+        info = gl.gl_info
+        return (info.have_version(2, 0)
+                and info.have_extension('GL_ARB_draw_instanced')
+                and info.have_extension('GL_ARB_instanced_arrays'))
+
+    def pack(self, key, sprites):
+        """Refill the instance buffers of layer ``key`` from ``sprites``.
+
+        Visible sprites are grouped by texture, so a layer whose images all
+        come from one resource atlas ends up as a single buffer.
+        """
+        try:
+            buffers = self._layers[key]
+        except KeyError:
+            buffers = self._layers[key] = {}
+        for buf in buffers.itervalues():
+            del buf.data[:]
+        for sprite in sprites:
+            if not sprite.visible:
+                continue
+            # _texture is the current frame, also for animated sprites
+            texture = sprite._texture
+            try:
+                buf = buffers[texture.id]
+            except KeyError:
+                buf = buffers[texture.id] = InstanceBuffer(texture)
+            buf.add(sprite.x, sprite.y, sprite.rotation, sprite.scale, texture)
+        for buf in buffers.itervalues():
+            buf.upload()
+        return buffers.values()
+
+    def forget(self, key):
+        """Release the GPU buffers of layer ``key``."""
+        for buf in self._layers.pop(key, {}).itervalues():
+            buf.delete()
+        self._packed.discard(key)
+
+    def reset(self):
+        """Release the GPU buffers of all layers (e.g. for a new game)."""
+        for key in list(self._layers):
+            self.forget(key)
+
+    def draw_sprites(self, key, sprites, static=False):
+        """Draw a layer of sprites.
+
+        ``key`` identifies the layer.  A static layer is packed on first
+        use and reused until `forget` is called for it; other layers are
+        repacked on every call, reusing their buffers.
+        """
+        if static and key in self._packed:
+            buffers = self._layers[key].values()
+        else:
+            buffers = self.pack(key, sprites)
+            if static:
+                self._packed.add(key)
+        with self._state():
+            gl.glUniform1f(self.program.uniform('row_length'), 0)
+            for buf in buffers:
+                self._draw_buffer(buf)
+
+    def draw_rows(self, texture, length, spacing, offsets):
+        """Draw ``length`` copies of ``texture`` side by side at each offset.
+
+        This is how the sea draws its wave bands: one instanced call per
+        `MAX_ROWS` bands instead of one batch draw per band.
+        """
+        if not offsets or not length:
+            return
+        tc = texture.tex_coords
+        with self._state():
+            gl.glBindTexture(texture.target, texture.id)
+            program = self.program
+            gl.glUniform1f(program.uniform('row_length'), length)
+            gl.glUniform1f(program.uniform('row_spacing'), spacing)
+            gl.glVertexAttrib4f(self.PLACEMENT, 0, 0, 0, 1)
+            gl.glVertexAttrib4f(self.EXTENT, texture.width, texture.height,
+                                texture.anchor_x, texture.anchor_y)
+            gl.glVertexAttrib4f(self.FRAME, tc[0], tc[1], tc[6], tc[7])
+            for start in range(0, len(offsets), self.MAX_ROWS):
+                chunk = offsets[start:start + self.MAX_ROWS]
+                flat = (gl.GLfloat * (2 * len(chunk)))(
+                    *[v for offset in chunk for v in offset])
+                gl.glUniform2fv(program.uniform('row_offsets'), len(chunk), flat)
+                self._draw_instanced(gl.GL_QUADS, 0, 4, length * len(chunk))
+
+    def _draw_buffer(self, buf):
+        if not buf.count:
+            return
+        gl.glBindTexture(buf.texture.target, buf.texture.id)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, buf.id)
+        stride = InstanceBuffer.FLOATS_PER_INSTANCE * 4
+        for n, index in enumerate((self.PLACEMENT, self.EXTENT, self.FRAME)):
+            gl.glEnableVertexAttribArray(index)
+            gl.glVertexAttribPointer(index, 4, gl.GL_FLOAT, False, stride,
+                                     n * 16)
+            self._attrib_divisor(index, 1)
+        self._draw_instanced(gl.GL_QUADS, 0, 4, buf.count)
+        for index in (self.PLACEMENT, self.EXTENT, self.FRAME):
+            self._attrib_divisor(index, 0)
+            gl.glDisableVertexAttribArray(index)
+
+    def _state(self):
+        return _InstancedState(self)
+
+
+class _InstancedState(object):
+    # A tiny context manager instead of @contextmanager, since draw_rows and
+    # draw_sprites run a handful of times every frame.
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+
+    def __enter__(self):
+        r = self.renderer
+        gl.glPushAttrib(gl.GL_COLOR_BUFFER_BIT | gl.GL_ENABLE_BIT)
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        r.program.use()
+        gl.glUniform1i(r.program.uniform('sprite_texture'), 0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, r.quad)
+        gl.glEnableVertexAttribArray(r.CORNER)
+        gl.glVertexAttribPointer(r.CORNER, 2, gl.GL_FLOAT, False, 0, 0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def __exit__(self, *exc_info):
+        r = self.renderer
+        gl.glDisableVertexAttribArray(r.CORNER)
+        r.program.stop()
+        gl.glPopAttrib()
+
+
+class RenderTarget(object):
+    """A texture that can be drawn into through a framebuffer object."""
+
+    def __init__(self, width, height, mipmaps=False):
+        self.width = width
+        self.height = height
+        self.mipmaps = mipmaps
+        # may be a region of a larger power-of-two texture
+        self.texture = pyglet.image.Texture.create(width, height, gl.GL_RGBA)
+        self.fbo = gl.GLuint()
+        gl.glGenFramebuffersEXT(1, ctypes.byref(self.fbo))
+        gl.glBindFramebufferEXT(gl.GL_FRAMEBUFFER_EXT, self.fbo)
+        gl.glFramebufferTexture2DEXT(gl.GL_FRAMEBUFFER_EXT,
+                                     gl.GL_COLOR_ATTACHMENT0_EXT,
+                                     self.texture.target, self.texture.id, 0)
+        status = gl.glCheckFramebufferStatusEXT(gl.GL_FRAMEBUFFER_EXT)
+        gl.glBindFramebufferEXT(gl.GL_FRAMEBUFFER_EXT, 0)
+        if status != gl.GL_FRAMEBUFFER_COMPLETE_EXT:
+            self.delete()
+            raise RenderTargetError('framebuffer incomplete: 0x%x' % status)
+
+    @staticmethod
+    def is_supported():
+        return gl.gl_info.have_extension('GL_EXT_framebuffer_object')
+
+    @staticmethod
+    def max_size():
+        size = gl.GLint()
+        gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE, ctypes.byref(size))
+        return size.value
+
+    @contextmanager
+    def drawing(self, left, bottom, right, top, clear_color=(0, 0, 0, 0)):
+        """Draw into the target with the given rectangle mapped onto it.
+
+        The target is cleared to ``clear_color`` first.  On a transparent
+        target, sprites blend their colour with their own alpha, so the
+        result is (roughly) premultiplied; draw it with
+        `blit_premultiplied`.  That blending gets the alpha channel wrong,
+        though, so a target that covers everything below it is better
+        cleared to an opaque colour and drawn with `blit_opaque`.
+
+        Targets nest: the framebuffer bound before is bound again after.
+        """
+        previous = gl.GLint()
+        gl.glGetIntegerv(gl.GL_FRAMEBUFFER_BINDING_EXT, ctypes.byref(previous))
+        gl.glPushAttrib(gl.GL_VIEWPORT_BIT | gl.GL_COLOR_BUFFER_BIT)
+        gl.glBindFramebufferEXT(gl.GL_FRAMEBUFFER_EXT, self.fbo)
+        gl.glViewport(0, 0, self.width, self.height)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glOrtho(left, right, bottom, top, -1, 1)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glClearColor(*clear_color)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        try:
+            yield
+        finally:
+            gl.glPopMatrix()
+            gl.glMatrixMode(gl.GL_PROJECTION)
+            gl.glPopMatrix()
+            gl.glMatrixMode(gl.GL_MODELVIEW)
+            gl.glBindFramebufferEXT(gl.GL_FRAMEBUFFER_EXT, previous.value)
+            gl.glPopAttrib()
+        if self.mipmaps:
+            texture = self.texture
+            gl.glBindTexture(texture.target, texture.id)
+            gl.glGenerateMipmapEXT(texture.target)
+            gl.glTexParameteri(texture.target, gl.GL_TEXTURE_MIN_FILTER,
+                               gl.GL_LINEAR_MIPMAP_LINEAR)
+
+    def blit_premultiplied(self, x, y, width, height):
+        gl.glPushAttrib(gl.GL_COLOR_BUFFER_BIT)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
+        self.texture.blit(x, y, width=width, height=height)
+        gl.glPopAttrib()
+
+    def blit_opaque(self, x, y, width, height):
+        gl.glPushAttrib(gl.GL_COLOR_BUFFER_BIT)
+        gl.glDisable(gl.GL_BLEND)
+        self.texture.blit(x, y, width=width, height=height)
+        gl.glPopAttrib()
+
+    def delete(self):
+        gl.glDeleteFramebuffersEXT(1, ctypes.byref(self.fbo))
+        self.texture = None # textures are released when collected
+
+
+_instanced_renderer = None
+
+
+def get_instanced_renderer():
+    """Return the shared `InstancedRenderer`, or None if unsupported."""
+    global _instanced_renderer
+    if _instanced_renderer is None:
+        if not InstancedRenderer.is_supported():
+            log.warning('instanced rendering not supported, using batches')
+            _instanced_renderer = False
+        else:
+            try:
+                _instanced_renderer = InstancedRenderer()
+            except ShaderError as e:
+                log.warning('instanced renderer disabled: %s', e)
+                _instanced_renderer = False
+    return _instanced_renderer or None
@@ -0,0 +1,196 @@
+"""
+Compact binary snapshots of a Dodopult game.
+
+`Game.capture_state()` in dodo.py returns a `GameState`, and
+`Game.restore_state()` puts it back.  dumps() and loads() turn a state into
+a string and back; most of it is the dodo arrays, which are copied whole,
+so packing takes microseconds and a game with a hundred dodos fits in a
+few kilobytes.
+
+Snapshot layout (all numbers little-endian)::
+
+    header    magic, version, flags
+    counts    level index, dodos in the flock, flying dodos, dodos in
+              play, then flock indices of the bunny, the payload and the
+              camera focus (-1 for none)
+    scalars   the GameState.SCALARS, as doubles
+    columns   the GameState.COLUMNS, one after another
+
+`RewindBuffer` keeps the last few seconds of snapshots for rewinding.
+"""
+import sys
+import struct
+from array import array
+
+
+MAGIC = 'DODOSAV\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHH')
+COUNTS = struct.Struct('<HIIIiii')
+
+# flags
+GAME_OVER = 1
+ARMED = 2
+POWERING_UP = 4
+MANUAL_CAMERA = 8
+
+# how a dodo looks
+STANDING, READY, DEAD, GONE, ENDING = range(5)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class GameState(object):
+    """Everything needed to put a game back the way it was."""
+
+    SCALARS = ('game_over_time', 'sea_level', 'sea_phase',
+               'dodopult_x', 'dodopult_y', 'power', 'time_loading',
+               'aim_angle', 'camera_x', 'camera_y', 'camera_target_x',
+               'camera_target_y', 'focus_timer')
+
+    # name, typecode; the flock columns have one item per dodo
+    COLUMNS = (('x', 'd'), ('y', 'd'), ('dx', 'd'), ('dy', 'd'),
+               ('alive', 'b'), ('looks', 'B'), ('standing', 'B'),
+               ('flying', 'I'), ('dodos', 'I'))
+
+    def __init__(self):
+        self.flags = 0
+        self.level = 0
+        self.bunny = self.payload = self.focus = -1
+        for name in self.SCALARS:
+            setattr(self, name, 0.0)
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+
+    @staticmethod
+    def column_sizes(members, flying, dodos):
+        return [members] * 7 + [flying, dodos]
+
+    def check(self, levels, standing_images):
+        """Raise SnapshotError unless the state fits a game whose map has
+        ``levels`` levels and whose dodos have ``standing_images``."""
+        if not 0 <= self.level < levels:
+            raise SnapshotError('level %d is not on this map' % self.level)
+        if self.standing and max(self.standing) >= standing_images:
+            raise SnapshotError('unknown standing image %d'
+                                % max(self.standing))
+
+
+SCALARS = struct.Struct('<%dd' % len(GameState.SCALARS))
+
+
+def dumps(state):
+    parts = [HEADER.pack(MAGIC, VERSION, state.flags),
+             COUNTS.pack(state.level, len(state.x), len(state.flying),
+                         len(state.dodos), state.bunny, state.payload,
+                         state.focus),
+             SCALARS.pack(*[getattr(state, name)
+                            for name in GameState.SCALARS])]
+    for name, typecode in GameState.COLUMNS:
+        column = getattr(state, name)
+        if sys.byteorder == 'big':
+            column = array(typecode, column)
+            column.byteswap()
+        parts.append(column.tostring())
+    return ''.join(parts)
+
+
+def _unpack(fmt, data, offset):
+    if offset + fmt.size > len(data):
+        raise SnapshotError('truncated snapshot')
+    return fmt.unpack_from(data, offset)
+
+
+def loads(data):
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError('not a saved game')
+    magic, version, flags = HEADER.unpack_from(data, 0)
+    if version != VERSION:
+        raise SnapshotError('unsupported snapshot version %d' % version)
+    state = GameState()
+    state.flags = flags
+    offset = HEADER.size
+    (state.level, members, flying, dodos, state.bunny, state.payload,
+     state.focus) = _unpack(COUNTS, data, offset)
+    offset += COUNTS.size
+    for name, value in zip(GameState.SCALARS,
+                           _unpack(SCALARS, data, offset)):
+        setattr(state, name, value)
+    offset += SCALARS.size
+    sizes = GameState.column_sizes(members, flying, dodos)
+    for (name, typecode), count in zip(GameState.COLUMNS, sizes):
+        column = getattr(state, name)
+        end = offset + column.itemsize * count
+        if end > len(data):
+            raise SnapshotError('truncated snapshot')
+        column.fromstring(data[offset:end])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        offset = end
+    for index in state.bunny, state.payload, state.focus:
+        if not -1 <= index < members:
+            raise SnapshotError('dodo %d is not in the flock' % index)
+    for column in state.flying, state.dodos:
+        if column and max(column) >= members:
+            raise SnapshotError('dodo %d is not in the flock' % max(column))
+    if state.looks and max(state.looks) > ENDING:
+        raise SnapshotError('unknown look %d' % max(state.looks))
+    return state
+
+
+def save(game, filename):
+    f = open(filename, 'wb')
+    try:
+        f.write(dumps(game.capture_state()))
+    finally:
+        f.close()
+
+
+def load(game, filename):
+    f = open(filename, 'rb')
+    try:
+        game.restore_state(loads(f.read()))
+    finally:
+        f.close()
+
+
+class RewindBuffer(object):
+    """The last few seconds of a game, as packed snapshots.
+
+    A snapshot is recorded every ``interval`` seconds of game time into a
+    fixed ring of slots, so the buffer never grows.
+    """
+
+    def __init__(self, game, seconds=10.0, interval=0.25):
+        self.game = game
+        self.interval = interval
+        self.snapshots = [None] * max(1, int(seconds / interval))
+        self.newest = -1
+        self.count = 0
+
+    def start(self):
+        self.game.clock.schedule_interval(self.record, self.interval)
+
+    def stop(self):
+        self.game.clock.unschedule(self.record)
+
+    def record(self, dt=None):
+        self.newest = (self.newest + 1) % len(self.snapshots)
+        self.snapshots[self.newest] = dumps(self.game.capture_state())
+        self.count = min(self.count + 1, len(self.snapshots))
+
+    def rewind(self, seconds=1.0):
+        """Go back about ``seconds``; False if nothing was recorded yet.
+
+        Snapshots newer than the one restored are dropped.
+        """
+        if not self.count:
+            return False
+        steps = min(max(1, int(round(seconds / self.interval))), self.count)
+        self.newest = (self.newest - steps + 1) % len(self.snapshots)
+        self.count -= steps - 1
+        self.game.restore_state(loads(self.snapshots[self.newest]))
+        return True
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""
+Server hosting many headless Dodopult games at once.
+
+    python server.py [port] [workers]
+    python server.py client [port] [sessions] [seconds]
+
+The server listens on localhost.  Each session is an independent headless
+`dodo.Game`; sessions are spread over worker processes (one per core by
+default), which step all their sessions at a fixed tick and send back what
+changed.  The server process itself only routes messages, with asyncore.
+
+Every message is a FRAME header (payload length, message type) followed
+by the payload.  Clients send NEW_SESSION, INPUT (session, event), CLOSE
+(session) and GET_STATS; the server answers with SESSION (session, worker),
+a DELTA for every tick in which something changed in a session, CLOSED and
+STATS (JSON, including sessions per core).  See encode_delta() for the
+delta layout.
+
+The client mode opens a few sessions, plays them with random input and
+prints what it received and the server's stats.
+"""
+import os
+import sys
+import time
+import json
+import random
+import select
+import socket
+import struct
+import asyncore
+import logging
+import multiprocessing
+from array import array
+
+
+log = logging.getLogger('dodo.server')
+
+PORT = 4747
+TICK = 1 / 60.
+
+FRAME = struct.Struct('<IB')
+
+# client -> server
+NEW_SESSION = 1
+INPUT = 2
+CLOSE = 3
+GET_STATS = 4
+
+# server -> client
+SESSION = 1
+DELTA = 2
+CLOSED = 3
+STATS = 4
+
+SESSION_ID = struct.Struct('<I')
+SESSION_INFO = struct.Struct('<IH') # session, worker
+INPUT_EVENT = struct.Struct('<IB') # session, event
+
+# INPUT events are 1 + an index into this list of Dodopult methods
+EVENTS = ('move_left', 'move_right', 'aim_up', 'aim_down',
+          'start_powering_up', 'fire', 'try_load')
+
+DELTA_HEADER = struct.Struct('<IIHH') # session, tick, scalar mask, dodos
+DODO = struct.Struct('<Hffb') # index, x, y, alive
+
+# scalars a DELTA may carry, in mask bit order
+SCALARS = ('level', 'sea_level', 'dodopult_x', 'dodopult_y', 'aim_angle',
+           'power', 'camera_x', 'camera_y', 'payload', 'game_over')
+
+
+def frame(kind, payload=''):
+    return FRAME.pack(len(payload), kind) + payload
+
+
+def split_frames(buffer):
+    """Return the complete (type, payload) messages in buffer, and the rest."""
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= FRAME.size:
+        size, kind = FRAME.unpack_from(buffer, offset)
+        end = offset + FRAME.size + size
+        if end > len(buffer):
+            break
+        messages.append((kind, buffer[offset + FRAME.size:end]))
+        offset = end
+    return messages, buffer[offset:]
+
+
+def encode_delta(session, tick, scalars, dodos):
+    """Pack a session's changes.
+
+    ``scalars`` maps SCALARS names to their new values; ``dodos`` lists
+    (index, x, y, alive) for the dodos that moved, died or appeared.
+    """
+    mask = 0
+    values = []
+    for bit, name in enumerate(SCALARS):
+        if name in scalars:
+            mask |= 1 << bit
+            values.append(scalars[name])
+    parts = [DELTA_HEADER.pack(session, tick, mask, len(dodos)),
+             struct.pack('<%dd' % len(values), *values)]
+    parts.extend(DODO.pack(*dodo) for dodo in dodos)
+    return ''.join(parts)
+
+
+def decode_delta(data):
+    """The inverse of encode_delta(): (session, tick, scalars, dodos)."""
+    session, tick, mask, count = DELTA_HEADER.unpack_from(data, 0)
+    names = [name for bit, name in enumerate(SCALARS) if mask & (1 << bit)]
+    offset = DELTA_HEADER.size
+    values = struct.unpack_from('<%dd' % len(names), data, offset)
+    offset += 8 * len(names)
+    dodos = [DODO.unpack_from(data, offset + n * DODO.size)
+             for n in range(count)]
+    return session, tick, dict(zip(names, values)), dodos
+
+
+class Session(object):
+    """One headless game, stepped by a worker at a fixed tick."""
+
+    def __init__(self, id):
+        # imported here, so that the server process never loads pyglet;
+        # the processes that run sessions make dodo headless first
+        import dodo
+        import pyglet
+        self.id = id
+        self.time = 0.0
+        self.tick = 0
+        self.clock = pyglet.clock.Clock(time_function=self.now)
+        self.game = dodo.Game(headless=True, clock=self.clock)
+        self.sent = {}
+        self.sent_alive = array('b')
+
+    def now(self):
+        return self.time
+
+    def handle(self, event):
+        if 1 <= event <= len(EVENTS):
+            getattr(self.game.dodopult, EVENTS[event - 1])()
+
+    def step(self, dt):
+        self.time += dt
+        self.tick += 1
+        self.clock.tick(True)
+
+    def scalars(self):
+        game = self.game
+        dodopult = game.dodopult
+        payload = dodopult.payload
+        return dict(level=game.current_level.number,
+                    sea_level=game.sea.level,
+                    dodopult_x=dodopult.x, dodopult_y=dodopult.y,
+                    aim_angle=dodopult.aim_angle, power=dodopult.power,
+                    camera_x=game.camera.x, camera_y=game.camera.y,
+                    payload=payload is None and -1 or payload.index,
+                    game_over=game.game_is_over)
+
+    def delta(self):
+        """Return an encoded DELTA since the last call, or None."""
+        scalars = self.scalars()
+        changed = dict((name, value) for name, value in scalars.items()
+                       if self.sent.get(name) != value)
+        self.sent = scalars
+        flock = self.game.flock
+        indices, flock.moved = flock.moved, set()
+        alive = flock.alive
+        if alive != self.sent_alive:
+            sent = self.sent_alive
+            indices.update(n for n in range(len(alive))
+                           if n >= len(sent) or alive[n] != sent[n])
+            self.sent_alive = array('b', alive)
+        if not changed and not indices:
+            return None
+        dodos = [(n, flock.x[n], flock.y[n], alive[n])
+                 for n in sorted(indices)]
+        return encode_delta(self.id, self.tick, changed, dodos)
+
+
+def worker_main(index, conn, tick):
+    """Step sessions at a fixed tick, as told by the server over conn."""
+    # games must be headless before dodo (and so pyglet) is imported
+    os.environ['DODOPULT_HEADLESS'] = '1'
+    sessions = {}
+    next_tick = time.time()
+    while True:
+        timeout = max(0, next_tick - time.time())
+        while conn.poll(timeout):
+            message = conn.recv()
+            command = message[0]
+            if command == 'new':
+                sessions[message[1]] = Session(message[1])
+            elif command == 'input':
+                session = sessions.get(message[1])
+                if session is not None:
+                    session.handle(message[2])
+            elif command == 'close':
+                sessions.pop(message[1], None)
+            elif command == 'quit':
+                return
+            timeout = max(0, next_tick - time.time())
+        now = time.time()
+        if now - next_tick > 0.25:
+            next_tick = now # too far behind to catch up
+        next_tick += tick
+        if not sessions:
+            continue
+        deltas = []
+        for session in sessions.values():
+            session.step(tick)
+            data = session.delta()
+            if data is not None:
+                deltas.append(data)
+        conn.send(('tick', deltas, len(sessions), time.time() - now))
+
+
+class WorkerLink(asyncore.file_dispatcher):
+    """The server's end of the pipe to one worker process."""
+
+    def __init__(self, server, index, tick):
+        self.server = server
+        self.index = index
+        self.tick = tick
+        self.sessions = 0
+        self.busy = 0.0 # fraction of a tick spent stepping, smoothed
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main,
+                                               args=(index, child, tick))
+        self.process.daemon = True
+        self.process.start()
+        asyncore.file_dispatcher.__init__(self, self.conn.fileno())
+
+    def writable(self):
+        return False
+
+    def command(self, *message):
+        self.conn.send(message)
+
+    def handle_read(self):
+        while self.conn.poll():
+            kind, deltas, sessions, busy = self.conn.recv()
+            self.sessions = sessions
+            self.busy += (busy / self.tick - self.busy) * 0.05
+            for data in deltas:
+                self.server.route(data)
+
+    def handle_close(self):
+        log.error('worker %d died', self.index)
+        self.close()
+
+
+class ClientConnection(asyncore.dispatcher):
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock)
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = []
+        self.sessions = set()
+
+    def send_message(self, kind, payload=''):
+        self.outbuf.append(frame(kind, payload))
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        data = ''.join(self.outbuf)
+        sent = self.send(data)
+        self.outbuf = sent < len(data) and [data[sent:]] or []
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        messages, self.inbuf = split_frames(self.inbuf + data)
+        for kind, payload in messages:
+            self.server.handle(self, kind, payload)
+
+    def handle_close(self):
+        for session in list(self.sessions):
+            self.server.close_session(session)
+        self.close()
+
+
+class Server(asyncore.dispatcher):
+
+    stats_interval = 10.0 # seconds between stats in the log
+
+    def __init__(self, port=PORT, workers=None, tick=TICK):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', port))
+        self.listen(16)
+        self.cores = multiprocessing.cpu_count()
+        self.workers = [WorkerLink(self, n, tick)
+                        for n in range(workers or self.cores)]
+        self.sessions = {} # session -> (client, worker)
+        self.next_session = 1
+        self.logged_at = time.time()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ClientConnection(self, pair[0])
+
+    def handle(self, client, kind, payload):
+        if kind == NEW_SESSION:
+            worker = min(self.workers, key=lambda w: w.sessions)
+            session = self.next_session
+            self.next_session += 1
+            worker.sessions += 1 # until the worker reports back
+            worker.command('new', session)
+            self.sessions[session] = (client, worker)
+            client.sessions.add(session)
+            client.send_message(SESSION, SESSION_INFO.pack(session,
+                                                           worker.index))
+        elif kind == INPUT:
+            session, event = INPUT_EVENT.unpack(payload)
+            if session in client.sessions:
+                self.sessions[session][1].command('input', session, event)
+        elif kind == CLOSE:
+            session, = SESSION_ID.unpack(payload)
+            if session in client.sessions:
+                self.close_session(session)
+                client.send_message(CLOSED, payload)
+        elif kind == GET_STATS:
+            client.send_message(STATS, json.dumps(self.stats()))
+
+    def route(self, delta):
+        session, = SESSION_ID.unpack_from(delta, 0)
+        if session in self.sessions:
+            self.sessions[session][0].send_message(DELTA, delta)
+
+    def close_session(self, session):
+        client, worker = self.sessions.pop(session)
+        client.sessions.discard(session)
+        worker.command('close', session)
+
+    def stats(self):
+        """Sessions per core now, and how many a core could take."""
+        sessions = len(self.sessions)
+        busy = sum(w.busy for w in self.workers)
+        stats = dict(cores=self.cores, workers=len(self.workers),
+                     sessions=sessions,
+                     sessions_per_core=sessions / float(self.cores),
+                     busy_cores=busy,
+                     per_worker=[dict(sessions=w.sessions, busy=w.busy)
+                                 for w in self.workers])
+        if busy > 0:
+            stats['capacity_per_core'] = sessions / busy
+        return stats
+
+    def maybe_log_stats(self):
+        if time.time() - self.logged_at >= self.stats_interval:
+            self.logged_at = time.time()
+            stats = self.stats()
+            log.info('%d sessions on %d cores: %.1f per core, %.2f cores busy',
+                     stats['sessions'], stats['cores'],
+                     stats['sessions_per_core'], stats['busy_cores'])
+
+    def serve_forever(self):
+        try:
+            while True:
+                asyncore.loop(timeout=0.05, use_poll=True, count=1)
+                self.maybe_log_stats()
+        finally:
+            for worker in self.workers:
+                worker.command('quit')
+
+
+def run_client(port=PORT, sessions=4, seconds=10.0):
+    """Play a few sessions with random input; print what came back."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    buffer = ['']
+
+    def receive(timeout):
+        readable = select.select([sock], [], [], timeout)[0]
+        if not readable:
+            return []
+        data = sock.recv(65536)
+        if not data:
+            raise IOError('server closed the connection')
+        messages, buffer[0] = split_frames(buffer[0] + data)
+        return messages
+
+    for n in range(sessions):
+        sock.sendall(frame(NEW_SESSION))
+    ids = []
+    deltas = 0
+    delta_bytes = 0
+    dodos = 0
+    # try_load, start_powering_up, then fire at a random power
+    plan = [EVENTS.index(name) + 1
+            for name in ('try_load', 'start_powering_up', 'fire')]
+    step = dict()
+    deadline = time.time() + seconds
+    next_input = time.time()
+    while time.time() < deadline:
+        for kind, payload in receive(0.01):
+            if kind == SESSION:
+                ids.append(SESSION_INFO.unpack(payload)[0])
+            elif kind == DELTA:
+                deltas += 1
+                delta_bytes += len(payload)
+                dodos += len(decode_delta(payload)[3])
+        if time.time() >= next_input:
+            next_input = time.time() + random.uniform(0.2, 0.8)
+            for session in ids:
+                n = step.get(session, 0)
+                step[session] = n + 1
+                sock.sendall(frame(INPUT, INPUT_EVENT.pack(
+                    session, plan[n % len(plan)])))
+    sock.sendall(frame(GET_STATS))
+    stats = None
+    while stats is None:
+        for kind, payload in receive(1.0):
+            if kind == STATS:
+                stats = json.loads(payload)
+    for session in ids:
+        sock.sendall(frame(CLOSE, SESSION_ID.pack(session)))
+    sock.close()
+    print('%d sessions, %d deltas (%.1f per session per second), '
+          '%d bytes, %d dodo updates' % (
+              len(ids), deltas, deltas / float(max(1, len(ids))) / seconds,
+              delta_bytes, dodos))
+    print('server: %(sessions)d sessions on %(cores)d cores, '
+          '%(sessions_per_core).2f sessions per core, '
+          '%(busy_cores).3f cores busy' % stats)
+    if 'capacity_per_core' in stats:
+        print('server: room for about %d sessions per core'
+              % stats['capacity_per_core'])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    if args and args[0] == 'client':
+        args = args[1:]
+        port = len(args) > 0 and int(args[0]) or PORT
+        sessions = len(args) > 1 and int(args[1]) or 4
+        seconds = len(args) > 2 and float(args[2]) or 10.0
+        run_client(port, sessions, seconds)
+        return
+    port = len(args) > 0 and int(args[0]) or PORT
+    workers = len(args) > 1 and int(args[1]) or None
+    server = Server(port, workers)
+    log.info('listening on port %d with %d workers', port,
+             len(server.workers))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
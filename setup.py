@@ -111,6 +111,15 @@ def make_dirs(dname_):
         if not os.path.isdir(dname):
             os.mkdir(dname)
 
+# pack the assets into one archive instead of copying the loose files
+if cmd in ('py2exe',):
+    import pyglet
+    pyglet.options['shadow_window'] = False
+    import assetpack
+    make_dirs(data_dir)
+    assetpack.pack('assets', os.path.join(data_dir, 'assets.pak'))
+    data = [fname for fname in data if not fname.startswith('assets')]
+
 # copy data into the binaries 
 if cmd in ('py2exe',):
     dest = data_dir
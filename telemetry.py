@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Opt-in performance telemetry for Dodopult.
+
+With TELEMETRY on in dodo.py, a `TelemetryWriter` counts every frame and
+simulation tick in memory and, every ``interval`` seconds and whenever the
+level changes, turns the counts into one record.  Records are appended to
+a local JSON lines file in batches, so the game doesn't touch the disk
+every frame.  Nothing is sent anywhere.
+
+Records (one JSON object per line, all with "type", "session", "time"):
+
+    session   python and pyglet versions, platform
+    load      "what" was loaded and how many "seconds" it took
+    frames    "level", "seconds" covered, "frames", "histogram" of frame
+              times (counts per FRAME_BUCKETS, plus one for slower
+              frames), "ticks", "overruns" (ticks that came late, in
+              real time),
+              "dodos" alive and "sea_level" at the end, and "draw_calls"
+              per frame when the diagnostics counters are on
+
+Running this module sums up any number of such files:
+
+    python telemetry.py ~/.dodopult-telemetry.jsonl other.jsonl ...
+
+prints frame time percentiles (p50/p95/p99) per level, and load times.
+"""
+import sys
+import json
+import time
+import uuid
+import platform
+import threading
+
+import pyglet
+
+
+# upper bounds of the frame time histogram buckets, in milliseconds; the
+# last bucket counts everything slower
+FRAME_BUCKETS = (5, 10, 15, 17, 20, 25, 34, 50, 67, 100, 200, 500)
+
+# a tick that comes this many tick lengths after the previous one is late
+OVERRUN = 1.5
+
+
+class TelemetryWriter(object):
+    """Collects frame and tick statistics and appends them to a file."""
+
+    interval = 10.0  # seconds covered by a frames record
+    batch_size = 30  # records kept in memory before writing
+    tick_length = 1 / 60. # Game.update_freq
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.session = uuid.uuid4().hex
+        self.buffer = []
+        self.level = None
+        # ticks come from the simulation thread with THREADED_SIMULATION
+        self.lock = threading.Lock()
+        self.ticks = 0
+        self.overruns = 0
+        self.last_tick = None
+        self.reset(time.time())
+        self.record('session', python=platform.python_version(),
+                    pyglet=pyglet.version, platform=platform.platform())
+
+    def reset(self, now):
+        self.started = now
+        self.frames = 0
+        self.histogram = [0] * (len(FRAME_BUCKETS) + 1)
+        self.draw_calls = 0
+
+    def record(self, kind, **fields):
+        fields.update(type=kind, session=self.session, time=time.time())
+        self.buffer.append(json.dumps(fields))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def load(self, what, seconds):
+        self.record('load', what=what, seconds=seconds)
+        with self.lock:
+            self.last_tick = None # no ticks are due while loading
+
+    def tick(self, dt=None):
+        """Count a simulation tick.
+
+        Lateness is measured in real time, since the ``dt`` of a game
+        stepped in fixed ticks (FRAME_PACING) is always one tick.
+        """
+        now = time.time()
+        with self.lock:
+            self.ticks += 1
+            if (self.last_tick is not None
+                and now - self.last_tick > self.tick_length * OVERRUN):
+                self.overruns += 1
+            self.last_tick = now
+
+    def frame(self, dt, game, profiler=None):
+        """Count a frame drawn ``dt`` seconds after the previous one."""
+        now = time.time()
+        level = game.current_level.number
+        if self.level is not None and (level != self.level or
+                                       now - self.started >= self.interval):
+            self.end_record(game, now)
+        self.level = level
+        ms = dt * 1000
+        for n, bound in enumerate(FRAME_BUCKETS):
+            if ms <= bound:
+                self.histogram[n] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+        self.frames += 1
+        totals = getattr(profiler, 'totals', None)
+        if totals is not None:
+            self.draw_calls += totals().draw_calls
+
+    def end_record(self, game, now):
+        with self.lock:
+            ticks, overruns = self.ticks, self.overruns
+            self.ticks = self.overruns = 0
+        if self.frames:
+            fields = dict(level=self.level, seconds=now - self.started,
+                          frames=self.frames, histogram=self.histogram,
+                          ticks=ticks, overruns=overruns,
+                          dodos=len([dodo for dodo in game.dodos
+                                     if dodo.is_alive]),
+                          sea_level=game.sea.level)
+            if self.draw_calls:
+                fields['draw_calls'] = self.draw_calls / float(self.frames)
+            self.record('frames', **fields)
+        self.reset(now)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            f = open(self.filename, 'a')
+            try:
+                f.write('\n'.join(self.buffer) + '\n')
+            finally:
+                f.close()
+        except IOError:
+            pass # telemetry must never get in the way of the game
+        self.buffer = []
+
+    def close(self, game=None):
+        if game is not None:
+            self.end_record(game, time.time())
+        self.flush()
+
+
+def percentile(histogram, fraction):
+    """Estimate a frame time percentile (in ms) from a histogram.
+
+    Interpolates within the bucket; returns None if it falls among the
+    frames slower than the last bucket.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    lower = 0
+    for count, upper in zip(histogram, FRAME_BUCKETS):
+        if count and seen + count >= rank:
+            return lower + (upper - lower) * (rank - seen) / float(count)
+        seen += count
+        lower = upper
+    return None
+
+
+class Report(object):
+    """Telemetry records summed up per level."""
+
+    def __init__(self):
+        self.levels = {} # number -> dict of sums
+        self.loads = {} # what -> [seconds, ...]
+        self.sessions = set()
+
+    def add(self, record):
+        self.sessions.add(record.get('session'))
+        if record['type'] == 'load':
+            self.loads.setdefault(record['what'], []).append(record['seconds'])
+        elif record['type'] == 'frames':
+            row = self.levels.get(record['level'])
+            if row is None:
+                row = self.levels[record['level']] = dict(
+                    frames=0, ticks=0, overruns=0, dodos=0.0,
+                    histogram=[0] * (len(FRAME_BUCKETS) + 1))
+            row['frames'] += record['frames']
+            row['ticks'] += record['ticks']
+            row['overruns'] += record['overruns']
+            row['dodos'] += record['dodos'] * record['frames']
+            for n, count in enumerate(record['histogram']):
+                row['histogram'][n] += count
+
+    def read(self, f):
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self.add(json.loads(line))
+            except (ValueError, KeyError):
+                pass # a torn write from a crash; skip it
+
+    def report(self):
+        """Return the summary as lines of text."""
+        def ms(value):
+            if value is None:
+                return '>%d' % FRAME_BUCKETS[-1]
+            return '%.1f' % value
+        lines = ['%d sessions' % len(self.sessions),
+                 '%5s %8s %7s %7s %7s %9s %6s' % (
+                     'level', 'frames', 'p50', 'p95', 'p99', 'overruns',
+                     'dodos')]
+        for number in sorted(self.levels):
+            row = self.levels[number]
+            histogram = row['histogram']
+            lines.append('%5d %8d %7s %7s %7s %8.1f%% %6.1f' % (
+                number, row['frames'], ms(percentile(histogram, 0.5)),
+                ms(percentile(histogram, 0.95)),
+                ms(percentile(histogram, 0.99)),
+                100.0 * row['overruns'] / max(1, row['ticks']),
+                row['dodos'] / max(1, row['frames'])))
+        for what in sorted(self.loads):
+            times = sorted(self.loads[what])
+            def at(fraction):
+                return times[min(len(times) - 1, int(fraction * len(times)))]
+            lines.append('load %s: %d times, p50 %.0f ms, p95 %.0f ms, '
+                         'p99 %.0f ms' % (what, len(times), at(0.5) * 1000,
+                                          at(0.95) * 1000, at(0.99) * 1000))
+        return lines
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('usage: %s telemetry.jsonl ...' % sys.argv[0])
+    report = Report()
+    for filename in sys.argv[1:]:
+        f = open(filename)
+        try:
+            report.read(f)
+        finally:
+            f.close()
+    for line in report.report():
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,12 @@
+import os
 import sys
+import time
+import wave
+import shutil
+import tempfile
+from array import array
+import random
+import threading
 
 from nose.tools import assert_equals, assert_true, assert_false
 
@@ -16,7 +24,11 @@ class FakePygletWindow(object):
 
 class FakePygletImage(object):
     class Image(object):
-        pass
+        id = 0
+        x = y = 0
+        width = height = 32
+        def get_texture(self):
+            return self
     class Animation(object):
         @classmethod
         def from_image_sequence(self, *a, **kw):
@@ -25,19 +37,44 @@ class FakePygletImage(object):
 class FakePygletResource(object):
     path = None
 
+    class Loader(object):
+        def __init__(self, path=None, script_home=None):
+            self.path = path
+            self.reindex()
+
+    class ResourceNotFoundException(Exception):
+        pass
+
     def image(self, filename):
         return FakePygletImage.Image()
     def media(self, filename, streaming=True):
         return None
+    def file(self, filename, mode='rb'):
+        return open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'assets', filename), mode)
     def reindex(self):
         pass
+    def get_script_home(self):
+        return '.'
 
 class FakePygletSprite(object):
     class Sprite(object):
-        def __init__(self, image, **kw):
+        def __init__(self, image, x=0, y=0, **kw):
             self.image = image
+            self.x, self.y = x, y
+        def set_position(self, x, y):
+            self.x, self.y = x, y
+        def delete(self):
+            pass
 
 class FakePygletMedia(object):
+    class AudioFormat(object):
+        def __init__(self, channels, sample_size, sample_rate):
+            self.bytes_per_second = channels * sample_size // 8 * sample_rate
+    class StaticMemorySource(object):
+        def _get_queue_source(self):
+            # what pyglet's StaticSource does when a source is queued
+            return FakePygletMedia.StaticMemorySource(self._data)
     class Player(object):
         def queue(self, source):
             pass
@@ -48,12 +85,30 @@ class FakePygletMedia(object):
         def seek(self, where):
             pass
 
+class FakePygletApp(object):
+    class EventLoop(object):
+        pass
+
+class FakePygletGraphics(object):
+    class Batch(object):
+        pass
+    class Group(object):
+        def __init__(self, parent=None):
+            self.parent = parent
+    class OrderedGroup(Group):
+        def __init__(self, order, parent=None):
+            self.order = order
+            self.parent = parent
+
 class FakePygletClock(object):
     def schedule_once(self, fn, when):
         pass
 
 class FakePyglet(object):
+    version = '1.1.4'
     gl = FakePygletGl()
+    app = FakePygletApp()
+    graphics = FakePygletGraphics()
     window = FakePygletWindow()
     resource = FakePygletResource()
     sprite = FakePygletSprite()
@@ -66,7 +121,21 @@ sys.modules['pyglet.window'] = FakePyglet.window
 
 # -- end of zomg stubs --
 
-from dodo import Dodo
+from dodo import Dodo, Flock, Map, QualityController, GarbageCollector
+from dodo import FramePacer, SpriteAnimator, WorldPool, release_player
+from dodo import SimulationThread
+import dodo
+from particles import ParticleKind, ParticleSystem
+from diagnostics import FrameProfiler
+import savestate
+import server
+import balance
+import autoplay
+import fuzz
+import telemetry
+import renderbench
+import texturecache
+import assetpack
 
 
 class FakeMap(object):
@@ -89,6 +158,8 @@ class FakeMap(object):
 
 
 class FakeCamera(object):
+    def focus_on(self, obj):
+        pass
     def remove_focus(self, obj):
         pass
 
@@ -96,7 +167,11 @@ class FakeCamera(object):
 class FakeGame(object):
 
     dodo_batch = None
+    headless = False
     camera = FakeCamera()
+    gravity = 0.0 # dodos fly in straight lines, as drawn in the tests
+    air_resistance = 0.0
+    clock = FakePygletClock()
 
     def __init__(self, game_map):
         self.game_map = game_map
@@ -104,6 +179,12 @@ class FakeGame(object):
     def count_surviving_dodos(self):
         pass
 
+    def defer(self, func, *args):
+        func(*args)
+
+    def emit_particles(self, *args, **kw):
+        pass
+
 
 def test_collision_detection_1():
     # air
@@ -217,3 +298,717 @@ def test_collision_detection_launch_inside_wall():
     assert_equals(dodo.dx, 0)
     assert_equals(dodo.dy, 0)
 
+
+
+def test_map_update_matches_a_fresh_map():
+    before = '\n'.join(['      ####',
+                        '   #######',
+                        '##########',
+                        '##########'])
+    after = '\n'.join(['       ###',
+                       '  # #  ####',
+                       '##  ######',
+                       '##########'])
+    game = FakeGame(None)
+    game_map = Map(game, before)
+    changed = game_map.update(after)
+    assert_equals(sorted(changed), [(2, 1), (2, 2), (3, 1), (3, 2), (5, 2),
+                                    (6, 2), (6, 3), (10, 2)])
+    fresh = Map(game, after)
+    def tiles(m):
+        return sorted((cell, sprite.image, sprite.x, sprite.y)
+                      for cell, sprite in m.tiles.items())
+    def levels(m):
+        return [(l.number, l.left, l.right, l.height,
+                 l.next and l.next.number) for l in m.levels]
+    assert_equals(tiles(game_map), tiles(fresh))
+    assert_equals(levels(game_map), levels(fresh))
+    assert_equals(game_map.boundaries, fresh.boundaries)
+    # levels away from an edit are kept
+    first_level = game_map.levels[0]
+    game_map.update(after.replace('       ###', '       ## '))
+    assert_true(game_map.levels[0] is first_level)
+
+
+def test_flock_updates_only_flying_dodos():
+    game = FakeGame(FakeMap(ground_level=100))
+    game.gravity = 200.0
+    flock = Flock(game)
+    resting, flying = Dodo(game, flock), Dodo(game, flock)
+    for dodo in resting, flying:
+        dodo.x = 20.0
+        dodo.y = 100.0
+    flying.launch(10.0, 200.0)
+    assert_equals(flock.flying, set([flying.index]))
+    flock.update(0.25)
+    assert_equals((resting.x, resting.y), (20.0, 100.0))
+    assert_equals((flying.x, flying.y), (27.5, 193.75))
+    while flock.flying:
+        flock.update(0.1)
+    assert_false(flying.in_flight)
+    assert_true(flying.is_alive)
+    assert_equals(flying.y, 100.0)
+
+
+def test_particles_stay_within_budget():
+    particles = ParticleSystem([ParticleKind('a', (0, 0, 0, 255),
+                                             lifetime=(1.0, 1.0)),
+                                ParticleKind('b', (0, 0, 0, 255),
+                                             lifetime=(2.0, 2.0))],
+                               budget=50)
+    assert_equals(particles.emit('a', 0, 0, 30), 30)
+    assert_equals(particles.emit('b', 0, 0, 30), 20)
+    assert_equals(particles.emit('a', 0, 0, 1), 0)
+    particles.update(1.5)
+    assert_equals(particles.live, 20)
+    assert_equals(particles.emit('a', 0, 0, 40), 30)
+
+
+def test_profiler_counts_per_layer():
+    profiler = FrameProfiler()
+    counter = profiler.counter
+    profiler.begin_frame()
+    counter.draw(4)
+    with profiler.layer('sea'):
+        counter.bind()
+        counter.draw(100)
+        with profiler.layer('hud'):
+            counter.draw(4)
+        counter.draw(100)
+    with profiler.layer('hud'):
+        counter.draw(6)
+    profiler.end_frame()
+    counter.draw(1000) # between frames
+    assert_equals(profiler.order, ['other', 'sea', 'hud'])
+    assert_equals(profiler.frame['sea'].as_dict(),
+                  dict(draw_calls=2, texture_binds=1, vertices=200))
+    assert_equals(profiler.frame['hud'].vertices, 10)
+    assert_equals(profiler.totals().draw_calls, 5)
+
+
+def test_full_collections_wait_for_idle_screens():
+    collector = GarbageCollector()
+    assert_equals(collector.generation_due((100, 0, 0), False), None)
+    assert_equals(collector.generation_due((800, 0, 5), False), 0)
+    assert_equals(collector.generation_due((800, 10, 5), False), 1)
+    assert_equals(collector.generation_due((0, 0, 5), True), 2)
+    assert_equals(collector.generation_due((0, 0, 0), True), None)
+    assert_equals(collector.generation_due((0, 0, 100), False), 2)
+
+
+def test_snapshot_round_trip():
+    state = savestate.GameState()
+    state.flags = savestate.GAME_OVER | savestate.ARMED
+    state.level, state.payload, state.focus = 3, 1, -1
+    state.sea_level = 1234.5
+    state.x.extend([1.0, 2.0])
+    state.y.extend([3.0, 4.0])
+    state.dx.extend([0.0, 5.0])
+    state.dy.extend([0.0, -6.0])
+    state.alive.extend([1, 0])
+    state.looks.extend([savestate.STANDING, savestate.DEAD])
+    state.standing.extend([7, 0])
+    state.flying.append(1)
+    state.dodos.extend([0, 1])
+    copy = savestate.loads(savestate.dumps(state))
+    for name in ('flags', 'level', 'payload', 'focus', 'bunny') + \
+            savestate.GameState.SCALARS:
+        assert_equals(getattr(copy, name), getattr(state, name))
+    for name, typecode in savestate.GameState.COLUMNS:
+        assert_equals(getattr(copy, name), getattr(state, name))
+
+
+def assert_snapshot_error(func, *args):
+    try:
+        func(*args)
+    except savestate.SnapshotError:
+        pass
+    else:
+        raise AssertionError('%s%r raised no SnapshotError' % (func.__name__,
+                                                               args))
+
+
+def test_bad_snapshots_are_refused():
+    state = savestate.GameState()
+    state.level, state.payload = 2, 0
+    for name, typecode in savestate.GameState.COLUMNS[:7]:
+        getattr(state, name).append(0)
+    data = savestate.dumps(state)
+    for size in range(len(data)):
+        assert_snapshot_error(savestate.loads, data[:size])
+    state.focus = 1 # only one dodo in the flock
+    assert_snapshot_error(savestate.loads, savestate.dumps(state))
+    state.focus = -1
+    # fine on its own, but not in a game on a map with two levels
+    state = savestate.loads(savestate.dumps(state))
+    state.check(3, 16)
+    assert_snapshot_error(state.check, 2, 16)
+    state.standing[0] = 16
+    assert_snapshot_error(state.check, 3, 16)
+
+
+class CountingGame(object):
+    """Its whole state is one number."""
+
+    def __init__(self):
+        self.n = 0
+
+    def capture_state(self):
+        state = savestate.GameState()
+        state.sea_level = self.n
+        return state
+
+    def restore_state(self, state):
+        self.n = state.sea_level
+
+
+def test_rewind_buffer():
+    game = CountingGame()
+    rewind = savestate.RewindBuffer(game, seconds=2.0, interval=0.5)
+    assert_false(rewind.rewind())
+    for game.n in range(10):
+        rewind.record()
+    # only the last 4 snapshots are kept
+    assert_true(rewind.rewind(1.0))
+    assert_equals(game.n, 8)
+    assert_true(rewind.rewind(5.0))
+    assert_equals(game.n, 6)
+    assert_true(rewind.rewind(0.5))
+    assert_equals(game.n, 6)
+
+
+def test_server_messages():
+    delta = server.encode_delta(7, 120, dict(power=12.5, game_over=1),
+                                [(3, 10.0, -2.5, 1), (4, 0.0, 0.0, 0)])
+    data = server.frame(server.DELTA, delta) + server.frame(server.DELTA)
+    messages, rest = server.split_frames(data + data[:3])
+    assert_equals(messages, [(server.DELTA, delta), (server.DELTA, '')])
+    assert_equals(rest, data[:3])
+    assert_equals(server.decode_delta(delta),
+                  (7, 120, dict(power=12.5, game_over=1),
+                   [(3, 10.0, -2.5, 1), (4, 0.0, 0.0, 0)]))
+
+
+def test_balance_summary():
+    assert_equals(list(balance.sweep(dict(gravity=[1, 2], max_power=[3]))),
+                  [[('gravity', 1), ('max_power', 3)],
+                   [('gravity', 2), ('max_power', 3)]])
+    summary = balance.Summary()
+    for completed, survivors, level_times in [(True, 5, [10.0, 4.0]),
+                                              (False, 0, [20.0])]:
+        summary.add(dict(params=[['gravity', 150.0]], completed=completed,
+                         timed_out=False, dodos=20, survivors=survivors,
+                         level_times=level_times))
+    assert_equals(summary.report(),
+                  ['gravity=150: 2 games, 50% completed, 12% of dodos saved,'
+                   ' 0 timed out',
+                   '    seconds per level: 1:15.0 2:4.0'])
+
+
+class StairsMap(object):
+    tile_width = 100
+    map_width = 1000
+
+    def ground_level(self, x):
+        col = int(x / self.tile_width)
+        return 0 <= col < 10 and 100 * (col // 3) or 1000
+
+
+def test_autoplay_landing_matches_stepping():
+    heightmap = autoplay.Heightmap(StairsMap())
+    table = autoplay.ShotTable(200.0, 0.14, 1 / 60., range(15, 76, 10),
+                               range(200, 1001, 100))
+    for xs, ys, apex in table.paths:
+        expected = None
+        prev_y = 50
+        for x, y in zip(xs, ys):
+            ground = StairsMap().ground_level(x + 20)
+            if y + 50 < ground:
+                expected = (x + 20, ground, prev_y >= ground)
+                break
+            prev_y = y + 50
+        assert_equals(heightmap.landing((xs, ys, apex), 20, 50), expected)
+
+
+class BrokenGroundLevel(fuzz.GroundLevel):
+    # forgets that rows too short to reach a column count as solid there
+
+    def optimized(self, case):
+        col = int(case['x'] / fuzz.TILE_WIDTH)
+        y = 0
+        for line in fuzz.parse(case['rows']):
+            if line[col:col+1] != '#':
+                break
+            y += fuzz.TILE_HEIGHT
+        return y
+
+
+def test_fuzz_shrinks_mismatches():
+    target = BrokenGroundLevel()
+    case = dict(rows=['#   ', '##  ', '### ', '####'], x=123.25)
+    assert_equals(fuzz.mismatch(target, case), None)
+    case['rows'] = ['#', '##', '###', '####']
+    assert_equals(fuzz.mismatch(target, case), (400, 300))
+    assert_equals(fuzz.shrink(target, case), dict(rows=['#'], x=120.0))
+
+
+def test_telemetry_report():
+    report = telemetry.Report()
+    histogram = [0] * (len(telemetry.FRAME_BUCKETS) + 1)
+    histogram[3] = 90 # 15-17 ms
+    histogram[6] = 10 # 25-34 ms
+    report.read(['{"type": "load", "what": "game", "seconds": 0.5}',
+                 '{"type": "frames", "level": 2, "frames": 100, "ticks": 200,'
+                 ' "overruns": 3, "dodos": 12, "histogram": %s}' % histogram,
+                 '{"type": "frames", "level": 2, "broken',
+                 ''])
+    assert_equals(telemetry.percentile(report.levels[2]['histogram'], 0.5),
+                  15.0 + 2.0 * 50 / 90)
+    assert_equals(telemetry.percentile(report.levels[2]['histogram'], 0.95),
+                  25.0 + 9.0 * 5 / 10)
+    assert_equals(report.report()[2:],
+                  ['    2      100    16.1    29.5    33.1      1.5%   12.0',
+                   'load game: 1 times, p50 500 ms, p95 500 ms, p99 500 ms'])
+
+
+def test_telemetry_counts_late_ticks_in_real_time():
+    writer = telemetry.TelemetryWriter(os.devnull)
+    writer.tick(1 / 60.)
+    writer.last_tick -= 0.1 # as if the next tick came 100 ms later...
+    writer.tick(1 / 60.) # ...even though a fixed step reports one tick
+    writer.tick(1 / 60.)
+    assert_equals((writer.ticks, writer.overruns), (3, 1))
+    writer.load('game', 0.5)
+    writer.tick(1 / 60.)
+    assert_equals((writer.ticks, writer.overruns), (4, 1))
+
+
+def test_quality_drops_when_frames_are_slow():
+    qc = QualityController()
+    changed = [qc.add_frame(1 / 30.) for n in range(qc.window_size)]
+    assert_equals(changed, [False] * (qc.window_size - 1) + [True])
+    assert_equals(qc.level, 1)
+
+
+def test_quality_does_not_flicker():
+    qc = QualityController()
+    qc.level = 2
+    fast, slow = 1 / 60., 1 / 40.
+    # enough fast frames to try one level up...
+    for n in range(int(qc.min_probe_delay / fast) + 1):
+        qc.add_frame(fast)
+    assert_equals(qc.level, 1)
+    # ...which turns out to be too slow
+    for n in range(qc.window_size):
+        qc.add_frame(slow)
+    assert_equals(qc.level, 2)
+    # so the next attempt waits twice as long
+    for n in range(int(qc.min_probe_delay / fast) + 1):
+        qc.add_frame(fast)
+    assert_equals(qc.level, 2)
+    for n in range(int(qc.min_probe_delay / fast) + 1):
+        qc.add_frame(fast)
+    assert_equals(qc.level, 1)
+
+
+def test_frame_pacer_snaps_jitter():
+    pacer = FramePacer()
+    rng = random.Random(1)
+    # flips every refresh, seen through a timer that is up to 2 ms off
+    flips = [n / 60. + rng.uniform(-0.002, 0.002) for n in range(300)]
+    paced = []
+    for now in flips:
+        pacer.present(now)
+        paced.append(pacer.take())
+    assert_equals(pacer.estimate, 1 / 60.)
+    # once the refresh rate is known every frame is one refresh long...
+    assert_equals(set(paced[FramePacer.estimate_every + 1:]), set([1 / 60.]))
+    # ...and game time keeps up with the timer
+    assert abs(sum(paced) + pacer.carry - (flips[-1] - flips[0])) < 1e-9
+    # a dropped frame takes two refreshes; a stall is passed through
+    assert_equals(pacer.frame(2 / 60.), 2 / 60.)
+    carry = pacer.carry
+    assert_equals(pacer.frame(6.5 / 60.), 6.5 / 60. + carry)
+    assert_equals(pacer.carry, 0.0)
+    mean, raw, smooth, snapped = pacer.stats()
+    assert smooth < raw
+
+
+def test_renderbench_compare():
+    golden = '\x00\x00\x00\xff' * 4
+    assert_equals(renderbench.compare(golden, golden, 8), ([], 0))
+    frame = ('\x00\x00\x00\xff' + '\x05\x00\x00\xff' +
+             '\x00\x00\x00\xff' + '\x00\x00\x40\xff')
+    assert_equals(renderbench.compare(frame, golden, 8), ([3], 0x40))
+
+
+def test_flights_do_not_depend_on_the_tick_rate():
+    def fly(rate):
+        game = FakeGame(FakeMap(ground_level=100))
+        game.gravity, game.air_resistance = 200.0, 0.14
+        dodo = Dodo(game)
+        dodo.x, dodo.y = 20.0, 130.0
+        dodo.launch(300.0, 250.0)
+        path = []
+        while dodo.in_flight:
+            dodo.update(1.0 / rate)
+            path.append((dodo.x, dodo.y))
+        return path
+    paths = dict((rate, fly(rate)) for rate in (30, 60, 120))
+    # where the dodos are at the end of every 1/30 of a second...
+    for n, (x, y) in enumerate(paths[30][:-1]):
+        for rate in 60, 120:
+            other = paths[rate][(n + 1) * rate // 30 - 1]
+            assert abs(other[0] - x) < 1e-6 and abs(other[1] - y) < 1e-6
+    # ...and where they land; landings are found on straight steps
+    for rate in 60, 120:
+        assert abs(paths[rate][-1][0] - paths[30][-1][0]) < 0.5
+        assert_equals(paths[rate][-1][1], 100.0)
+
+
+class FakeTexture(object):
+
+    def __init__(self, id, width, height, owner=None, x=0, y=0):
+        self.id, self.width, self.height = id, width, height
+        self.owner, self.x, self.y = owner, x, y
+        self.blits = []
+
+    def get_texture(self):
+        return self
+
+    def blit_into(self, data, x, y, z):
+        self.blits.append((data, x, y))
+
+
+class FakeTextureRegistry(texturecache.TextureRegistry):
+
+    min_idle = 2
+
+    def __init__(self, budget):
+        texturecache.TextureRegistry.__init__(self, lambda name: name, budget)
+        self._bind = lambda target, texture: None
+
+    def release(self, texture):
+        pass
+
+    def allocate(self, texture):
+        texture.blits = []
+
+
+def test_texture_registry_evicts_idle_textures():
+    atlas = FakeTexture(1, 256, 256)
+    sky = FakeTexture(2, 1024, 1024)
+    registry = FakeTextureRegistry(budget=1024 * 1024)
+    registry.register('Dodo.png', FakeTexture(1, 32, 32, atlas, 64, 0), 'dodos')
+    registry.register('Earth_1.png', FakeTexture(1, 64, 64, atlas), 'terrain')
+    registry.register('sky.png', sky, 'sky')
+    assert_equals(registry.resident(), (256 * 256 + 1024 * 1024) * 4)
+    layers, assets = registry.usage()
+    assert_equals(layers, {'dodos': 32 * 32 * 4, 'terrain': 64 * 64 * 4,
+                           'sky': 1024 * 1024 * 4})
+    # only the atlas is drawn; the sky goes idle and is dropped
+    for frame in range(4):
+        registry.glBindTexture(None, atlas.id)
+        registry.end_frame()
+    assert_equals(registry.resident(), 256 * 256 * 4)
+    assert_equals(registry.evictions, 1)
+    # drawing it again loads it back
+    registry.glBindTexture(None, sky.id)
+    assert_equals(sky.blits, [('sky.png', 0, 0)])
+    assert_equals(registry.reloads, 1)
+    assert_equals(registry.report()[0],
+                  'textures   4.2 MB in 2, budget 1 MB, 0 evicted')
+
+
+class FakeFrame(object):
+
+    def __init__(self, image, duration):
+        self.image, self.duration = image, duration
+
+
+class FakeAnimation(object):
+
+    def __init__(self, *frames):
+        self.frames = [FakeFrame(image, 0.5) for image in frames]
+
+
+def test_animator_only_updates_sprites_in_view():
+    now = [0.0]
+    animator = SpriteAnimator(time=lambda: now[0])
+    blink = FakeAnimation('open', 'closed')
+    here = FakePygletSprite.Sprite(None, 100, 300)
+    there = FakePygletSprite.Sprite(None, 5000, 300)
+    for sprite in here, there:
+        animator.add(sprite, blink, sprite.x)
+        assert_equals(sprite.image, 'open')
+    now[0] = 0.75
+    animator.update(0, 0, 1000, 600)
+    assert_equals((here.image, there.image), ('closed', 'open'))
+    # the one out of view catches up when it comes into view
+    now[0] = 2.6
+    animator.update(4500, 0, 5500, 600)
+    assert_equals((here.image, there.image), ('closed', 'closed'))
+    animator.remove(there)
+    assert_equals(len(animator), 1)
+
+
+class ViewedGame(FakeGame):
+
+    dodo_batch = 'batch'
+    dodo_group = None
+    bunny = None
+
+    def __init__(self, game_map):
+        FakeGame.__init__(self, game_map)
+        self.dodopult = Spot()
+        self.dodopult.payload = None
+        self.animator = SpriteAnimator()
+
+
+def test_dodos_only_have_sprites_in_view():
+    game = ViewedGame(FakeMap(ground_level=100))
+    game.flock = Flock(game)
+    dodos = [Dodo(game, game.flock) for n in range(3)]
+    for dodo, x in zip(dodos, [100.0, 900.0, 5000.0]):
+        dodo.x, dodo.y = x, 100.0
+    game.flock.sync_sprites()
+    assert_equals([dodo.sprite for dodo in dodos], [None] * 3)
+    game.flock.show_sprites_in(0, 0, 1000, 600)
+    assert_equals([dodo.sprite is not None for dodo in dodos],
+                  [True, True, False])
+    dodos[1].vanish()
+    game.flock.show_sprites_in(0, 0, 1000, 600)
+    assert_equals(dodos[1].sprite, None)
+    # the dodo that walks away loses its sprite, and gets it back
+    dodos[0].x = 3000.0
+    game.flock.sync_sprites()
+    game.flock.show_sprites_in(4500, 0, 5500, 600)
+    assert_equals([dodo.sprite is not None for dodo in dodos],
+                  [False, False, True])
+    game.flock.show_sprites_in(2500, 0, 3500, 600)
+    assert_equals([dodo.sprite is not None for dodo in dodos],
+                  [True, False, False])
+    assert_equals(game.flock.shown, set([0]))
+
+
+class QueuedPlayer(object):
+
+    def __init__(self, *sources):
+        self.sources = list(sources)
+        self.playing = True
+
+    @property
+    def source(self):
+        return self.sources and self.sources[0] or None
+
+    def pause(self):
+        self.playing = False
+
+    def next(self):
+        self.sources.pop(0)
+
+
+def test_stopped_games_leave_their_dodos_to_the_next():
+    old = FakeGame(FakeMap(ground_level=100))
+    old.clouds = None
+    old.flock = Flock(old)
+    dodos = [Dodo(old, old.flock) for n in range(3)]
+    for dodo in dodos:
+        dodo.x, dodo.y = 20.0, 100.0
+    dodos[0].launch(10.0, 200.0)
+    dodos[1].is_alive = False
+    dodos[2].player = QueuedPlayer('splat.wav', 'splat.wav')
+    release_player(dodos[2].player)
+    assert_false(dodos[2].player.playing)
+    assert_equals(dodos[2].player.source, None)
+
+    pool = WorldPool()
+    pool.put(old)
+    new = FakeGame(FakeMap(ground_level=300))
+    game_map, clouds, flock = pool.take(new)
+    assert_true(flock is old.flock)
+    assert_true(game_map is old.game_map)
+    for dodo in flock.members:
+        dodo.reset()
+        assert_true(dodo.game is new)
+        assert_true(dodo.is_alive)
+    assert_equals(flock.flying, set())
+    # a pool hands its parts out once
+    assert_equals(pool.take(new), (None, None, None))
+
+
+class RecordingClock(object):
+
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule_interval(self, func, interval):
+        self.scheduled.append(func)
+
+    def schedule_once(self, func, delay):
+        self.scheduled.append(func)
+
+    def unschedule(self, func):
+        self.scheduled = [f for f in self.scheduled if f != func]
+
+
+class ManualClock(RecordingClock):
+    """Calls what is scheduled on it when the test ticks it."""
+
+    def __init__(self):
+        RecordingClock.__init__(self)
+        self.time = 0.0
+        self.due = {} # func -> time, for schedule_once()
+
+    def schedule_once(self, func, delay):
+        RecordingClock.schedule_once(self, func, delay)
+        self.due[func] = self.time + delay
+
+    def unschedule(self, func):
+        RecordingClock.unschedule(self, func)
+        self.due.pop(func, None)
+
+    def tick(self, dt):
+        self.time += dt
+        for func in list(self.scheduled):
+            if func not in self.due:
+                func(dt)
+            elif self.due[func] <= self.time:
+                self.unschedule(func)
+                func(dt)
+
+
+def test_restored_games_are_the_captured_ones():
+    random.seed(0)
+    clock = ManualClock()
+    game = dodo.Game(headless=True, clock=clock)
+    for n in range(600):
+        if game.dodopult.payload is not None:
+            break
+        autoplay.walk_to_nearest_dodo(game)
+        clock.tick(game.update_freq)
+    payload = game.dodopult.payload
+    assert_true(payload is not None)
+    game.dodos[-1].drown()
+    loaded = game.capture_state()
+    # headless dodos have no sprites, but they still have looks
+    assert_equals(loaded.looks[payload.index], savestate.READY)
+    assert_equals(list(loaded.looks).count(savestate.GONE), 1)
+
+    for n in range(3):
+        game.dodopult.aim_up()
+    game.dodopult.fire()
+    clock.tick(game.update_freq)
+    flying = game.capture_state()
+    assert_equals(game.flock.flying, set([payload.index]))
+
+    for n in range(300):
+        clock.tick(game.update_freq)
+    assert_false(payload.in_flight)
+    game.game_over()
+    assert_equals(len(game.flock), game.INITIAL_DODOS + 1)
+
+    for state in flying, loaded:
+        game.restore_state(state)
+        flock = game.flock
+        assert_equals((flock.x, flock.y), (state.x, state.y))
+        assert_equals(flock.flying, set(state.flying))
+        assert_equals(array('B', [member.look for member in flock.members]),
+                      state.looks)
+        assert_false(game.game_is_over)
+        assert_true(game.bunny is None)
+    assert_true(game.dodopult.payload is payload)
+    assert_equals(payload.look, savestate.READY)
+    assert_equals(game.dodos[-1].look, savestate.GONE)
+    assert_equals(game.dodos[0].look, savestate.STANDING)
+
+
+def test_new_games_reuse_the_world_of_stopped_ones():
+    pool = WorldPool()
+    clock = RecordingClock()
+    game = dodo.Game(headless=True, clock=clock, pool=pool)
+    scheduled = len(clock.scheduled)
+    game.next_level()
+    game.game_over()
+    game.stop(pool)
+    assert_equals(clock.scheduled, [])
+
+    new = dodo.Game(headless=True, clock=clock, pool=pool)
+    assert_equals(len(clock.scheduled), scheduled)
+    assert_true(new.game_map is game.game_map)
+    assert_true(new.flock is game.flock)
+    assert_equals(len(new.flock), new.INITIAL_DODOS) # no bunny
+    assert_true(all(member.is_alive and member.game is new
+                    for member in new.dodos))
+    assert_true(new.current_level is new.game_map.levels[0])
+    new.stop()
+    assert_equals(clock.scheduled, [])
+
+
+class Spot(object):
+    x = y = level = phase = 0
+
+
+class TickCountingClock(object):
+
+    ticks = 0
+
+    def tick(self, poll=False):
+        self.ticks += 1
+
+
+class ThreadedGame(object):
+
+    update_freq = 0.001
+    game_over_time = 0
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clock = TickCountingClock()
+        self.camera = self.sea = self.dodopult = Spot()
+        self.flock = Flock(self)
+
+
+def test_simulation_stops_while_the_lock_is_held():
+    game = ThreadedGame()
+    simulation = SimulationThread(game)
+    simulation.start()
+    while not game.clock.ticks:
+        time.sleep(0.001)
+    still_held = []
+    def stop_from_an_input_handler():
+        with game.lock:
+            with game.lock:
+                simulation.stop()
+            still_held.append(game.lock.acquire(False))
+            game.lock.release()
+    stopper = threading.Thread(target=stop_from_an_input_handler)
+    stopper.daemon = True
+    stopper.start()
+    stopper.join(2.0)
+    assert_false(stopper.is_alive())
+    assert_false(simulation.is_alive())
+    assert_equals(still_held, [True])
+
+
+def test_packed_sounds_can_be_queued_again_and_again():
+    tmp = tempfile.mkdtemp()
+    try:
+        assets = os.path.join(tmp, 'assets')
+        os.mkdir(assets)
+        w = wave.open(os.path.join(assets, 'splat.wav'), 'wb')
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(8000)
+        w.writeframes('\x01\x02' * 800)
+        w.close()
+        filename = os.path.join(tmp, 'assets.pak')
+        assetpack.pack(assets, filename)
+        sound = assetpack.open_archive(filename).media('splat.wav')
+        first = sound._get_queue_source() # as Player.queue() does
+        assert_equals(first._file.read(4), '\x01\x02\x01\x02')
+        second = sound._get_queue_source()
+        assert_equals(len(second._file.read()), 1600)
+        assert_equals(second._duration, 0.1)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,185 @@
+"""
+Texture memory accounting and budgeted eviction for Dodopult.
+
+dodo.py registers every image it loads with a `TextureRegistry`, together
+with the layer that draws it.  Small images share atlas textures, so the
+registry keeps track of textures (what the GPU allocates) and of the
+images on them (what the layers use), and can tell how much memory each
+asset, layer and texture takes.
+
+With a budget, install() hooks glBindTexture the way diagnostics.py's
+GLCounter hooks the draw calls, to see which textures each frame uses.
+When more memory than the budget is resident at the end of a frame, the
+textures that have gone unused longest are evicted: their storage is
+shrunk to a single texel, which frees the memory but keeps the texture
+name, so sprites and batches holding the texture don't notice.  Binding
+an evicted texture loads its images again from the asset files before
+the bind goes through.  Textures bound within the last ``min_idle``
+frames are never evicted, so a budget that is too small only means
+more memory is used than asked for.
+"""
+import sys
+
+from pyglet import gl
+
+
+MEGABYTE = 1024 * 1024
+
+
+class TextureEntry(object):
+    """A texture and the assets drawn from it."""
+
+    __slots__ = ('texture', 'assets', 'last_used', 'evicted')
+
+    def __init__(self, texture):
+        self.texture = texture
+        self.assets = [] # (name, x, y, width, height, layer)
+        self.last_used = 0
+        self.evicted = False
+
+    @property
+    def size(self):
+        """Bytes of texture memory, assuming 4 bytes per texel."""
+        return self.texture.width * self.texture.height * 4
+
+
+class TextureRegistry(object):
+    """Counts texture memory per asset and layer, and keeps it in budget.
+
+    ``load_data(name)`` must return the decoded image of an asset, for
+    reloading evicted textures.  ``budget`` is in bytes; None means no
+    limit (the memory is still counted).
+    """
+
+    min_idle = 120 # frames a texture must go unused before it is evicted
+
+    def __init__(self, load_data, budget=None):
+        self.load_data = load_data
+        self.budget = budget
+        self.textures = {} # texture id -> TextureEntry
+        self.names = set()
+        self.frame = 0
+        self.evictions = 0
+        self.reloads = 0
+        self._bind = getattr(gl, 'glBindTexture', None)
+        self._patched = []
+
+    def register(self, name, image, layer='other'):
+        """Note that ``image`` was loaded from the asset ``name``."""
+        if name in self.names:
+            return
+        self.names.add(name)
+        texture = image.get_texture()
+        owner = getattr(texture, 'owner', None) or texture
+        entry = self.textures.get(owner.id)
+        if entry is None:
+            entry = self.textures[owner.id] = TextureEntry(owner)
+            entry.last_used = self.frame
+        entry.assets.append((name, texture.x, texture.y, texture.width,
+                             texture.height, layer))
+        if entry.evicted:
+            # pyglet just packed the image into an atlas we had evicted
+            self.reload(entry)
+
+    def resident(self):
+        """Bytes of texture memory in use by the registered textures."""
+        return sum(entry.size for entry in self.textures.values()
+                   if not entry.evicted)
+
+    def usage(self):
+        """Return {layer: bytes} and {asset: bytes} of resident images."""
+        layers, assets = {}, {}
+        for entry in self.textures.values():
+            if entry.evicted:
+                continue
+            for name, x, y, width, height, layer in entry.assets:
+                size = width * height * 4
+                assets[name] = size
+                layers[layer] = layers.get(layer, 0) + size
+        return layers, assets
+
+    def report(self):
+        """Return the memory use as lines of text."""
+        layers, assets = self.usage()
+        evicted = len([entry for entry in self.textures.values()
+                       if entry.evicted])
+        line = 'textures   %.1f MB in %d' % (
+            self.resident() / float(MEGABYTE), len(self.textures) - evicted)
+        if self.budget is not None:
+            line += ', budget %.0f MB, %d evicted' % (
+                self.budget / float(MEGABYTE), evicted)
+        lines = [line]
+        for layer in sorted(layers, key=layers.get, reverse=True):
+            lines.append('  %-8s %6.2f MB' % (layer,
+                                              layers[layer] / float(MEGABYTE)))
+        return lines
+
+    # the hook and the budget
+
+    def glBindTexture(self, target, texture):
+        entry = self.textures.get(texture)
+        if entry is not None:
+            entry.last_used = self.frame
+            if entry.evicted:
+                self.reload(entry)
+        return self._bind(target, texture)
+
+    def install(self):
+        """Start watching glBindTexture in every module that calls it."""
+        if self._patched:
+            return
+        original = self._bind
+        wrapper = self.glBindTexture
+        for module in list(sys.modules.values()):
+            if getattr(module, '__dict__', {}).get('glBindTexture') is original:
+                setattr(module, 'glBindTexture', wrapper)
+                self._patched.append(module)
+
+    def uninstall(self):
+        for module in self._patched:
+            setattr(module, 'glBindTexture', self._bind)
+        self._patched = []
+
+    def end_frame(self):
+        """Evict idle textures while over budget; call between frames."""
+        self.frame += 1
+        if self.budget is None:
+            return
+        over = self.resident() - self.budget
+        if over <= 0:
+            return
+        idle = [entry for entry in self.textures.values()
+                if not entry.evicted
+                and self.frame - entry.last_used > self.min_idle]
+        idle.sort(key=lambda entry: entry.last_used)
+        for entry in idle:
+            if over <= 0:
+                break
+            self.evict(entry)
+            over -= entry.size
+
+    def evict(self, entry):
+        self.release(entry.texture)
+        entry.evicted = True
+        self.evictions += 1
+
+    def reload(self, entry):
+        entry.evicted = False
+        self.allocate(entry.texture)
+        for name, x, y, width, height, layer in entry.assets:
+            entry.texture.blit_into(self.load_data(name), x, y, 0)
+        self.reloads += 1
+
+    def release(self, texture):
+        """Shrink a texture's storage to one texel."""
+        self._bind(texture.target, texture.id)
+        pixel = (gl.GLubyte * 4)()
+        gl.glTexImage2D(texture.target, 0, gl.GL_RGBA, 1, 1, 0, gl.GL_RGBA,
+                        gl.GL_UNSIGNED_BYTE, pixel)
+
+    def allocate(self, texture):
+        """Give a released texture back its full-size storage."""
+        self._bind(texture.target, texture.id)
+        gl.glTexImage2D(texture.target, 0, gl.GL_RGBA, texture.width,
+                        texture.height, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                        None)